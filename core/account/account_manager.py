@@ -11,14 +11,14 @@
 #
 import datetime
 import logging
-from copy import deepcopy
+from collections import deque
 
 from dateutil import parser
 from typing import List
 
-from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
 
+from core.account.closed_orders_uploader import ClosedOrdersUploader, BigQuerySink
 from core.backtesting.backtest_result import BacktestResult
 from core.candles.binance_client import BinanceClient
 from core.order.moby_order import MobyOrder, OrderMode, OrderStatus, OrderPosition
@@ -35,6 +35,7 @@ class Account:
         self.available_balance: float = 0
         self.opened_positions: List[MobyOrder] = list()
         self.closed_positions: List[MobyOrder] = list()
+        self.unmatched_closed_positions: List[MobyOrder] = list()  # Cerradas sin su trade de apertura en el periodo
 
 
 class AccountManager:
@@ -49,6 +50,7 @@ class AccountManager:
         self.__bq_client: bigquery.Client = None
         self.__bq_table_moby_order: bigquery.Table = None
         self.__bq_job_config: bigquery.LoadJobConfig = None
+        self.__closed_orders_uploader: ClosedOrdersUploader = None
 
     def load(self):
         self.__bq_client = bigquery.Client(project="fender-310315")
@@ -57,6 +59,8 @@ class AccountManager:
         self.__bq_job_config = bigquery.LoadJobConfig()
         self.__bq_job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
         self.__bq_job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        self.__closed_orders_uploader = ClosedOrdersUploader(
+            self.__account_name, BigQuerySink(self.__bq_client, self.__bq_table_moby_order, self.__bq_job_config))
         return self
 
     def build_account_summary(self, start_time_text: str = None, end_time_text: str = None, upload_to_bq=False) -> str:
@@ -72,7 +76,8 @@ class AccountManager:
 
         account = self.get_account_info(start_time, end_time, with_opened_positions_prices=(not hide_opened_positions))
         if upload_to_bq:
-            uploaded_rows = self.__upload_closed_orders_to_bq(account)
+            # Sin fechas el resumen ya tiene todo el historico de trades: se sube de el sin volver a pedirlos
+            uploaded_rows = self.upload_closed_positions(account if not hide_opened_positions else None)
             logging.info("Se han volcado a BQ {0} nuevas posiciones".format(uploaded_rows))
 
         msg = "BALANCE:\n"
@@ -179,20 +184,52 @@ class AccountManager:
 
         return msg
 
+    def upload_closed_positions(self, account: Account = None) -> int:
+        """Sube a BQ las posiciones cerradas despues del ultimo volcado. Sin account, pide solo los trades desde poco
+        antes del watermark, ampliando la ventana mientras alguna posicion pendiente quede sin su apertura"""
+
+        if account is None:
+            for start_time in self.__closed_orders_uploader.get_trades_start_times():
+                account = self.get_account_info(start_time, with_opened_positions_prices=False)
+                if not self.__closed_orders_uploader.get_pending(account.unmatched_closed_positions):
+                    break
+
+        # Con todo el historico, las que siguen sin apertura no se podran casar nunca: se saltan
+        unmatched_positions = self.__closed_orders_uploader.get_pending(account.unmatched_closed_positions)
+        if unmatched_positions:
+            logging.warning("{0} posiciones cerradas sin apertura en el historico de trades, no se suben".format(
+                len(unmatched_positions)))
+
+        return self.__closed_orders_uploader.upload(account.closed_positions, unmatched_positions)
+
     def get_account_info(self, start_time: datetime = None, end_time: datetime = None, with_opened_positions_prices=True) -> Account:
-        """Calls Binance Account Api to build an Account"""
+        """Calls Binance Account Api to build an Account. Without start_time, the last 180 days of trades are used"""
         account = Account()
 
         account_info = self.__binance_client.get_account_info()
-        account_trades = self.__binance_client.get_account_trade_list(start_time, end_time)
+        account_trades = self.__binance_client.get_all_account_trades(start_time, end_time)
         if with_opened_positions_prices:
-            all_positions_info = self.__binance_client.get_all_positions_information()
-            all_open_orders = self.__binance_client.get_open_orders()
+            # Indices por symbol (primera posicion por symbol, como el filtrado original)
+            positions_info_by_symbol = dict()
+            for pos_info in self.__binance_client.get_all_positions_information():
+                positions_info_by_symbol.setdefault(pos_info["symbol"], pos_info)
+            open_orders_by_symbol = dict()
+            for open_order in self.__binance_client.get_open_orders():
+                open_orders_by_symbol.setdefault(open_order["symbol"], []).append(open_order)
 
         account.wallet_balance = float(account_info["totalWalletBalance"])
         account.margin_balance = float(account_info["totalMarginBalance"])
         account.available_balance = float(account_info["availableBalance"])
 
+        # Indices para casar trades con posiciones:
+        #   - pending_positions_by_symbol: posiciones aun sin open_time, en orden de creacion
+        #   - positions_by_open_order_id / closed_positions_by_close_order_id
+        #   - position_sequence: orden de cada posicion en opened_positions + closed_positions, para desempatar
+        pending_positions_by_symbol = dict()
+        positions_by_open_order_id = dict()
+        closed_positions_by_close_order_id = dict()
+        position_sequence = dict()
+
         for position in account_info["positions"]:
             if position["initialMargin"] != "0":
                 opened_position = MobyOrder(position["symbol"])
@@ -204,30 +241,39 @@ class AccountManager:
                 opened_position.status = OrderStatus.Open
                 opened_position.account = self.__account_name
                 if with_opened_positions_prices:
-                    pos_info = [pos for pos in all_positions_info if pos["symbol"] == opened_position.ticker]
-                    open_orders = [order for order in all_open_orders if order["symbol"] == opened_position.ticker]
+                    pos_info = positions_info_by_symbol.get(opened_position.ticker)
+                    open_orders = open_orders_by_symbol.get(opened_position.ticker, [])
                     stoploss_order = [order for order in open_orders if order["type"] == "STOP_MARKET"]
                     take_profit_order = [order for order in open_orders if order["type"] == "TAKE_PROFIT_MARKET"]
 
-                    opened_position.close_price = float(pos_info[0]["markPrice"]) if pos_info else None
+                    opened_position.close_price = float(pos_info["markPrice"]) if pos_info else None
                     opened_position.stop_loss = float(stoploss_order[0]["stopPrice"]) if stoploss_order else None
                     opened_position.take_profit_price = float(take_profit_order[0]["stopPrice"]) if take_profit_order else None
 
                 account.opened_positions.append(opened_position)
+                position_sequence[id(opened_position)] = len(position_sequence)
+                pending_positions_by_symbol.setdefault(opened_position.ticker, deque()).append(opened_position)
 
         for trade in reversed(account_trades):
             if trade["realizedPnl"] == "0":  # Open
-                position = None
                 symbol = trade["symbol"]
-                for current_position in account.opened_positions + account.closed_positions:
-                    if (current_position.ticker == symbol and current_position.open_time is None) or current_position.open_order_id == trade["orderId"]:
-                        position = current_position
-                        break
+
+                # Primera posicion (en orden de creacion) pendiente de ese symbol, o ya abierta por esa misma orden
+                pending_positions = pending_positions_by_symbol.get(symbol)
+                candidates = [pending_positions[0]] if pending_positions else []
+                if trade["orderId"] in positions_by_open_order_id:
+                    candidates.append(positions_by_open_order_id[trade["orderId"]])
+                position = min(candidates, key=lambda candidate: position_sequence[id(candidate)]) if candidates else None
 
                 if position is None:
                     logging.warning("Posicion abierta que no está ni cerrada ni en curso ¿?")
                 else:
+                    if position.open_time is None:
+                        pending_positions.popleft()
                     position.open_order_id = trade["orderId"]
+                    same_order_position = positions_by_open_order_id.get(trade["orderId"])
+                    if same_order_position is None or position_sequence[id(position)] < position_sequence[id(same_order_position)]:
+                        positions_by_open_order_id[trade["orderId"]] = position
                     position.open_time = unix_time_to_datetime_utc(trade["time"])
                     position.position = OrderPosition.Long if trade["side"] == "BUY" else OrderPosition.Short
                     position.open_price = float(trade["price"])
@@ -236,17 +282,15 @@ class AccountManager:
                     position.update_metrics()
 
             else:  # Close
-                closed_position = None
-
                 # Find position closed with >1 orders
-                for current_position in account.closed_positions:
-                    if current_position.close_order_id == trade["orderId"]:
-                        closed_position = current_position
-                        break
+                closed_position = closed_positions_by_close_order_id.get(trade["orderId"])
 
                 if closed_position is None:
                     closed_position = MobyOrder(trade["symbol"])
                     account.closed_positions.append(closed_position)
+                    closed_positions_by_close_order_id[trade["orderId"]] = closed_position
+                    position_sequence[id(closed_position)] = len(position_sequence)
+                    pending_positions_by_symbol.setdefault(closed_position.ticker, deque()).append(closed_position)
 
                     closed_position.close_order_id = trade["orderId"]
                     closed_position.close_price = float(trade["price"])
@@ -261,57 +305,12 @@ class AccountManager:
 
                 closed_position.commission += float(trade["commission"])
 
+        account.unmatched_closed_positions = [position for position in account.closed_positions
+                                              if position.open_time is None]
         account.closed_positions = [position for position in account.closed_positions if position.open_time is not None]
 
         return account
 
-    def __upload_closed_orders_to_bq(self, account: Account):
-        """Upload orders from account to BQ only if not already exist. Does not uses Streaming Insert"""
-
-        query = """
-            SELECT open_order_id
-            FROM `fender-310315.MobyDick.MobyOrderReal`
-            WHERE account = '{0}'
-        """.format(self.__account_name)
-
-        query_job = self.__bq_client.query(query)  # Make an API request.
-        already_in_bq_open_order_ids = [row[0] for row in query_job]
-
-        json_rows = [
-            deepcopy(position).__dict__ for position in account.closed_positions
-            if position.open_order_id not in already_in_bq_open_order_ids
-        ]
-
-        if not json_rows:
-            return 0
-
-        # Datetimes to str, and delete Nones
-        for i in range(len(json_rows)):
-            position_json = json_rows[i]
-            position_json_copy = position_json.copy()
-            for key, value in position_json.items():
-                if type(value) == datetime.datetime:
-                    position_json_copy[key] = str(value)
-                elif value is None:
-                    del(position_json_copy[key])
-            json_rows[i] = position_json_copy
-
-        job = self.__bq_client.load_table_from_json(
-            json_rows=json_rows,
-            destination=self.__bq_table_moby_order,
-            job_config=self.__bq_job_config
-        )
-
-        try:
-            job.result()  # Waits for table load to complete.
-        except BadRequest as e:
-            for error in job.errors:
-                logging.error('ERROR: {}'.format(error['message']))
-            raise e
-
-        # Return number of uploaded rows
-        return job.output_rows
-
 
 # Local Testing
 if __name__ == "__main__":
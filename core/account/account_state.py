@@ -0,0 +1,129 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Account State - Cached snapshot of positions, open orders and leverage of a Binance account]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from core.candles.binance_client import BinanceClient
+from core.utils.redisclient import RedisClient
+
+
+class AccountState:
+    """Snapshot de posiciones, ordenes abiertas y apalancamiento por symbol, refrescado con una sola llamada
+    bulk a /positionRisk (y otra a /openOrders) por escaneo en lugar de una llamada por señal"""
+
+    def __init__(self, binance_client: BinanceClient, account: str, max_age_seconds: float = 120):
+        """Default constructor
+        Args:
+            binance_client: Cliente firmado de la cuenta
+            account: Nombre de la cuenta, para las claves de Redis
+            max_age_seconds: Antigüedad maxima del snapshot antes de refrescarlo bajo demanda
+        """
+
+        self.__binance_client = binance_client
+        self.__account = account
+        self.__max_age_seconds = max_age_seconds
+        # La reserva debe sobrevivir al snapshot que protege (hasta que caduque otro worker puede ver el symbol
+        # sin posicion) mas la latencia de enviar la orden
+        self.__claim_seconds = int(max_age_seconds) + 60
+
+        self.__lock = threading.Lock()
+        self.__position_amounts: Dict[str, float] = None
+        self.__leverages: Dict[str, int] = dict()
+        self.__open_orders: Dict[str, List[dict]] = dict()
+        self.__refreshed_at: float = 0
+
+    def refresh(self):
+        """Descarga posiciones y ordenes abiertas de toda la cuenta, en paralelo"""
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            positions_future = executor.submit(self.__binance_client.get_all_positions_information)
+            open_orders_future = executor.submit(self.__binance_client.get_open_orders)
+            positions = positions_future.result()
+            open_orders = open_orders_future.result()
+
+        position_amounts = dict()
+        leverages = dict()
+        for position in positions:
+            # En Hedge Mode hay una entrada por lado, acumulamos el tamaño absoluto
+            position_amounts[position["symbol"]] = position_amounts.get(position["symbol"], 0) + abs(float(position["positionAmt"]))
+            leverages[position["symbol"]] = int(position["leverage"])
+
+        open_orders_by_symbol = dict()
+        for open_order in open_orders:
+            open_orders_by_symbol.setdefault(open_order["symbol"], []).append(open_order)
+
+        with self.__lock:
+            self.__position_amounts = position_amounts
+            self.__leverages = leverages
+            self.__open_orders = open_orders_by_symbol
+            self.__refreshed_at = time.time()
+
+    def is_position_open(self, symbol: str) -> bool:
+        """True si hay una posicion abierta sobre el symbol"""
+
+        if not self.__ensure_fresh():
+            return self.__binance_client.is_position_open(symbol)
+        return self.__position_amounts.get(symbol, 0) != 0
+
+    def has_open_orders(self, symbol: str) -> bool:
+        """True si hay ordenes abiertas (ej: stops residuales) sobre el symbol"""
+
+        if not self.__ensure_fresh():
+            return True
+        return len(self.__open_orders.get(symbol, [])) > 0
+
+    def get_leverage(self, symbol: str) -> int:
+        """Apalancamiento configurado en el symbol, None si no se conoce"""
+
+        if not self.__ensure_fresh():
+            return None
+        return self.__leverages.get(symbol)
+
+    def claim_symbol(self, symbol: str) -> bool:
+        """Reserva el symbol para abrir posicion, evitando que otro worker abra la misma entre refrescos"""
+
+        return RedisClient().save_value_if_not_exists("REAL_ORDER_CLAIM_" + self.__account + "_" + symbol, 1,
+                                                      self.__claim_seconds)
+
+    def mark_position_opened(self, symbol: str, position_amount: float):
+        with self.__lock:
+            if self.__position_amounts is not None:
+                self.__position_amounts[symbol] = position_amount
+
+    def mark_leverage(self, symbol: str, leverage: int):
+        with self.__lock:
+            self.__leverages[symbol] = leverage
+
+    def mark_orders_deleted(self, symbol: str):
+        with self.__lock:
+            self.__open_orders.pop(symbol, None)
+
+    def mark_order_opened(self, symbol: str, order: dict):
+        with self.__lock:
+            self.__open_orders.setdefault(symbol, []).append(order)
+
+    def __ensure_fresh(self) -> bool:
+        """Refresca el snapshot si ha caducado. False si no hay snapshot utilizable"""
+
+        if time.time() - self.__refreshed_at <= self.__max_age_seconds:
+            return True
+
+        try:
+            self.refresh()
+            return True
+        except Exception as e:
+            logging.exception("No se pudo refrescar el estado de la cuenta " + self.__account + ": " + repr(e))
+            return False
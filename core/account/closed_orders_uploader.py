@@ -0,0 +1,271 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Closed Orders Uploader - Incremental upload of closed real positions to BQ]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import datetime
+import logging
+
+from abc import ABC, abstractmethod
+from dateutil import parser
+from typing import List, Set
+
+from core.order.moby_order import MobyOrder
+
+
+class Watermark:
+    """Ultima posicion subida: su close_time y los close_order_id ya subidos con ese mismo close_time"""
+    def __init__(self, close_time: datetime.datetime = None, close_order_ids: Set[int] = None):
+        """Default constructor"""
+        self.close_time: datetime.datetime = close_time
+        self.close_order_ids: Set[int] = close_order_ids if close_order_ids is not None else set()
+
+    def is_uploaded(self, position: MobyOrder) -> bool:
+        if self.close_time is None:
+            return False
+        if position.close_time < self.close_time:
+            return True
+        return position.close_time == self.close_time and position.close_order_id in self.close_order_ids
+
+    def to_dict(self) -> dict:
+        return {"close_time": self.close_time.isoformat() if self.close_time is not None else None,
+                "close_order_ids": list(self.close_order_ids)}
+
+    @staticmethod
+    def from_dict(watermark_dict: dict) -> 'Watermark':
+        close_time = watermark_dict.get("close_time")
+        return Watermark(parser.parse(close_time) if close_time else None,
+                         set(watermark_dict.get("close_order_ids", [])))
+
+
+class OrderSink(ABC):
+    """Interfaz del destino de las posiciones cerradas"""
+
+    @abstractmethod
+    def write(self, json_rows: List[dict]) -> int:
+        """Escribe las filas y devuelve cuantas se han escrito"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_last_watermark(self, account: str) -> Watermark:
+        """Watermark deducido del propio destino, para arrancar cuando no hay uno guardado"""
+        raise NotImplementedError()
+
+
+class BigQuerySink(OrderSink):
+    """Posiciones cerradas en la tabla MobyOrderReal de BQ, con load jobs (no Streaming Insert)"""
+
+    def __init__(self, bq_client, bq_table, bq_job_config):
+        """Default constructor"""
+        self.__bq_client = bq_client
+        self.__bq_table = bq_table
+        self.__bq_job_config = bq_job_config
+
+    def write(self, json_rows: List[dict]) -> int:
+
+        from google.api_core.exceptions import BadRequest
+
+        job = self.__bq_client.load_table_from_json(
+            json_rows=json_rows,
+            destination=self.__bq_table,
+            job_config=self.__bq_job_config
+        )
+
+        try:
+            job.result()  # Waits for table load to complete.
+        except BadRequest as e:
+            for error in job.errors:
+                logging.error('ERROR: {}'.format(error['message']))
+            raise e
+
+        # Return number of uploaded rows
+        return job.output_rows
+
+    def get_last_watermark(self, account: str) -> Watermark:
+        """Solo se ejecuta una vez por cuenta, cuando no hay watermark guardado"""
+
+        query = """
+            SELECT close_time, close_order_id
+            FROM `fender-310315.MobyDick.MobyOrderReal`
+            WHERE account = '{0}'
+            AND close_time = (SELECT MAX(close_time) FROM `fender-310315.MobyDick.MobyOrderReal` WHERE account = '{0}')
+        """.format(account)
+
+        watermark = Watermark()
+        for row in self.__bq_client.query(query):
+            close_time = row[0]
+            if isinstance(close_time, str):
+                close_time = parser.parse(close_time)
+            watermark.close_time = close_time.replace(tzinfo=None)
+            watermark.close_order_ids.add(row[1])
+
+        return watermark
+
+
+class MemorySink(OrderSink):
+    """Sink en memoria, sustituye a BQ en pruebas locales"""
+
+    def __init__(self):
+        """Default constructor"""
+        self.rows: List[dict] = list()
+
+    def write(self, json_rows: List[dict]) -> int:
+        self.rows.extend(json_rows)
+        return len(json_rows)
+
+    def get_last_watermark(self, account: str) -> Watermark:
+        watermark = Watermark()
+        account_rows = [row for row in self.rows if row.get("account") == account]
+        if account_rows:
+            watermark.close_time = max(parser.parse(row["close_time"]) for row in account_rows)
+            watermark.close_order_ids = {row["close_order_id"] for row in account_rows
+                                         if parser.parse(row["close_time"]) == watermark.close_time}
+        return watermark
+
+
+class MemoryWatermarkStore:
+    """Sustituye a RedisClient (get_dict/save_dict) para guardar el watermark en pruebas locales"""
+
+    def __init__(self):
+        """Default constructor"""
+        self.values = dict()
+
+    def get_dict(self, key, serialization="json"):
+        return self.values.get(key, dict())
+
+    def save_dict(self, key, value, expiration_seconds=None, serialization="json"):
+        self.values[key] = value
+
+
+class ClosedOrdersUploader:
+    """Sube a un sink solo las posiciones cerradas posteriores al ultimo watermark de la cuenta"""
+
+    def __init__(self, account: str, sink: OrderSink, watermark_store=None, open_lookback_days: int = 7,
+                 max_open_lookback_days: int = 112):
+        """Default constructor
+        Args:
+            account: Nombre de la cuenta
+            sink: Destino de las filas (BigQuerySink, o MemorySink en pruebas)
+            watermark_store: Objeto con get_dict/save_dict para guardar el watermark. Por defecto RedisClient
+            open_lookback_days: Dias de trades anteriores al watermark con los que se intenta primero casar la
+                apertura de las posiciones que se cierran despues de el
+            max_open_lookback_days: Si alguna queda sin apertura, la ventana se dobla hasta este maximo; despues,
+                todo el historico de trades
+        """
+
+        if watermark_store is None:
+            from core.utils.redisclient import RedisClient
+            watermark_store = RedisClient()
+
+        self.__account = account
+        self.__sink = sink
+        self.__watermark_store = watermark_store
+        self.__watermark_key = "BQ_UPLOAD_WATERMARK_" + account
+        self.__open_lookback_days = open_lookback_days
+        self.__max_open_lookback_days = max_open_lookback_days
+
+    def get_watermark(self) -> Watermark:
+        """Watermark guardado, o deducido una unica vez del sink"""
+
+        watermark_dict = self.__watermark_store.get_dict(self.__watermark_key, serialization="json")
+        # Los watermarks antiguos (por open_order_id) se vuelven a deducir del sink
+        if watermark_dict and "close_order_ids" in watermark_dict:
+            return Watermark.from_dict(watermark_dict)
+
+        watermark = self.__sink.get_last_watermark(self.__account)
+        self.__save_watermark(watermark)
+        return watermark
+
+    def get_trades_start_times(self) -> List[datetime.datetime]:
+        """Desde cuando pedir trades para construir las posiciones aun no subidas, de menos a mas margen para casar sus
+        aperturas: open_lookback_days antes del watermark, el doble... hasta max_open_lookback_days, y por ultimo None
+        (todo el historico). Se pasa a la siguiente solo si quedan posiciones sin apertura"""
+
+        watermark = self.get_watermark()
+        if watermark.close_time is None:
+            return [None]
+
+        start_times = list()
+        lookback_days = self.__open_lookback_days
+        while lookback_days <= self.__max_open_lookback_days:
+            start_times.append(watermark.close_time - datetime.timedelta(days=lookback_days))
+            lookback_days *= 2
+        return start_times + [None]
+
+    def get_pending(self, positions: List[MobyOrder]) -> List[MobyOrder]:
+        """Posiciones posteriores al watermark (aun no subidas)"""
+
+        watermark = self.get_watermark()
+        return [position for position in positions if not watermark.is_uploaded(position)]
+
+    def upload(self, closed_positions: List[MobyOrder], skipped_positions: List[MobyOrder] = None) -> int:
+        """Sube las posiciones no subidas aun y avanza el watermark. Las posiciones sin apertura casada
+        (open_order_id None) no se suben. skipped_positions: posiciones que no se pueden subir (sin apertura en todo
+        el historico), que el watermark da por tratadas. Devuelve el numero de filas subidas"""
+
+        watermark = self.get_watermark()
+
+        new_positions = dict()
+        for position in closed_positions:
+            if position.open_order_id is None:
+                logging.warning("Posicion cerrada sin apertura, no se sube: " + str(position.close_order_id))
+                continue
+            if not watermark.is_uploaded(position):
+                new_positions.setdefault(position.close_order_id, position)
+
+        handled_positions = dict(new_positions)
+        for position in self.get_pending(skipped_positions or []):
+            handled_positions.setdefault(position.close_order_id, position)
+
+        if not handled_positions:
+            return 0
+
+        uploaded_rows = 0
+        if new_positions:
+            json_rows = [self.__to_json_row(position) for position in new_positions.values()]
+            uploaded_rows = self.__sink.write(json_rows)
+
+        # Avanzar el watermark
+        last_close_time = max(position.close_time for position in handled_positions.values())
+        last_close_order_ids = {position.close_order_id for position in handled_positions.values()
+                                if position.close_time == last_close_time}
+        if last_close_time == watermark.close_time:
+            last_close_order_ids |= watermark.close_order_ids
+        self.__save_watermark(Watermark(last_close_time, last_close_order_ids))
+
+        return uploaded_rows
+
+    def __save_watermark(self, watermark: Watermark):
+        self.__watermark_store.save_dict(self.__watermark_key, watermark.to_dict(), serialization="json")
+
+    @staticmethod
+    def __to_json_row(position: MobyOrder) -> dict:
+        """Datetimes to str, and delete Nones. Sin copiar la posicion"""
+        return {key: (str(value) if isinstance(value, datetime.datetime) else value)
+                for key, value in vars(position).items() if value is not None}
+
+
+# Local Testing
+if __name__ == "__main__":
+    memory_sink = MemorySink()
+    uploader = ClosedOrdersUploader("local", memory_sink, MemoryWatermarkStore())
+
+    positions = list()
+    for i in range(5):
+        position = MobyOrder("BTCUSDT")
+        position.account = "local"
+        position.open_order_id = i
+        position.close_order_id = 100 + i
+        position.close_time = datetime.datetime(2021, 12, 1) + datetime.timedelta(minutes=i // 2)
+        positions.append(position)
+
+    print("Subidas:", uploader.upload(positions[:3]))
+    print("Subidas:", uploader.upload(positions))
+    print("Subidas:", uploader.upload(positions))
+    print("Watermark:", uploader.get_watermark().to_dict())
@@ -2,10 +2,233 @@
 # Interacción con los chats/bots para notificaciones
 # Version: 0.1
 #
+import atexit
+import configparser
 import logging
+import os
+import queue
+import threading
+import time
 
-import telegram_send
+from contextlib import contextmanager
 from os import path
+from typing import Dict, List
+
+from requests import Session
+
+
+class TelegramDispatcher:
+    """Clase singleton que envía los mensajes desde un hilo en segundo plano, con una única conexión al Bot API,
+    agrupando ráfagas y respetando los límites de Telegram por chat"""
+
+    __instance = None
+    __init_called = False
+
+    __max_message_length = 4096
+    __group_min_interval_seconds = 3  # Grupos: 20 mensajes por minuto
+    __private_min_interval_seconds = 1  # Chats privados: 1 mensaje por segundo
+
+    def __new__(cls):
+
+        """ Generate singleton """
+
+        if TelegramDispatcher.__instance is None:
+            TelegramDispatcher.__instance = object.__new__(cls)
+        return TelegramDispatcher.__instance
+
+    def __init__(self):
+
+        """ Initialize variables """
+
+        if not self.__init_called:
+            self.__init_called = True
+
+            self.__coalesce_seconds = 1  # Mensajes que llegan juntos a un chat se envían en uno solo
+            self.__confs: Dict[str, dict] = dict()
+            self.__queue = queue.Queue(maxsize=1000)
+            self.__session = Session()
+            self.__last_sent: Dict[str, float] = dict()
+            self.__lock = threading.Lock()
+            self.__thread: threading.Thread = None
+            self.__thread_pid: int = None
+            self.__summaries = threading.local()
+
+            atexit.register(self.flush, 5)
+
+    def send(self, conf_path: str, message: str):
+        """Encola un mensaje para el chat del fichero de configuración. No bloquea"""
+
+        summary = getattr(self.__summaries, "messages", None)
+        if summary is not None:
+            summary.setdefault(conf_path, []).append(message)
+            return
+
+        self.__ensure_thread()
+        try:
+            self.__queue.put_nowait((conf_path, message))
+        except queue.Full:
+            logging.error("Cola de Telegram llena, se descarta el mensaje: " + message)
+
+    @contextmanager
+    def summary(self, title: str):
+        """Dentro del bloque, los mensajes de este hilo se acumulan y al salir se envía uno por chat con todos"""
+
+        if getattr(self.__summaries, "messages", None) is not None:
+            # Resumen anidado: se incluye en el exterior
+            yield
+            return
+
+        self.__summaries.messages = dict()
+        try:
+            yield
+        finally:
+            messages_by_conf = self.__summaries.messages
+            self.__summaries.messages = None
+            for conf_path, messages in messages_by_conf.items():
+                # Si no cabe en un mensaje de Telegram, se parte entre mensajes, sin cortar ninguno si es posible
+                header = "<strong>{0}</strong> ({1} mensajes{2})\n\n"
+                max_length = self.__max_message_length - len(header.format(title, len(messages), ", 9999/9999"))
+                parts = self.__join_messages(messages, max_length)
+                for i, part in enumerate(parts):
+                    part_label = ", {0}/{1}".format(i + 1, len(parts)) if len(parts) > 1 else ""
+                    self.send(conf_path, header.format(title, len(messages), part_label) + part)
+
+    def flush(self, timeout_seconds: float = 5):
+        """Espera (como mucho timeout_seconds) a que se envíe lo encolado"""
+
+        deadline = time.time() + timeout_seconds
+        while self.__queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+    def __ensure_thread(self):
+        """Arranca el hilo en el primer uso de cada proceso (los workers de gunicorn hacen fork)"""
+
+        if self.__thread is not None and self.__thread_pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__thread is not None and self.__thread_pid == os.getpid():
+                return
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread_pid = os.getpid()
+            self.__thread.start()
+
+    def __run(self):
+        """Bucle del hilo: agrupa lo que llegue en coalesce_seconds por chat y lo envía"""
+
+        while True:
+            conf_path, message = self.__queue.get()
+            pending: Dict[str, List[str]] = {conf_path: [message]}
+            taken = 1
+
+            deadline = time.time() + self.__coalesce_seconds
+            while time.time() < deadline:
+                try:
+                    conf_path, message = self.__queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                pending.setdefault(conf_path, []).append(message)
+                taken += 1
+
+            for conf_path, messages in pending.items():
+                for text in self.__join_messages(messages):
+                    try:
+                        self.__send_to_chat(conf_path, text)
+                    except Exception as e:
+                        logging.exception(repr(e))
+
+            for _ in range(taken):
+                self.__queue.task_done()
+
+    def __join_messages(self, messages: List[str], max_length: int = None) -> List[str]:
+        """Une mensajes en los menos textos posibles sin pasar de max_length (por defecto, el límite de longitud de
+        Telegram). Los cortes se hacen entre mensajes; solo un mensaje que no cabe solo se parte por líneas"""
+
+        if max_length is None:
+            max_length = self.__max_message_length
+
+        texts = list()
+        current = ""
+        for message in messages:
+            for part in self.__split_message(message, max_length):
+                if current and len(current) + 2 + len(part) > max_length:
+                    texts.append(current)
+                    current = ""
+                current = current + "\n\n" + part if current else part
+        if current:
+            texts.append(current)
+        return texts
+
+    @staticmethod
+    def __split_message(message: str, max_length: int) -> List[str]:
+        """Parte un mensaje en trozos de max_length como mucho, por saltos de línea (o a pelo si una línea no cabe)"""
+
+        if len(message) <= max_length:
+            return [message]
+
+        parts = list()
+        current = ""
+        for line in message.split("\n"):
+            while len(line) > max_length:
+                if current:
+                    parts.append(current)
+                    current = ""
+                parts.append(line[:max_length])
+                line = line[max_length:]
+            if current and len(current) + 1 + len(line) > max_length:
+                parts.append(current)
+                current = ""
+            current = current + "\n" + line if current else line
+        if current:
+            parts.append(current)
+        return parts
+
+    def __send_to_chat(self, conf_path: str, text: str):
+        """sendMessage al Bot API respetando el intervalo mínimo del chat y los 429 (retry_after)"""
+
+        conf = self.__get_conf(conf_path)
+        chat_id = conf["chat_id"]
+
+        min_interval = self.__group_min_interval_seconds if chat_id.startswith("-") else self.__private_min_interval_seconds
+        wait = self.__last_sent.get(chat_id, 0) + min_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        for attempt in range(3):
+            response = self.__session.post(
+                url="https://api.telegram.org/bot" + conf["token"] + "/sendMessage",
+                json={
+                    "chat_id": chat_id,
+                    "text": text,
+                    "parse_mode": "html",
+                    "disable_web_page_preview": True
+                },
+                timeout=10
+            )
+            self.__last_sent[chat_id] = time.time()
+
+            if response.status_code == 429:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                logging.warning("Telegram 429, reintentando en {0}s".format(retry_after))
+                time.sleep(retry_after)
+                continue
+
+            if response.status_code != 200:
+                raise Exception("Telegram Http Error " + str(response.status_code) + " " + response.text)
+            return
+
+        raise Exception("Telegram: mensaje descartado tras varios 429")
+
+    def __get_conf(self, conf_path: str) -> dict:
+        """Token y chat_id del fichero de configuración (formato telegram-send), leido una única vez"""
+
+        conf = self.__confs.get(conf_path)
+        if conf is None:
+            config = configparser.ConfigParser()
+            config.read(conf_path)
+            conf = {"token": config["telegram"]["token"], "chat_id": config["telegram"]["chat_id"]}
+            self.__confs[conf_path] = conf
+        return conf
 
 
 class Telegram:
@@ -13,15 +236,20 @@ class Telegram:
     def __init__(self):
         self.__conf_path_1 = path.dirname(path.realpath(__file__)) + "/telegram-bot-group1.conf"
         self.__conf_path_2 = path.dirname(path.realpath(__file__)) + "/telegram-bot-group2.conf"
+        self.__dispatcher = TelegramDispatcher()
 
     def send_message_to_group_1(self, message: str):
         try:
-            telegram_send.send(messages=[message], conf=self.__conf_path_1, disable_web_page_preview=True, parse_mode="html")
+            self.__dispatcher.send(self.__conf_path_1, message)
         except Exception as e:
             logging.exception(repr(e))
 
     def send_message_to_group_2(self, message: str):
         try:
-            telegram_send.send(messages=[message], conf=self.__conf_path_2, disable_web_page_preview=True, parse_mode="html")
+            self.__dispatcher.send(self.__conf_path_2, message)
         except Exception as e:
-            logging.exception(repr(e))
\ No newline at end of file
+            logging.exception(repr(e))
+
+    def summary(self, title: str):
+        """Context manager: los mensajes enviados dentro del bloque (en este hilo) llegan en un único mensaje por grupo"""
+        return self.__dispatcher.summary(title)
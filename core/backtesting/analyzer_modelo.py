@@ -14,6 +14,9 @@ import logging
 from datetime import datetime
 from typing import List
 
+import numpy as np
+
+from core.candles.candle_series import CandleSeries
 from core.candles.candlestick import Candlestick
 from core.market.technical_indicators import TechnicalIndicators
 from core.candles.binance_client import BinanceClient
@@ -78,6 +81,13 @@ class AnalyzerModelo:
         self.__technical_indicators.generate_average_true_range(candles)
 
 
+    def precondition_mask(self, series: CandleSeries) -> np.ndarray:
+        """Velas en las que analyze() abre orden siendo la vela actual: la anterior con 4 veces el volumen de la previa"""
+
+        mask = np.zeros(len(series), dtype=bool)
+        mask[2:] = series.volume[1:-1] > 4 * series.volume[:-2]
+        return mask
+
     def analyze(self, candles: List[Candlestick]) -> MobyOrder:
         """Analiza una moneda para buscar entradas"""
 
@@ -16,24 +16,29 @@ import pickle
 from multiprocessing import Pool, cpu_count
 from typing import List, Dict
 from datetime import datetime
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
 
 from core.backtesting.backtest_result import BacktestResult
 from core.backtesting.analyzer_modelo import AnalyzerModelo
+from core.backtesting.intrabar_resolver import IntrabarResolver
+from core.backtesting.robustness import robustness, RobustnessResult
 from core.candles.binance_client import BinanceClient
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
 from core.candles.candlestick import Candlestick
 from core.order.binance_order import BinanceOrder
-from core.order.moby_order import MobyOrder, OrderPosition, PositionCloseReason, OrderMode
+from core.order.exit_rules import update_trailing_stop, check_exit
+from core.order.moby_order import MobyOrder, OrderPosition, OrderMode
 from core.order.order_simulator import OrderSimulator
 from core.utils.utils import percentage_to_str, datetime_utc_to_madrid
 
 
 # Reutilizamos velas cargadas en ram entre instancias de la clase Backtesting() en los compare_backtests()
 all_candles: List[Candlestick] = None
+all_candles_series: CandleSeries = None
 
 # Reutilizamos el indice cargado en ram entre monedas de la misma instancia y entre instancias de la clase Backtesting()
 btc_index: List[Candlestick] = None
+btc_index_series: CandleSeries = None
 
 
 class Backtesting:
@@ -54,10 +59,16 @@ class Backtesting:
         12: "Diciembre",
     }
 
-    def __init__(self):
-        """Default constructor"""
+    def __init__(self, intrabar_interval: str = None):
+        """Default constructor
+        Args:
+            intrabar_interval: Si se indica, las velas en las que saltan a la vez stop y take profit se resuelven con
+                velas de este intervalo (Ej: "1m" en un backtest de 5m), descargadas solo para esas velas
+        """
         self.__start_datetime = datetime.now()
         self.__result_per_coin: Dict[str, BacktestResult] = dict()
+        self.__intrabar_interval = intrabar_interval
+        self.__intrabar_resolver = IntrabarResolver(intrabar_interval) if intrabar_interval else None
 
         self.__moby_order: MobyOrder = None
         self.__previous_moby_order: MobyOrder = None
@@ -84,17 +95,18 @@ class Backtesting:
             for coin in coins_to_analyze:
                 self.__backtest_single_coin(analyzer, start_time, coin)
         else:
-            analyzer = Backtesting.__clean_analyzer_for_multiprocessing(analyzer)
+            analyzer = Backtesting.clean_analyzer_for_multiprocessing(analyzer)
             with Pool(processes) as p:
-                results = p.starmap(Backtesting.thread_backtest_single_coin, [(analyzer, start_time, coin) for coin in coins_to_analyze])
+                results = p.starmap(Backtesting.thread_backtest_single_coin,
+                                    [(analyzer, start_time, coin, self.__intrabar_interval) for coin in coins_to_analyze])
             for result_per_coin in results:
                 self.__result_per_coin.update(result_per_coin)
 
         self.__write_backtest_results(start_time, analyzer.interval, analyzer.order_label, full_report=True)
 
     @staticmethod
-    def thread_backtest_single_coin(analyzer, start_time, coin) -> Dict[str, BacktestResult]:
-        coin_backtest = Backtesting()
+    def thread_backtest_single_coin(analyzer, start_time, coin, intrabar_interval=None) -> Dict[str, BacktestResult]:
+        coin_backtest = Backtesting(intrabar_interval)
         coin_backtest.__backtest_single_coin(analyzer, start_time, coin)
         return coin_backtest.__result_per_coin
 
@@ -104,7 +116,9 @@ class Backtesting:
         print("Backtest:", coin)
 
         global all_candles
+        global all_candles_series
         global btc_index
+        global btc_index_series
 
         analyze_args = inspect.getfullargspec(analyzer.analyze).args
         use_btc_index = "external_index_candles" in analyze_args
@@ -114,13 +128,29 @@ class Backtesting:
             print("Reutilizando velas")
         else:
             all_candles = self.get_all_candles_from_start_time(coin, analyzer.interval, start_time)
-            if hasattr(analyzer, "prepare_candles"):
-                print("Preparando velas")
-                analyzer.prepare_candles(all_candles)
-                print("Velas preparadas")
+            all_candles_series = None
+
+        # Columnas de las velas: para las mascaras de precondicion y las vistas numpy de las ventanas
+        if all_candles_series is None:
+            all_candles_series = CandleSeries.from_candles(coin, all_candles)
+
+        # Cada analyzer prepara sus indicadores aunque se reutilicen las velas. Los que ya haya calculado otro
+        # analyzer sobre las mismas velas salen de la IndicatorCache
+        if hasattr(analyzer, "prepare_candles"):
+            print("Preparando velas")
+            analyzer.prepare_candles(all_candles)
+            print("Velas preparadas")
+
+        # Velas en las que el analyzer puede dar entrada (mascara de patrones sobre toda la serie): el resto se salta
+        precondition_mask = None
+        if hasattr(analyzer, "precondition_mask"):
+            precondition_mask = analyzer.precondition_mask(all_candles_series)
+            print("Velas candidatas:", int(precondition_mask[analyzer.candle_index_to_start_backtest - 1:-1].sum()),
+                  "de", len(all_candles) - analyzer.candle_index_to_start_backtest)
 
         if not btc_index and use_btc_index:
             btc_index = self.get_all_candles_from_start_time("BTCUSDT", analyzer.interval, start_time)
+            btc_index_series = CandleSeries.from_candles("BTCUSDT", btc_index)
             print("External Index BTC: " + str(len(btc_index)))
 
         print()
@@ -137,11 +167,16 @@ class Backtesting:
             #     continue
 
             if self.__moby_order is None:
-                current_candles = all_candles[i - analyzer.num_candles_to_iterate:i]
+                if precondition_mask is not None and not precondition_mask[i - 1]:
+                    continue
+
+                # Ventanas sin copia de la lista completa (se comportan como all_candles[i - n:i])
+                current_candles = CandleWindow(all_candles, all_candles_series, i - analyzer.num_candles_to_iterate, i)
 
                 # Llama a analyze() con los parametros que necesite
                 if use_btc_index:
-                    external_index_candles = btc_index[i - analyzer.num_candles_to_iterate:i]
+                    external_index_candles = CandleWindow(btc_index, btc_index_series,
+                                                          i - analyzer.num_candles_to_iterate, i)
                     if use_previous_moby_order:
                         moby_order = analyzer.analyze(current_candles, external_index_candles=external_index_candles, previous_moby_order=self.__previous_moby_order)
                     else:
@@ -158,6 +193,11 @@ class Backtesting:
 
         if not reuse_candles:
             all_candles = None
+            all_candles_series = None
+
+        if self.__intrabar_resolver is not None:
+            self.__intrabar_resolver.flush()
+            print("Velas ambiguas:", self.__intrabar_resolver.get_stats())
 
         self.__write_backtest_results(start_time, analyzer.interval, analyzer.order_label, full_report=False)
 
@@ -173,14 +213,20 @@ class Backtesting:
         return all_results
 
     def __open_order(self, moby_order: MobyOrder, current_candle: Candlestick):
+        """Abre la orden en el backtest"""
+
+        self.__reset_opened_position_variables()
+        self.__trailing_stop_price = Backtesting.prepare_order(moby_order, current_candle)
+        self.__moby_order = moby_order
+
+    @staticmethod
+    def prepare_order(moby_order: MobyOrder, current_candle: Candlestick) -> float:
         """ ¡¡¡WARNING!!! Modifica la moby_order por referencia
         Añade valores a la moby_order (Ej: si tenemos trailing_stop_activation_price, lo traduce a
         trailing_stop_activation_percent, tambien transforma nos None en float imposibles, etc)
-        para facilitarle el trabajo al simulador.
+        para facilitarle el trabajo al simulador. Devuelve el trailing stop price inicial
         """
 
-        self.__reset_opened_position_variables()
-
         moby_order.order_mode = OrderMode.Backtest
         moby_order.open_time = current_candle.close_time
         moby_order.open_price = current_candle.close_price
@@ -198,10 +244,10 @@ class Backtesting:
 
         # Comprobación parametros
         if moby_order.position == OrderPosition.Long:
-            self.__trailing_stop_price = 0
+            trailing_stop_price = 0
             if not moby_order.trailing_stop_activation_percent:
                 # Activamos directamente el trailing stop si el percentage es None o cero
-                self.__trailing_stop_price = moby_order.order_price - trailling_stop_inc_price
+                trailing_stop_price = moby_order.order_price - trailling_stop_inc_price
 
             if moby_order.stop_loss is None:
                 moby_order.stop_loss = 0
@@ -216,10 +262,10 @@ class Backtesting:
                                 + str(moby_order.take_profit_price) + " Price: " + str(moby_order.order_price))
 
         else:
-            self.__trailing_stop_price = 999999999
+            trailing_stop_price = 999999999
             if not moby_order.trailing_stop_activation_percent:
                 # Activamos directamente el trailing stop si el percentage es None o cero
-                self.__trailing_stop_price = moby_order.order_price + trailling_stop_inc_price
+                trailing_stop_price = moby_order.order_price + trailling_stop_inc_price
 
             if moby_order.stop_loss is None:
                 moby_order.stop_loss = 999999999
@@ -233,49 +279,40 @@ class Backtesting:
                 raise Exception("Simulator Error: El precio de take profit es inválido, saltaría de inmediado TakeProft: "
                                 + str(moby_order.take_profit_price) + " Price: " + str(moby_order.order_price))
 
-        self.__moby_order = moby_order
+        return trailing_stop_price
 
     def __track_opened_position(self, current_candle: Candlestick, previous_candle: Candlestick):
         """Comprueba ha saltado una orden de cierre, y actualiza el trailing stop price"""
 
-        trailling_stop_inc_price = self.__moby_order.order_price * self.__moby_order.trailing_stop / 100
-        trailling_stop_activation_inc_price = self.__moby_order.order_price * self.__moby_order.trailing_stop_activation_percent / 100
-
-        if self.__moby_order.position == OrderPosition.Long:
-            # Actualizar trailing stop price
-            trailing_stop_activation_price = self.__moby_order.order_price + trailling_stop_activation_inc_price
-            if previous_candle.high_price >= trailing_stop_activation_price and previous_candle.close_time > self.__moby_order.open_time:
-                new_trailling_stop_price = previous_candle.high_price - trailling_stop_inc_price
-                if new_trailling_stop_price > self.__trailing_stop_price:
-                    self.__trailing_stop_price = new_trailling_stop_price
-
-            # Comprobar si salta un cierre
-            trailing_stop_executed = current_candle.low_price <= self.__trailing_stop_price
-            stoploss_executed = current_candle.low_price <= self.__moby_order.stop_loss
-            take_profit_executed = current_candle.high_price >= self.__moby_order.take_profit_price
-
-        else:  # Short
-            # Actualizar trailing stop price
-            trailing_stop_activation_price = self.__moby_order.order_price - trailling_stop_activation_inc_price
-            if previous_candle.low_price <= trailing_stop_activation_price and previous_candle.close_time > self.__moby_order.open_time:
-                new_trailling_stop_price = previous_candle.low_price + trailling_stop_inc_price
-                if new_trailling_stop_price < self.__trailing_stop_price:
-                    self.__trailing_stop_price = new_trailling_stop_price
-
-            # Comprobar si salta un cierre
-            trailing_stop_executed = current_candle.high_price >= self.__trailing_stop_price
-            stoploss_executed = current_candle.high_price >= self.__moby_order.stop_loss
-            take_profit_executed = current_candle.low_price <= self.__moby_order.take_profit_price
-
-        if trailing_stop_executed:
-            self.__moby_order.close_price = self.__trailing_stop_price
-            self.__moby_order.close_reason = PositionCloseReason.TrailingStop
-        elif stoploss_executed:
-            self.__moby_order.close_price = self.__moby_order.stop_loss
-            self.__moby_order.close_reason = PositionCloseReason.Stoploss
-        elif take_profit_executed:
-            self.__moby_order.close_price = self.__moby_order.take_profit_price
-            self.__moby_order.close_reason = PositionCloseReason.TakeProfit
+        is_long = self.__moby_order.position == OrderPosition.Long
+
+        # Actualizar trailing stop price con la vela anterior, si ya es posterior a la apertura
+        if previous_candle.close_time > self.__moby_order.open_time:
+            self.__trailing_stop_price = update_trailing_stop(is_long,
+                                                              self.__moby_order.order_price,
+                                                              self.__moby_order.trailing_stop,
+                                                              self.__moby_order.trailing_stop_activation_percent,
+                                                              self.__trailing_stop_price,
+                                                              previous_candle.high_price,
+                                                              previous_candle.low_price)
+
+        # Comprobar si salta un cierre
+        if self.__intrabar_resolver is not None:
+            close_reason, close_price = self.__intrabar_resolver.resolve_exit(is_long,
+                                                                              self.__trailing_stop_price,
+                                                                              self.__moby_order.stop_loss,
+                                                                              self.__moby_order.take_profit_price,
+                                                                              current_candle)
+        else:
+            close_reason, close_price = check_exit(is_long,
+                                                   self.__trailing_stop_price,
+                                                   self.__moby_order.stop_loss,
+                                                   self.__moby_order.take_profit_price,
+                                                   current_candle.high_price,
+                                                   current_candle.low_price)
+        if close_reason is not None:
+            self.__moby_order.close_price = close_price
+            self.__moby_order.close_reason = close_reason
 
         if self.__moby_order.close_reason is not None:
             self.__moby_order.close_time = current_candle.close_time
@@ -495,6 +532,10 @@ class Backtesting:
             else:
                 short_profit.append(0)
 
+        # matplotlib solo se necesita para las graficas de backtesting
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as mtick
+
         plt.plot(x, total_profit, label="Total", color="blue")
         plt.plot(x, long_profit, label="Long", color="green")
         plt.plot(x, short_profit, label="Short", color="red")
@@ -524,6 +565,11 @@ class Backtesting:
         profit_podium = dict(sorted(backtesters_results.items(), key=lambda item: item[1].profit, reverse=True))
         drawdown_podium = dict(sorted(backtesters_results.items(), key=lambda item: item[1].drawdown.relative_dd, reverse=True))
 
+        # Peor caso razonable de cada variante: remuestreo por bloques de sus ordenes (mismas semillas para todas)
+        robustness_results: Dict[str, RobustnessResult] = {label: robustness(result.profit_np_array)
+                                                           for label, result in backtesters_results.items()}
+        robustness_podium = dict(sorted(robustness_results.items(), key=lambda item: item[1].profit_low, reverse=True))
+
         msg = "PODIUMS"
         if with_commissions:
             msg += " WITH COMMISIONS"
@@ -533,6 +579,8 @@ class Backtesting:
         msg += "PROFIT PODIUM:\n" + "\n".join([result.get_small_summary() + "\t" + label for label, result in profit_podium.items()])
         msg += "\n\n"
         msg += "DRAWDOWN PODIUM:\n" + "\n".join([result.get_small_summary() + "\t" + label for label, result in drawdown_podium.items()])
+        msg += "\n\n"
+        msg += "ROBUSTNESS PODIUM:\n" + "\n".join([result.get_small_summary() + "\t" + label for label, result in robustness_podium.items()])
 
         print()
         print()
@@ -616,7 +664,7 @@ class Backtesting:
         return all_candles
 
     @staticmethod
-    def compare_backtests(analyzers: list, start_time: datetime, processes: int = None):
+    def compare_backtests(analyzers: list, start_time: datetime, processes: int = None, intrabar_interval: str = None):
         """Realiza y compara backtests sobre varias hipotesis implementada en varios analyzer"""
 
         if len({analyzer.order_label for analyzer in analyzers}) != len(analyzers):
@@ -628,22 +676,24 @@ class Backtesting:
         if len({analyzer.interval for analyzer in analyzers}) != 1:
             raise Exception("Hay analyzers con diferentes interval")
 
-        backtesters: Dict[str, Backtesting] = {analyzer.order_label: Backtesting() for analyzer in analyzers}
+        backtesters: Dict[str, Backtesting] = {analyzer.order_label: Backtesting(intrabar_interval) for analyzer in analyzers}
 
         if processes is None:
             processes = cpu_count()
 
         if processes == 1:
             global all_candles
+            global all_candles_series
             for coin in coins_to_analyze:
                 for analyzer in analyzers:
                     backtesters[analyzer.order_label].__backtest_single_coin(analyzer, start_time, coin, True)
                 all_candles = None  # Liberamos recursos
+                all_candles_series = None
         else:
-            analyzers = [Backtesting.__clean_analyzer_for_multiprocessing(analyzer) for analyzer in analyzers]
+            analyzers = [Backtesting.clean_analyzer_for_multiprocessing(analyzer) for analyzer in analyzers]
             with Pool(processes) as p:
                 results = p.starmap(Backtesting.thread_backtest_single_coin_with_many_analyzers,
-                                    [(analyzers, start_time, coin) for coin in coins_to_analyze])
+                                    [(analyzers, start_time, coin, intrabar_interval) for coin in coins_to_analyze])
             for result_per_analyzer in results:
                 for order_label, result_per_coin in result_per_analyzer.items():
                     backtesters[order_label].__result_per_coin.update(result_per_coin)
@@ -655,20 +705,22 @@ class Backtesting:
         Backtesting.__write_podium(backtesters, True)
 
     @staticmethod
-    def thread_backtest_single_coin_with_many_analyzers(analyzers, start_time, coin) -> Dict[str, Dict[str, BacktestResult]]:
+    def thread_backtest_single_coin_with_many_analyzers(analyzers, start_time, coin, intrabar_interval=None) -> Dict[str, Dict[str, BacktestResult]]:
         all_result_per_coin = dict()
         for analyzer in analyzers:
-            coin_backtest = Backtesting()
+            coin_backtest = Backtesting(intrabar_interval)
             coin_backtest.__backtest_single_coin(analyzer, start_time, coin, reuse_candles=True)
             all_result_per_coin[analyzer.order_label] = coin_backtest.__result_per_coin
 
         global all_candles
+        global all_candles_series
         all_candles = None  # Liberamos recursos
+        all_candles_series = None
 
         return all_result_per_coin
 
     @staticmethod
-    def __clean_analyzer_for_multiprocessing(analyzer):
+    def clean_analyzer_for_multiprocessing(analyzer):
         """
         Quitamos OrderSimulator y BinanceOrder del analyzer,
         que no hacen falta en backtest e impiden el multiproceso
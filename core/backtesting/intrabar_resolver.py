@@ -0,0 +1,155 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Intrabar Resolver - Order of the exits hit inside one candle, from lower timeframe candles]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import os
+import pickle
+
+from typing import Dict, List
+
+from core.candles.binance_client import BinanceClient
+from core.candles.candlestick import Candlestick
+from core.candles.resampler import INTERVAL_MINUTES
+from core.order.exit_rules import check_exit
+from core.order.moby_order import PositionCloseReason
+from core.utils.utils import datetime_utc_to_unix_time
+
+
+class IntrabarResolver:
+    """Resuelve que salida salta primero cuando en una misma vela se tocan el lado del stop (trailing stop o stoploss)
+    y el take profit, que con solo high/low no se puede saber. Descarga bajo demanda las velas de interval de esas
+    velas ambiguas (una peticion por vela, cacheada en memoria y en disco), asi que la I/O extra es proporcional al
+    numero de velas ambiguas y no al del backtest"""
+
+    def __init__(self, interval: str = "1m", cache_dir: str = "cache"):
+        """Default constructor
+        Args:
+            interval: Intervalo de las subvelas
+            cache_dir: Directorio de la cache en disco (como el de get_all_candles_from_start_time)
+        """
+        self.__interval = interval
+        self.__cache_dir = cache_dir
+        self.__binance_client: BinanceClient = None
+
+        # Subvelas por symbol y open_time (ms) de la vela ambigua
+        self.__sub_candles: Dict[str, Dict[int, List[Candlestick]]] = dict()
+        self.__pending_save = set()
+
+        self.__ambiguous = 0
+        self.__unresolved = 0
+        self.__downloads = 0
+
+    def resolve_exit(self, is_long: bool, trailing_stop_price: float, stop_loss: float, take_profit_price: float,
+                     candle: Candlestick):
+        """Como check_exit, pero en el orden real dentro de la vela: de los stops, salta antes el mas cercano al
+        precio; entre stop y take profit, el que tocan antes las subvelas. Devuelve (PositionCloseReason, close_price)
+        de la salida que salta, o (None, None)"""
+
+        if is_long:
+            trailing_stop_executed = candle.low_price <= trailing_stop_price
+            stoploss_executed = candle.low_price <= stop_loss
+            take_profit_executed = candle.high_price >= take_profit_price
+            trailing_stop_first = trailing_stop_price >= stop_loss
+        else:
+            trailing_stop_executed = candle.high_price >= trailing_stop_price
+            stoploss_executed = candle.high_price >= stop_loss
+            take_profit_executed = candle.low_price <= take_profit_price
+            trailing_stop_first = trailing_stop_price <= stop_loss
+
+        if not trailing_stop_executed and not stoploss_executed:
+            return check_exit(is_long, trailing_stop_price, stop_loss, take_profit_price,
+                              candle.high_price, candle.low_price)
+
+        if trailing_stop_executed and (not stoploss_executed or trailing_stop_first):
+            stop_exit = PositionCloseReason.TrailingStop, trailing_stop_price
+        else:
+            stop_exit = PositionCloseReason.Stoploss, stop_loss
+
+        if take_profit_executed:
+            self.__ambiguous += 1
+            if self.__take_profit_first(is_long, stop_exit[1], take_profit_price, candle):
+                return PositionCloseReason.TakeProfit, take_profit_price
+
+        return stop_exit
+
+    def __take_profit_first(self, is_long: bool, stop_price: float, take_profit_price: float,
+                            candle: Candlestick) -> bool:
+        """True si las subvelas tocan el take profit antes que el stop. Si una misma subvela toca los dos (o ninguna
+        toca ninguno), se mantiene el orden fijo del Backtesting: primero el stop"""
+
+        for sub_candle in self.get_sub_candles(candle):
+            if is_long:
+                stop_executed = sub_candle.low_price <= stop_price
+                take_profit_executed = sub_candle.high_price >= take_profit_price
+            else:
+                stop_executed = sub_candle.high_price >= stop_price
+                take_profit_executed = sub_candle.low_price <= take_profit_price
+
+            if stop_executed and take_profit_executed:
+                break
+            if stop_executed:
+                return False
+            if take_profit_executed:
+                return True
+
+        self.__unresolved += 1
+        return False
+
+    def get_sub_candles(self, candle: Candlestick) -> List[Candlestick]:
+        """Velas de interval que forman la vela, de la cache o de Binance"""
+
+        ticker_sub_candles = self.__load_cache(candle.ticker)
+        open_time = datetime_utc_to_unix_time(candle.open_time, True)
+
+        sub_candles = ticker_sub_candles.get(open_time)
+        if sub_candles is None:
+            if self.__binance_client is None:
+                self.__binance_client = BinanceClient()
+
+            candle_minutes = round((candle.close_time - candle.open_time).total_seconds() / 60)
+            sub_candles = self.__binance_client.get_last_candlesticks(
+                coin=candle.ticker, start_time_utc=candle.open_time,
+                num_candlesticks=max(1, candle_minutes // INTERVAL_MINUTES[self.__interval]),
+                interval=self.__interval, futures_info=True)
+            sub_candles = [sub_candle for sub_candle in sub_candles if sub_candle.open_time < candle.close_time]
+
+            self.__downloads += 1
+            ticker_sub_candles[open_time] = sub_candles
+            self.__pending_save.add(candle.ticker)
+
+        return sub_candles
+
+    def __get_cache_filename(self, ticker: str) -> str:
+        return os.path.join(self.__cache_dir, "intrabar_{0}_{1}".format(ticker, self.__interval))
+
+    def __load_cache(self, ticker: str) -> Dict[int, List[Candlestick]]:
+        ticker_sub_candles = self.__sub_candles.get(ticker)
+        if ticker_sub_candles is None:
+            ticker_sub_candles = dict()
+            filename = self.__get_cache_filename(ticker)
+            if os.path.isfile(filename):
+                with open(filename, "rb") as f:
+                    ticker_sub_candles = pickle.load(f)
+            self.__sub_candles[ticker] = ticker_sub_candles
+        return ticker_sub_candles
+
+    def flush(self):
+        """Guarda en disco las subvelas descargadas desde el ultimo flush"""
+
+        for ticker in self.__pending_save:
+            filename = self.__get_cache_filename(ticker)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb") as f:
+                pickle.dump(self.__sub_candles[ticker], f)
+        self.__pending_save.clear()
+
+    def get_stats(self) -> dict:
+        """Velas ambiguas, las que no se han podido resolver con las subvelas, y descargas"""
+        return {"ambiguous": self.__ambiguous, "unresolved": self.__unresolved, "downloads": self.__downloads}
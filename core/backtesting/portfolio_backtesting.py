@@ -0,0 +1,291 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Portfolio Backtesting - Event-driven backtest of all the symbols at once with shared capital]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import heapq
+import inspect
+
+from datetime import datetime
+from typing import List, Dict
+
+import numpy as np
+
+from core.backtesting.backtest_result import BacktestResult
+from core.backtesting.backtesting import Backtesting
+from core.backtesting.intrabar_resolver import IntrabarResolver
+from core.backtesting.portfolio_state import PortfolioState
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import LazyCandles
+from core.order.exit_rules import find_order_exit
+from core.order.moby_order import MobyOrder
+from core.utils.utils import percentage_to_str, datetime_utc_to_madrid
+
+
+class PortfolioBacktesting:
+    """Backtest de cartera: recorre las velas de todas las monedas en orden temporal (entradas intercaladas por tiempo
+    de cierre, salidas en un heap), con capital, margen, apalancamiento y posiciones abiertas compartidos entre
+    monedas, como en una cuenta real. El seguimiento de cada posicion se resuelve vectorizado sobre sus velas"""
+
+    def __init__(self, initial_capital: float = 1000, max_opened_positions: int = 10, max_leverage: int = 20,
+                 max_exposure: float = None, default_quantity: float = 10, intrabar_interval: str = None):
+        """Default constructor
+        Args:
+            initial_capital: USDT iniciales de la cuenta
+            max_opened_positions: Maximo de posiciones abiertas a la vez
+            max_leverage: Apalancamiento maximo por orden (las ordenes con mas se abren con este)
+            max_exposure: Maximo nocional abierto, en veces el wallet balance (None: sin limite)
+            default_quantity: Margen en USDT de las ordenes que no indican quantity
+            intrabar_interval: Intervalo con el que resolver las velas en las que saltan a la vez stop y take profit
+        """
+        self.__initial_capital = initial_capital
+        self.__max_opened_positions = max_opened_positions
+        self.__max_leverage = max_leverage
+        self.__max_exposure = max_exposure
+        self.__default_quantity = default_quantity
+        self.__intrabar_resolver = IntrabarResolver(intrabar_interval) if intrabar_interval else None
+
+        self.__state: PortfolioState = None
+        self.__result_per_coin: Dict[str, BacktestResult] = dict()
+        self.__equity_curve: List[tuple] = list()
+        self.__rejected: Dict[str, int] = dict()
+        self.__leverage_capped = 0
+        self.__max_concurrent_positions = 0
+
+    def backtest(self, analyzer, start_time: datetime, coins: List[str] = None) -> PortfolioState:
+        """Realiza un backtest de cartera sobre la hipotesis implementada en un analyzer"""
+
+        coins = analyzer.coins_to_analyze.copy() if coins is None else coins
+
+        analyze_args = inspect.getfullargspec(analyzer.analyze).args
+        use_btc_index = "external_index_candles" in analyze_args
+        use_previous_moby_order = "previous_moby_order" in analyze_args
+        use_portfolio_state = "portfolio_state" in analyze_args
+
+        self.__state = PortfolioState(self.__initial_capital)
+        self.__result_per_coin = {coin: BacktestResult() for coin in coins}
+        self.__equity_curve = list()
+        self.__rejected = dict()
+        self.__leverage_capped = 0
+        self.__max_concurrent_positions = 0
+
+        # 1. Velas de todas las monedas en columnas (para mascaras y salidas). Como Candlestick (para analyze) solo
+        # se crean las de las ventanas de las velas candidatas
+        loader = Backtesting()
+        all_candles: List[LazyCandles] = list()
+        all_series: List[CandleSeries] = list()
+        event_times = list()
+        event_coins = list()
+        event_candles = list()
+
+        for coin_index, coin in enumerate(coins):
+            print("Cargando:", coin)
+            candles = loader.get_all_candles_from_start_time(coin, analyzer.interval, start_time)
+            series = CandleSeries.from_candles(coin, candles)
+
+            # Los indicadores se calculan sobre todas las velas; se conservan solo sus columnas
+            frame = None
+            if hasattr(analyzer, "prepare_candles"):
+                analyzer.prepare_candles(candles)
+                frame = candles[0].indicator_frame if candles else None
+            all_candles.append(LazyCandles(series, frame))
+            all_series.append(series)
+
+            # Velas en las que se puede entrar (la ultima de la ventana de analyze): la ultima vela no se evalua,
+            # como en el Backtesting
+            candidates = np.arange(analyzer.candle_index_to_start_backtest - 1, len(series) - 1)
+            if hasattr(analyzer, "precondition_mask") and len(candidates) > 0:
+                candidates = candidates[analyzer.precondition_mask(series)[candidates]]
+
+            event_times.append(series.close_time[candidates])
+            event_coins.append(np.full(len(candidates), coin_index, dtype=np.int64))
+            event_candles.append(candidates)
+
+        btc_index = None
+        if use_btc_index:
+            btc_index = LazyCandles(CandleSeries.from_candles(
+                "BTCUSDT", loader.get_all_candles_from_start_time("BTCUSDT", analyzer.interval, start_time)))
+
+        # 2. Entradas de todas las monedas intercaladas por tiempo (a igualdad, por moneda)
+        event_times = np.concatenate(event_times) if event_times else np.zeros(0, dtype=np.int64)
+        event_coins = np.concatenate(event_coins) if event_coins else np.zeros(0, dtype=np.int64)
+        event_candles = np.concatenate(event_candles) if event_candles else np.zeros(0, dtype=np.int64)
+        events = np.lexsort((event_candles, event_coins, event_times))
+        print("Velas candidatas:", len(events), "de", sum(len(series) for series in all_series))
+        print()
+
+        # Salidas pendientes: (tiempo de cierre, moneda, vela de salida, orden)
+        exits = list()
+        previous_moby_orders: List[MobyOrder] = [None] * len(coins)
+        next_entry_candle = [0] * len(coins)
+
+        for event_time, coin_index, candle_index in zip(event_times[events].tolist(), event_coins[events].tolist(),
+                                                        event_candles[events].tolist()):
+
+            # Las salidas se procesan antes que las entradas del mismo instante (liberan margen)
+            while exits and exits[0][0] <= event_time:
+                _, exit_coin_index, _, moby_order = heapq.heappop(exits)
+                self.__close_order(moby_order)
+                previous_moby_orders[exit_coin_index] = moby_order
+
+            if candle_index < next_entry_candle[coin_index]:
+                continue
+
+            # Ventana de analyze: se comporta como candles[i - n:i] con i = candle_index + 1
+            stop = candle_index + 1
+            current_candles = all_candles[coin_index].window(stop - analyzer.num_candles_to_iterate, stop)
+            self.__state.current_time = current_candles[-1].close_time
+
+            # Llama a analyze() con los parametros que necesite
+            kwargs = dict()
+            if use_btc_index:
+                kwargs["external_index_candles"] = btc_index.window(stop - analyzer.num_candles_to_iterate, stop)
+            if use_previous_moby_order:
+                kwargs["previous_moby_order"] = previous_moby_orders[coin_index]
+            if use_portfolio_state:
+                kwargs["portfolio_state"] = self.__state
+            moby_order = analyzer.analyze(current_candles, **kwargs)
+
+            if moby_order is None or not self.__accept_order(moby_order):
+                continue
+
+            exit_candle_index = self.__open_order(moby_order, all_candles[coin_index], all_series[coin_index],
+                                                  candle_index)
+            if exit_candle_index is None:
+                # Sin salida hasta el final del backtest: la moneda no vuelve a entrar
+                next_entry_candle[coin_index] = len(all_series[coin_index])
+            else:
+                next_entry_candle[coin_index] = exit_candle_index + 1
+                heapq.heappush(exits, (int(all_series[coin_index].close_time[exit_candle_index]), coin_index,
+                                       exit_candle_index, moby_order))
+
+        while exits:
+            _, exit_coin_index, _, moby_order = heapq.heappop(exits)
+            self.__close_order(moby_order)
+
+        if self.__intrabar_resolver is not None:
+            self.__intrabar_resolver.flush()
+            print("Velas ambiguas:", self.__intrabar_resolver.get_stats())
+
+        self.__write_backtest_results(analyzer.order_label)
+        return self.__state
+
+    def __accept_order(self, moby_order: MobyOrder) -> bool:
+        """Aplica los limites de la cuenta a una orden nueva. ¡¡¡WARNING!!! Puede modificar la orden (quantity y
+        leverage)"""
+
+        quantity = self.__default_quantity if moby_order.quantity is None else moby_order.quantity
+        leverage = min(moby_order.leverage, self.__max_leverage)
+
+        if len(self.__state.opened_positions) >= self.__max_opened_positions:
+            return self.__reject("Maximo de posiciones abiertas")
+
+        if quantity > self.__state.available_balance:
+            return self.__reject("Margen insuficiente")
+
+        if self.__max_exposure is not None and \
+                self.__state.exposure + quantity * leverage > self.__state.wallet_balance * self.__max_exposure:
+            return self.__reject("Exposicion maxima")
+
+        if leverage < moby_order.leverage:
+            self.__leverage_capped += 1
+        moby_order.quantity = quantity
+        moby_order.leverage = leverage
+        return True
+
+    def __reject(self, reason: str) -> bool:
+        self.__rejected[reason] = self.__rejected.get(reason, 0) + 1
+        return False
+
+    def __open_order(self, moby_order: MobyOrder, candles: LazyCandles, series: CandleSeries,
+                     candle_index: int) -> int:
+        """Abre la orden al cierre de la vela candle_index y busca su salida en las velas siguientes, por bloques
+        crecientes. Devuelve la vela de salida, o None si no sale antes del final"""
+
+        trailing_stop_price = Backtesting.prepare_order(moby_order, candles[candle_index])
+
+        self.__state.opened_positions.append(moby_order)
+        self.__state.available_balance -= moby_order.quantity
+        self.__max_concurrent_positions = max(self.__max_concurrent_positions, len(self.__state.opened_positions))
+
+        # La ultima vela no se evalua, como en el Backtesting
+        return find_order_exit(moby_order, trailing_stop_price, candles, series.high_price, series.low_price,
+                               candle_index + 1, len(series) - 1, self.__intrabar_resolver)
+
+    def __close_order(self, moby_order: MobyOrder):
+        """Cierra la orden en la cuenta: libera su margen y aplica su beneficio. Las ordenes sin salida se quedan
+        abiertas"""
+
+        if moby_order.close_reason is None:
+            return
+
+        moby_order.update_metrics()
+
+        self.__state.opened_positions.remove(moby_order)
+        self.__state.closed_positions.append(moby_order)
+        self.__state.wallet_balance += moby_order.profit_usdt
+        self.__state.margin_balance = self.__state.wallet_balance
+        self.__state.available_balance += moby_order.quantity + moby_order.profit_usdt
+        self.__equity_curve.append((moby_order.close_time, self.__state.wallet_balance))
+
+        self.__result_per_coin[moby_order.ticker].orders.append(moby_order)
+
+    def get_result(self, with_commissions=False) -> BacktestResult:
+        """Result acumulado de todas las monedas, ordenando las ordenes por fecha"""
+        all_results = BacktestResult()
+        for result in self.__result_per_coin.values():
+            all_results.orders += result.orders
+        if with_commissions:
+            all_results = all_results.copy_with_commissions()
+        all_results.orders = sorted(all_results.orders, key=lambda order: order.close_time, reverse=False)
+        all_results.init_metrics()
+        return all_results
+
+    def get_equity_drawdown(self) -> float:
+        """Maxima caida del wallet balance desde un maximo, en tanto por uno"""
+
+        if not self.__equity_curve:
+            return 0.0
+        equity = np.array([self.__initial_capital] + [balance for _, balance in self.__equity_curve])
+        peaks = np.maximum.accumulate(equity)
+        return float(((peaks - equity) / peaks).max())
+
+    def __write_backtest_results(self, order_label: str):
+        """Muestra los resultados del backtest de cartera"""
+
+        result = self.get_result()
+
+        msg = ""
+        msg += "---------------------------------------------\n"
+        msg += "Backtest de cartera " + order_label + "\n"
+        msg += "Capital inicial: {0:.2f} USDT\tFinal: {1:.2f} USDT\tBeneficio: {2}\n".format(
+            self.__initial_capital, self.__state.wallet_balance,
+            percentage_to_str(self.__state.wallet_balance / self.__initial_capital - 1))
+        msg += "DD del capital: {0}\tMaximo de posiciones abiertas: {1}\tSin cerrar: {2}\n".format(
+            percentage_to_str(self.get_equity_drawdown(), plus_symbol=False), self.__max_concurrent_positions,
+            len(self.__state.opened_positions))
+        msg += "Ordenes rechazadas: {0}\tApalancamiento recortado: {1}\n".format(
+            sum(self.__rejected.values()), self.__leverage_capped)
+        for reason, count in self.__rejected.items():
+            msg += "\t" + reason + ": " + str(count) + "\n"
+        msg += result.get_full_summary() + "\n"
+        if result.orders:
+            msg += "Primera orden: {0}\tUltima orden: {1}\n".format(
+                str(datetime_utc_to_madrid(result.orders[0].open_time)),
+                str(datetime_utc_to_madrid(result.orders[-1].close_time)))
+        msg += "---------------------------------------------\n"
+        print(msg)
+
+
+# Local Testing
+if __name__ == "__main__":
+    from core.market.analyzerJ3_1m import AnalyzerJ3_1m
+
+    portfolio_backtesting = PortfolioBacktesting(initial_capital=1000, max_opened_positions=10, max_leverage=20)
+    portfolio_backtesting.backtest(AnalyzerJ3_1m(), datetime(2021, 11, 30))
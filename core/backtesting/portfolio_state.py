@@ -0,0 +1,39 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Portfolio State - Global state of the simulated account in a portfolio backtest]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+from datetime import datetime
+from typing import List
+
+from core.order.moby_order import MobyOrder
+
+
+class PortfolioState:
+    """Estado global de la cuenta simulada, con los mismos campos que Account (AccountManager) para que los analyzers
+    lo usen igual que en real. Los analyzers lo reciben en analyze(..., portfolio_state=...) y no deben modificarlo"""
+
+    def __init__(self, initial_capital: float):
+        """Default constructor"""
+        self.initial_capital: float = initial_capital
+        self.wallet_balance: float = initial_capital
+        self.margin_balance: float = initial_capital
+        self.available_balance: float = initial_capital
+        self.opened_positions: List[MobyOrder] = list()
+        self.closed_positions: List[MobyOrder] = list()
+        self.current_time: datetime = None
+
+    @property
+    def used_margin(self) -> float:
+        return sum(order.quantity for order in self.opened_positions)
+
+    @property
+    def exposure(self) -> float:
+        """Nocional de las posiciones abiertas (margen por apalancamiento)"""
+        return sum(order.quantity * order.leverage for order in self.opened_positions)
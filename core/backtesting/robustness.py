@@ -0,0 +1,149 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Robustness - Monte Carlo resampling of the orders of a backtest: confidence intervals and risk of ruin]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from core.utils.utils import percentage_to_str
+
+BOOTSTRAP = "bootstrap"
+BLOCK_BOOTSTRAP = "block_bootstrap"
+SHUFFLE = "shuffle"
+
+
+class RobustnessResult:
+    """Distribucion del profit y del drawdown relativo de los remuestreos de un backtest. Mismas unidades que
+    BacktestResult (suma de profit_percent de las ordenes)"""
+
+    def __init__(self, method: str, resamples: int, num_orders: int, profits: np.ndarray, relative_dds: np.ndarray,
+                 confidence: float, ruin_dd: float):
+        self.method: str = method
+        self.resamples: int = resamples
+        self.num_orders: int = num_orders
+        self.confidence: float = confidence
+        self.ruin_dd: float = ruin_dd
+
+        low = 50 * (1 - confidence)
+        high = 100 - low
+        self.profit_low, self.profit_median, self.profit_high = np.percentile(profits, [low, 50, high]).tolist() \
+            if len(profits) else (0.0, 0.0, 0.0)
+        self.relative_dd_low, self.relative_dd_median, self.relative_dd_high = \
+            np.percentile(relative_dds, [low, 50, high]).tolist() if len(relative_dds) else (0.0, 0.0, 0.0)
+
+        # Probabilidad de acabar en perdidas y de ruina: drawdown relativo peor que ruin_dd
+        self.loss_probability: float = float((profits <= 0).mean()) if len(profits) else 0.0
+        self.ruin_probability: float = float((relative_dds <= -ruin_dd).mean()) if len(relative_dds) else 0.0
+
+    def get_small_summary(self) -> str:
+        return ("Prof IC{0}%: [{1}, {2}]\tDDRelativo IC{0}%: [{3}, {4}]\tPérdidas: {5:<7}\tRuina(DD {6}): {7:<7}".format(
+            round(self.confidence * 100),
+            percentage_to_str(self.profit_low),
+            percentage_to_str(self.profit_high),
+            percentage_to_str(self.relative_dd_low, False),
+            percentage_to_str(self.relative_dd_high, False),
+            percentage_to_str(self.loss_probability, False),
+            percentage_to_str(-self.ruin_dd, False),
+            percentage_to_str(self.ruin_probability, False)
+        )
+        )
+
+
+def resample_indexes(num_orders: int, rows: int, method: str, block_size: int,
+                     rng: np.random.Generator) -> np.ndarray:
+    """Matriz (rows x num_orders) de posiciones de ordenes: cada fila es una secuencia remuestreada"""
+
+    if method == BOOTSTRAP:
+        return rng.integers(0, num_orders, size=(rows, num_orders))
+
+    if method == BLOCK_BOOTSTRAP:
+        # Bootstrap por bloques circulares: conserva las rachas de hasta block_size ordenes seguidas
+        num_blocks = -(-num_orders // block_size)
+        starts = rng.integers(0, num_orders, size=(rows, num_blocks, 1))
+        indexes = (starts + np.arange(block_size)) % num_orders
+        return indexes.reshape(rows, num_blocks * block_size)[:, :num_orders]
+
+    if method == SHUFFLE:
+        # Mismas ordenes en otro orden: el profit final no cambia, solo el camino (drawdown)
+        return np.array([rng.permutation(num_orders) for _ in range(rows)])
+
+    raise Exception("Metodo de remuestreo desconocido: " + str(method))
+
+
+def path_metrics(paths: np.ndarray):
+    """Profit final y drawdown relativo (como BacktestResult.get_drawdown) de cada fila de profits por orden.
+    ¡¡¡WARNING!!! Reutiliza paths para los calculos"""
+
+    accumulated = np.cumsum(paths, axis=1, out=paths)
+    peaks = np.maximum.accumulate(accumulated, axis=1)
+    np.maximum(peaks, 0, out=peaks)
+    np.subtract(accumulated, peaks, out=peaks)
+    return accumulated[:, -1].copy(), peaks.min(axis=1)
+
+
+def _resample_metrics(profits: np.ndarray, method: str, resamples: int, block_size: int, seed,
+                      chunk_size: int = 250000):
+    """Profit final y drawdown relativo de resamples remuestreos, por bloques de filas de chunk_size elementos como
+    maximo (caben en cache)"""
+
+    rng = np.random.default_rng(seed)
+    rows_per_chunk = max(1, chunk_size // len(profits))
+    final_profits = np.empty(resamples)
+    relative_dds = np.empty(resamples)
+
+    for start in range(0, resamples, rows_per_chunk):
+        rows = min(rows_per_chunk, resamples - start)
+        indexes = resample_indexes(len(profits), rows, method, block_size, rng)
+        final_profits[start:start + rows], relative_dds[start:start + rows] = path_metrics(profits[indexes])
+
+    return final_profits, relative_dds
+
+
+def robustness(profits: np.ndarray, method: str = BLOCK_BOOTSTRAP, resamples: int = 10000, block_size: int = None,
+               confidence: float = 0.9, ruin_dd: float = 0.5, seed: int = 0, processes: int = None,
+               task_resamples: int = 500) -> RobustnessResult:
+    """Remuestrea resamples veces la secuencia de profits de las ordenes (ordenadas por cierre). Los remuestreos se
+    reparten en tareas de task_resamples, en paralelo, cada una con su semilla derivada de seed: el resultado no
+    depende del numero de procesos
+    Args:
+        profits: profit_percent de cada orden (Ej: BacktestResult.profit_np_array)
+        method: BOOTSTRAP, BLOCK_BOOTSTRAP o SHUFFLE
+        block_size: Ordenes por bloque en BLOCK_BOOTSTRAP (por defecto, raiz cubica del numero de ordenes)
+        confidence: Nivel de los intervalos de confianza
+        ruin_dd: Drawdown relativo (en positivo) a partir del cual se considera ruina
+        seed: Semilla, fija por defecto para comparar variantes con los mismos remuestreos
+    """
+
+    profits = np.asarray(profits, dtype=np.float64)
+    num_orders = len(profits)
+    if num_orders == 0:
+        return RobustnessResult(method, resamples, 0, np.zeros(0), np.zeros(0), confidence, ruin_dd)
+
+    if block_size is None:
+        block_size = max(1, int(round(num_orders ** (1 / 3))))
+
+    task_sizes = [min(task_resamples, resamples - start) for start in range(0, resamples, task_resamples)]
+    tasks = [(profits, method, task_size, block_size, task_seed)
+             for task_size, task_seed in zip(task_sizes, np.random.SeedSequence(seed).spawn(len(task_sizes)))]
+
+    if processes is None:
+        processes = cpu_count()
+
+    # Con pocas ordenes no compensa arrancar procesos
+    if processes == 1 or len(tasks) == 1 or num_orders * resamples < 10000000:
+        results = [_resample_metrics(*task) for task in tasks]
+    else:
+        with Pool(min(processes, len(tasks))) as p:
+            results = p.starmap(_resample_metrics, tasks)
+
+    final_profits = np.concatenate([task_profits for task_profits, _ in results])
+    relative_dds = np.concatenate([task_relative_dds for _, task_relative_dds in results])
+    return RobustnessResult(method, resamples, num_orders, final_profits, relative_dds, confidence, ruin_dd)
@@ -0,0 +1,327 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Walk Forward - Rolling in-sample optimization and out-of-sample evaluation of analyzer variants]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import inspect
+import os
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool, cpu_count
+from typing import List, Dict
+
+import numpy as np
+
+from core.backtesting.backtest_result import BacktestResult
+from core.backtesting.backtesting import Backtesting
+from core.backtesting.intrabar_resolver import IntrabarResolver
+from core.backtesting.robustness import robustness
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
+from core.candles.candlestick import Candlestick
+from core.candles.resampler import INTERVAL_MINUTES
+from core.order.exit_rules import find_order_exit
+from core.order.moby_order import MobyOrder
+from core.utils.utils import datetime_utc_to_unix_time
+
+
+class WalkForwardFold:
+    """Un paso del walk forward: variante ganadora en [train_start, train_end) y su resultado en
+    [train_end, test_end)"""
+
+    def __init__(self, train_start: datetime, train_end: datetime, test_end: datetime):
+        self.train_start: datetime = train_start
+        self.train_end: datetime = train_end
+        self.test_end: datetime = test_end
+
+        self.train_results: Dict[str, BacktestResult] = dict()
+        self.winner: str = None
+        self.test_result: BacktestResult = None
+
+
+class CoinSimulator:
+    """Backtest de una moneda en cualquier tramo [start, end) de su historia, como un Backtesting que empezase en
+    start sin posicion y cuyas velas acabasen en end. La decision de cada vela (analyze y su salida) se memoriza: los
+    tramos que se solapan (folds consecutivos) no vuelven a analizar las mismas velas. Supone, como el resto de
+    backtests, que analyze solo depende de sus parametros"""
+
+    def __init__(self, analyzer, candles: List[Candlestick], series: CandleSeries, btc_index: List[Candlestick] = None,
+                 btc_index_series: CandleSeries = None, intrabar_resolver: IntrabarResolver = None):
+        """Default constructor"""
+        self.__analyzer = analyzer
+        self.__candles = candles
+        self.__series = series
+        self.__btc_index = btc_index
+        self.__btc_index_series = btc_index_series
+        self.__intrabar_resolver = intrabar_resolver
+
+        analyze_args = inspect.getfullargspec(analyzer.analyze).args
+        self.__use_btc_index = "external_index_candles" in analyze_args
+        self.__use_previous_moby_order = "previous_moby_order" in analyze_args
+
+        # Velas en las que se puede entrar, como en el Backtesting (la ultima vela no se evalua)
+        candidates = np.arange(analyzer.candle_index_to_start_backtest - 1, len(candles) - 1)
+        if hasattr(analyzer, "precondition_mask") and len(candidates) > 0:
+            candidates = candidates[analyzer.precondition_mask(series)[candidates]]
+        self.__candidates = candidates
+
+        # Por vela (y orden anterior, si analyze la usa): None, o (orden, vela de salida o None si no sale)
+        self.__entries: Dict[tuple, tuple] = dict()
+
+    def simulate(self, start: int, end: int) -> List[MobyOrder]:
+        """Ordenes abiertas y cerradas en las velas [start, end)"""
+
+        orders = list()
+        previous_moby_order = None
+        position = int(np.searchsorted(self.__candidates, start))
+        stop = int(np.searchsorted(self.__candidates, end))
+
+        while position < stop:
+            candle_index = int(self.__candidates[position])
+            entry = self.__get_entry(candle_index, previous_moby_order)
+            position += 1
+            if entry is None:
+                continue
+
+            moby_order, exit_candle_index = entry
+            if exit_candle_index is None or exit_candle_index >= end:
+                break  # Sigue abierta al final del tramo
+
+            orders.append(moby_order)
+            previous_moby_order = moby_order
+            position = int(np.searchsorted(self.__candidates, exit_candle_index + 1))
+
+        return orders
+
+    def __get_entry(self, candle_index: int, previous_moby_order: MobyOrder):
+        key = (candle_index, id(previous_moby_order) if self.__use_previous_moby_order else None)
+        if key in self.__entries:
+            return self.__entries[key]
+
+        analyzer = self.__analyzer
+        stop = candle_index + 1
+        current_candles = CandleWindow(self.__candles, self.__series, stop - analyzer.num_candles_to_iterate, stop)
+
+        kwargs = dict()
+        if self.__use_btc_index:
+            kwargs["external_index_candles"] = CandleWindow(self.__btc_index, self.__btc_index_series,
+                                                            stop - analyzer.num_candles_to_iterate, stop)
+        if self.__use_previous_moby_order:
+            kwargs["previous_moby_order"] = previous_moby_order
+        moby_order = analyzer.analyze(current_candles, **kwargs)
+
+        entry = None
+        if moby_order is not None:
+            entry = moby_order, self.__find_exit(moby_order, candle_index)
+        self.__entries[key] = entry
+        return entry
+
+    def __find_exit(self, moby_order: MobyOrder, candle_index: int) -> int:
+        """Abre la orden al cierre de la vela candle_index y busca su salida, como el backtest de cartera. Las
+        ordenes que salen se cierran aqui (no hay cuenta que actualizar)"""
+
+        trailing_stop_price = Backtesting.prepare_order(moby_order, self.__candles[candle_index])
+
+        # La ultima vela no se evalua, como en el Backtesting
+        exit_candle_index = find_order_exit(moby_order, trailing_stop_price, self.__candles, self.__series.high_price,
+                                            self.__series.low_price, candle_index + 1, len(self.__candles) - 1,
+                                            self.__intrabar_resolver)
+        if exit_candle_index is not None:
+            moby_order.update_metrics()
+        return exit_candle_index
+
+
+class WalkForward:
+    """Walk forward: en cada fold elige entre varias variantes de un analyzer (mismo analyzer con distintos
+    parametros y order_label) la de mejor target_score en la ventana de entrenamiento, y la evalua en la ventana de
+    test siguiente. Las ventanas avanzan step_days. El resultado fuera de muestra es la union de los tests"""
+
+    def __init__(self, train_days: int = 30, test_days: int = 7, step_days: int = None, with_commissions: bool = True,
+                 intrabar_interval: str = None):
+        """Default constructor
+        Args:
+            train_days: Dias de la ventana de entrenamiento
+            test_days: Dias de la ventana de test
+            step_days: Dias que avanza cada fold (por defecto, test_days: los tests no se solapan)
+            with_commissions: Elegir la ganadora y evaluarla con comisiones
+            intrabar_interval: Intervalo con el que resolver las velas en las que saltan a la vez stop y take profit
+        """
+        self.__train_days = train_days
+        self.__test_days = test_days
+        self.__step_days = test_days if step_days is None else step_days
+        self.__with_commissions = with_commissions
+        self.__intrabar_interval = intrabar_interval
+
+        self.folds: List[WalkForwardFold] = list()
+
+    def get_folds(self, analyzers: list, start_time: datetime, end_time: datetime) -> List[WalkForwardFold]:
+        """Ventanas de cada fold. La primera empieza cuando todas las variantes tienen velas suficientes"""
+
+        warmup_candles = max(analyzer.candle_index_to_start_backtest for analyzer in analyzers)
+        train_start = start_time + timedelta(minutes=warmup_candles * INTERVAL_MINUTES[analyzers[0].interval])
+
+        folds = list()
+        while train_start + timedelta(days=self.__train_days + self.__test_days) <= end_time:
+            train_end = train_start + timedelta(days=self.__train_days)
+            folds.append(WalkForwardFold(train_start, train_end, train_end + timedelta(days=self.__test_days)))
+            train_start += timedelta(days=self.__step_days)
+        return folds
+
+    def run(self, analyzers: list, start_time: datetime, end_time: datetime = None,
+            processes: int = None) -> BacktestResult:
+        """Ejecuta el walk forward sobre las variantes y devuelve el resultado fuera de muestra"""
+
+        if len({analyzer.order_label for analyzer in analyzers}) != len(analyzers):
+            raise Exception("Hay order_label repetidos")
+        coins_to_analyze = analyzers[0].coins_to_analyze
+        if not all(analyzer.coins_to_analyze == coins_to_analyze for analyzer in analyzers):
+            raise Exception("Hay analyzers con diferentes coins_to_analyze")
+        if len({analyzer.interval for analyzer in analyzers}) != 1:
+            raise Exception("Hay analyzers con diferentes interval")
+
+        if end_time is None:
+            end_time = datetime.utcnow()
+
+        self.folds = self.get_folds(analyzers, start_time, end_time)
+        if not self.folds:
+            raise Exception("No hay historia suficiente para ningun fold")
+        windows = [(fold.train_start, fold.train_end, fold.test_end) for fold in self.folds]
+
+        # Cada moneda en un proceso: sus velas se cargan una vez para todas las variantes y todos los folds
+        if processes is None:
+            processes = cpu_count()
+
+        if processes == 1:
+            results = [WalkForward.thread_walk_forward_single_coin(analyzers, start_time, coin, windows,
+                                                                   self.__intrabar_interval)
+                       for coin in coins_to_analyze]
+        else:
+            analyzers = [Backtesting.clean_analyzer_for_multiprocessing(analyzer) for analyzer in analyzers]
+            with Pool(processes) as p:
+                results = p.starmap(WalkForward.thread_walk_forward_single_coin,
+                                    [(analyzers, start_time, coin, windows, self.__intrabar_interval)
+                                     for coin in coins_to_analyze])
+
+        # Ordenes de cada fold y variante, de todas las monedas
+        train_orders = [{analyzer.order_label: list() for analyzer in analyzers} for _ in self.folds]
+        test_orders = [{analyzer.order_label: list() for analyzer in analyzers} for _ in self.folds]
+        for result_per_analyzer in results:
+            for order_label, coin_folds in result_per_analyzer.items():
+                for fold_index, (coin_train_orders, coin_test_orders) in enumerate(coin_folds):
+                    train_orders[fold_index][order_label] += coin_train_orders
+                    test_orders[fold_index][order_label] += coin_test_orders
+
+        out_of_sample = BacktestResult()
+        for fold_index, fold in enumerate(self.folds):
+            fold.train_results = {order_label: self.__get_result(orders)
+                                  for order_label, orders in train_orders[fold_index].items()}
+            fold.winner = max(fold.train_results, key=lambda order_label: fold.train_results[order_label].target_score)
+            fold.test_result = self.__get_result(test_orders[fold_index][fold.winner])
+            out_of_sample.orders += fold.test_result.orders
+
+        out_of_sample.with_commissions = self.__with_commissions
+        out_of_sample.orders = sorted(out_of_sample.orders, key=lambda order: order.close_time)
+        out_of_sample.init_metrics()
+
+        self.__write_walk_forward_results(out_of_sample, analyzers[0].order_label)
+        return out_of_sample
+
+    def __get_result(self, orders: List[MobyOrder]) -> BacktestResult:
+        result = BacktestResult()
+        result.orders = sorted(orders, key=lambda order: order.close_time)
+        if self.__with_commissions:
+            result = result.copy_with_commissions()
+        result.init_metrics()
+        return result
+
+    @staticmethod
+    def thread_walk_forward_single_coin(analyzers, start_time, coin, windows,
+                                        intrabar_interval=None) -> Dict[str, list]:
+        """Ordenes (train, test) de cada fold y variante para una moneda"""
+
+        print("Walk forward:", coin)
+
+        loader = Backtesting()
+        candles = loader.get_all_candles_from_start_time(coin, analyzers[0].interval, start_time)
+        series = CandleSeries.from_candles(coin, candles)
+
+        btc_index = None
+        btc_index_series = None
+        if any("external_index_candles" in inspect.getfullargspec(analyzer.analyze).args for analyzer in analyzers):
+            btc_index = loader.get_all_candles_from_start_time("BTCUSDT", analyzers[0].interval, start_time)
+            btc_index_series = CandleSeries.from_candles("BTCUSDT", btc_index)
+
+        # Limites de cada ventana en velas (open_time en [inicio, fin))
+        boundaries = [[int(np.searchsorted(series.open_time, datetime_utc_to_unix_time(window_time, True)))
+                       for window_time in window] for window in windows]
+
+        intrabar_resolver = IntrabarResolver(intrabar_interval) if intrabar_interval else None
+
+        result_per_analyzer = dict()
+        for analyzer in analyzers:
+            # Como en compare_backtests: cada variante prepara sus indicadores sobre las mismas velas (los comunes
+            # salen de la IndicatorCache), una sola vez para todos los folds
+            if hasattr(analyzer, "prepare_candles"):
+                analyzer.prepare_candles(candles)
+
+            simulator = CoinSimulator(analyzer, candles, series, btc_index, btc_index_series, intrabar_resolver)
+            result_per_analyzer[analyzer.order_label] = [(simulator.simulate(train_start, train_end),
+                                                          simulator.simulate(train_end, test_end))
+                                                         for train_start, train_end, test_end in boundaries]
+
+        if intrabar_resolver is not None:
+            intrabar_resolver.flush()
+            print("Velas ambiguas:", intrabar_resolver.get_stats())
+        return result_per_analyzer
+
+    def __write_walk_forward_results(self, out_of_sample: BacktestResult, order_label: str):
+        """Muestra y escribe en fichero los resultados de cada fold y el resultado fuera de muestra"""
+
+        msg = "WALK FORWARD " + order_label
+        msg += " (Train {0}d, Test {1}d, Paso {2}d)".format(self.__train_days, self.__test_days, self.__step_days)
+        if self.__with_commissions:
+            msg += " WITH COMMISIONS"
+        msg += "\n\n"
+
+        for fold in self.folds:
+            msg += "Train {0} - {1}\tTest {1} - {2}\tGanadora: {3}\n".format(
+                fold.train_start.date(), fold.train_end.date(), fold.test_end.date(), fold.winner)
+            msg += "\tTrain: " + fold.train_results[fold.winner].get_small_summary() + "\n"
+            msg += "\tTest:  " + fold.test_result.get_small_summary() + "\n"
+
+        msg += "\nFUERA DE MUESTRA:\n" + out_of_sample.get_full_summary()
+        msg += "\n" + robustness(out_of_sample.profit_np_array).get_small_summary()
+
+        print()
+        print(msg)
+        print()
+
+        filename = "results/WALK FORWARD {0}".format(datetime.now()).replace(":", ".")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".txt", "wb") as text_file:
+            text_file.write(msg.encode("UTF-8"))
+
+
+# Local Testing
+if __name__ == "__main__":
+    from core.market.analyzer5 import Analyzer5
+
+    backtest_analyzers = list()
+    for stoploss_percentage in [1, 1.5, 2]:
+        backtest_analyzer = Analyzer5()
+        backtest_analyzer.stoploss_percentage = stoploss_percentage
+        backtest_analyzer.order_label += "[Stoploss{0}]".format(stoploss_percentage)
+        backtest_analyzers.append(backtest_analyzer)
+
+    start = datetime.utcnow()
+    WalkForward(train_days=30, test_days=7).run(backtest_analyzers, datetime(2021, 1, 1), processes=4)
+    end = datetime.utcnow()
+
+    time_elapsed = (end - start).total_seconds()
+    print("Finished in", time_elapsed, "seconds.")
@@ -15,12 +15,12 @@ import time
 import hmac
 import hashlib
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 from requests import Session
 from core.candles.candlestick import Candlestick
-from google.cloud.secretmanager import SecretManagerServiceClient
 
 from core.utils.utils import datetime_utc_to_unix_time
 
@@ -38,6 +38,8 @@ class BinanceClient:
         #Real Account
         if account is not None and len(account) > 2:
 
+            from google.cloud.secretmanager import SecretManagerServiceClient
+
             __binance_secret = SecretManagerServiceClient().access_secret_version(
                     request={"name": "projects/fender-310315/secrets/" + account + "/versions/latest"}
                 ).payload.data.decode("UTF-8")
@@ -101,6 +103,20 @@ class BinanceClient:
 
         return float(response.json()["markPrice"])
 
+    def get_all_mark_prices(self):
+        """Get current mark price of all symbols from futures in a single request"""
+
+        path = "/premiumIndex"
+
+        response = self.__session.get(url=self.__futures_api_url + path)
+
+        if response.status_code != 200:
+            reason = response.reason if response.reason else ""
+            info = response.text if response.text else ""
+            raise Exception("Binance Http Error " + str(response.status_code) + " " + reason + " " + info)
+
+        return {premium_index["symbol"]: float(premium_index["markPrice"]) for premium_index in response.json()}
+
     def get_all_available_symbols(self):
         """Get all available symbols to operate"""
 
@@ -173,6 +189,71 @@ class BinanceClient:
 
         return response_json
 
+    def get_all_account_trades(self, start_time_utc: datetime = None, end_time_utc: datetime = None,
+                               max_workers: int = 4):
+        """Get all account trades between two dates, without the 1000 trades limit of get_account_trade_list.
+        Binance only allows 7 days windows in /userTrades, so the range is split and windows are requested concurrently.
+        Default range: last 180 days"""
+
+        if end_time_utc is None:
+            end_time_utc = datetime.utcnow()
+        if start_time_utc is None:
+            start_time_utc = end_time_utc - timedelta(days=180)
+
+        windows = list()
+        window_start = start_time_utc
+        while window_start < end_time_utc:
+            window_end = min(window_start + timedelta(days=7), end_time_utc)
+            windows.append((datetime_utc_to_unix_time(window_start, True), datetime_utc_to_unix_time(window_end, True) - 1))
+            window_start = window_end
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            windows_trades = list(executor.map(lambda window: self.__get_window_trades(*window), windows))
+
+        # Dedup by trade id: contiguous pages of the same window may share trades
+        trades = dict()
+        for window_trades in windows_trades:
+            for trade in window_trades:
+                trades[trade["id"]] = trade
+
+        return sorted(trades.values(), key=lambda trade: (trade["time"], trade["id"]))
+
+    def __get_window_trades(self, start_time_ms: int, end_time_ms: int):
+        """All trades of a window (max 7 days), paging by time while the page is full"""
+
+        path = "/userTrades"
+        headers = {"X-MBX-APIKEY": self.__futures_api_key}
+        limit = 1000
+        trades = list()
+
+        while True:
+            params = {"limit": limit, "startTime": start_time_ms, "endTime": end_time_ms}
+            self.__sign_query_string_params(params, self.__futures_api_secret)
+
+            response = self.__session.get(
+                url=self.__futures_api_url + path,
+                params=params,
+                headers=headers
+            )
+
+            if response.status_code != 200:
+                reason = response.reason if response.reason else ""
+                info = response.text if response.text else ""
+                raise Exception("Binance Http Error " + str(response.status_code) + " " + reason + " " + info)
+
+            page = response.json()
+            trades.extend(page)
+
+            if len(page) < limit:
+                return trades
+
+            # Next page starts at the last trade time (repeated trades are deduped by id)
+            next_start_time_ms = page[-1]["time"]
+            if next_start_time_ms <= start_time_ms:
+                logging.warning("Más de {0} trades en el mismo milisegundo {1}".format(limit, start_time_ms))
+                next_start_time_ms = start_time_ms + 1
+            start_time_ms = next_start_time_ms
+
     def set_leverage(self, ticker: str, leverage: int = 20):
         """Set initial leverage for a ticket"""
 
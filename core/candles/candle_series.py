@@ -0,0 +1,92 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Candle Series - Columnar (numpy) representation of a series of candlesticks]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+from typing import List
+
+import numpy as np
+
+from core.candles.candlestick import Candlestick
+from core.utils.utils import datetime_utc_to_unix_time
+
+
+class CandleSeries:
+    """Serie de velas en columnas numpy, ordenada por open_time. Los tiempos son unix time en milisegundos,
+    como en el API de Binance"""
+
+    def __init__(self, ticker: str, open_time: np.ndarray, open_price: np.ndarray, high_price: np.ndarray,
+                 low_price: np.ndarray, close_price: np.ndarray, volume: np.ndarray, close_time: np.ndarray,
+                 quote_asset_volume: np.ndarray, number_of_trades: np.ndarray,
+                 taker_buy_base_asset_volume: np.ndarray, taker_buy_quote_asset_volume: np.ndarray):
+        """Default constructor"""
+        self.ticker: str = ticker
+        self.open_time: np.ndarray = open_time
+        self.open_price: np.ndarray = open_price
+        self.high_price: np.ndarray = high_price
+        self.low_price: np.ndarray = low_price
+        self.close_price: np.ndarray = close_price
+        self.volume: np.ndarray = volume
+        self.close_time: np.ndarray = close_time
+        self.quote_asset_volume: np.ndarray = quote_asset_volume
+        self.number_of_trades: np.ndarray = number_of_trades
+        self.taker_buy_base_asset_volume: np.ndarray = taker_buy_base_asset_volume
+        self.taker_buy_quote_asset_volume: np.ndarray = taker_buy_quote_asset_volume
+
+    __columns = ["open_time", "open_price", "high_price", "low_price", "close_price", "volume", "close_time",
+                 "quote_asset_volume", "number_of_trades", "taker_buy_base_asset_volume",
+                 "taker_buy_quote_asset_volume"]
+    __int_columns = {"open_time", "close_time", "number_of_trades"}
+
+    @staticmethod
+    def from_raw(ticker: str, raw_candlesticks: List[list]) -> 'CandleSeries':
+        """Serie a partir de la respuesta de /klines"""
+
+        columns = list(zip(*raw_candlesticks)) if raw_candlesticks else [[] for _ in CandleSeries.__columns]
+        return CandleSeries(ticker, *[np.array(values, dtype=np.int64 if name in CandleSeries.__int_columns else np.float64)
+                                      for name, values in zip(CandleSeries.__columns, columns)])
+
+    @staticmethod
+    def from_candles(ticker: str, candles: List[Candlestick]) -> 'CandleSeries':
+        """Serie a partir de una lista de Candlestick"""
+
+        return CandleSeries.from_raw(ticker, [[datetime_utc_to_unix_time(candle.open_time, True),
+                                               candle.open_price, candle.high_price, candle.low_price,
+                                               candle.close_price, candle.volume,
+                                               datetime_utc_to_unix_time(candle.close_time, True) - 1,
+                                               candle.quote_asset_volume, candle.number_of_trades,
+                                               candle.taker_buy_base_asset_volume, candle.taker_buy_quote_asset_volume]
+                                              for candle in candles])
+
+    def to_candles(self, last: int = None) -> List[Candlestick]:
+        """Lista de Candlestick (de las last ultimas velas si se indica), para los analyzers"""
+
+        start = 0 if last is None else max(0, len(self) - last)
+        rows = zip(*[getattr(self, name)[start:].tolist() for name in self.__columns])
+        return [Candlestick(self.ticker, list(row)) for row in rows]
+
+    def slice(self, start: int = None, end: int = None) -> 'CandleSeries':
+        """Vista de un tramo de la serie (sin copiar)"""
+        return CandleSeries(self.ticker, *[getattr(self, name)[start:end] for name in self.__columns])
+
+    def tail(self, count: int) -> 'CandleSeries':
+        return self.slice(max(0, len(self) - count), None)
+
+    def append(self, other: 'CandleSeries') -> 'CandleSeries':
+        """Nueva serie con las velas de other añadidas. Las velas de other sustituyen a las que tengan el mismo
+        open_time o posterior (ej: la ultima vela, que estaba aun abierta)"""
+
+        if len(other) == 0:
+            return self
+        keep = int(np.searchsorted(self.open_time, other.open_time[0], side="left"))
+        return CandleSeries(self.ticker, *[np.concatenate((getattr(self, name)[:keep], getattr(other, name)))
+                                           for name in self.__columns])
+
+    def __len__(self):
+        return len(self.open_time)
@@ -0,0 +1,182 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Candle Window - Zero-copy view of a window of a list of candlesticks, and lazily built candlesticks of a series]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+from collections.abc import Sequence
+from typing import List
+
+import numpy as np
+
+from core.candles.candle_series import CandleSeries
+from core.candles.candlestick import Candlestick, IndicatorFrame
+
+
+class CandleWindow(Sequence):
+    """Ventana [start, stop) de una lista de velas sin copiarla: se comporta como la lista candles[start:stop]
+    (indices negativos, slices, iteracion) y da sus columnas como vistas numpy de la CandleSeries de la lista"""
+
+    __metric_columns = {"open_price", "high_price", "low_price", "close_price", "volume", "quote_asset_volume",
+                        "number_of_trades", "taker_buy_base_asset_volume", "taker_buy_quote_asset_volume"}
+
+    __slots__ = ["__candles", "__series", "__start", "__stop"]
+
+    def __init__(self, candles: List[Candlestick], series: CandleSeries, start: int, stop: int):
+        """Default constructor
+        Args:
+            candles: Lista completa de velas
+            series: CandleSeries de la misma lista (mismas posiciones)
+            start: Primera posicion de la ventana
+            stop: Posicion siguiente a la ultima de la ventana
+        """
+        self.__candles = candles
+        self.__series = series
+        self.__start = min(max(start, 0), len(candles))
+        self.__stop = min(max(self.__start, stop), len(candles))
+
+    def __len__(self):
+        return self.__stop - self.__start
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            start, stop, step = index.indices(self.__stop - self.__start)
+            if step != 1:
+                return list(self)[index]
+            return CandleWindow(self.__candles, self.__series, self.__start + start, self.__start + stop)
+
+        position = (self.__stop if index < 0 else self.__start) + index
+        if not self.__start <= position < self.__stop:
+            raise IndexError("CandleWindow index out of range")
+        return self.__candles[position]
+
+    def __iter__(self):
+        # Copia solo los punteros de la ventana: islice recorreria la lista desde el principio hasta start
+        return iter(self.__candles[self.__start:self.__stop])
+
+    def __add__(self, other) -> list:
+        return list(self) + list(other)
+
+    def __radd__(self, other) -> list:
+        return list(other) + list(self)
+
+    def values(self, metric: str) -> np.ndarray:
+        """Valores de un atributo de Candlestick en la ventana como array. None si no es una columna de la serie"""
+
+        if metric in self.__metric_columns:
+            return getattr(self.__series, metric)[self.__start:self.__stop]
+        if metric == "shadow":
+            return self.high - self.low
+        return None
+
+    @property
+    def open(self) -> np.ndarray:
+        return self.__series.open_price[self.__start:self.__stop]
+
+    @property
+    def high(self) -> np.ndarray:
+        return self.__series.high_price[self.__start:self.__stop]
+
+    @property
+    def low(self) -> np.ndarray:
+        return self.__series.low_price[self.__start:self.__stop]
+
+    @property
+    def close(self) -> np.ndarray:
+        return self.__series.close_price[self.__start:self.__stop]
+
+    @property
+    def volume(self) -> np.ndarray:
+        return self.__series.volume[self.__start:self.__stop]
+
+    @property
+    def quote_volume(self) -> np.ndarray:
+        return self.__series.quote_asset_volume[self.__start:self.__stop]
+
+    @property
+    def open_time(self) -> np.ndarray:
+        """Unix time en milisegundos"""
+        return self.__series.open_time[self.__start:self.__stop]
+
+
+class LazyCandles:
+    """Velas de una CandleSeries como Candlestick solo donde se piden: se crean las de la ultima ventana pedida
+    (reutilizando las que se solapan con la anterior) en vez de tener toda la serie como objetos. Los indicadores
+    salen del IndicatorFrame calculado sobre la serie completa"""
+
+    __slots__ = ["__series", "__frame", "__candles", "__start"]
+
+    def __init__(self, series: CandleSeries, frame: IndicatorFrame = None):
+        """Default constructor
+        Args:
+            series: Serie completa
+            frame: Indicadores de la lista completa de velas de la serie (mismas posiciones), si los hay
+        """
+        self.__series = series
+        self.__frame = frame
+        self.__candles: List[Candlestick] = list()
+        self.__start = 0
+
+    def __len__(self):
+        return len(self.__series)
+
+    def __getitem__(self, index: int) -> Candlestick:
+        position = index + len(self.__series) if index < 0 else index
+        if not 0 <= position < len(self.__series):
+            raise IndexError("LazyCandles index out of range")
+        if self.__start <= position < self.__start + len(self.__candles):
+            return self.__candles[position - self.__start]
+        return self.__build(position, position + 1)[0]
+
+    def window(self, start: int, stop: int) -> CandleWindow:
+        """Ventana [start, stop), como CandleWindow(candles, series, start, stop) sobre la lista completa. Pensado para
+        ventanas que avanzan: solo se crean las velas que no estaban en la ventana anterior"""
+
+        start = min(max(start, 0), len(self.__series))
+        stop = min(max(start, stop), len(self.__series))
+        cached_stop = self.__start + len(self.__candles)
+
+        if start < self.__start or start > cached_stop:
+            candles = self.__build(start, stop)
+        else:
+            # Lista nueva: las ventanas ya devueltas no cambian
+            candles = self.__candles[start - self.__start:] + self.__build(cached_stop, stop)
+        self.__candles = candles
+        self.__start = start
+
+        return CandleWindow(candles, self.__series.slice(start, start + len(candles)), 0, stop - start)
+
+    def __build(self, start: int, stop: int) -> List[Candlestick]:
+        if stop <= start:
+            return list()
+        candles = self.__series.slice(start, stop).to_candles()
+        if self.__frame is not None:
+            for position, candle in enumerate(candles, start):
+                candle.indicator_frame = self.__frame
+                candle.indicator_index = position
+        return candles
+
+
+# Local Testing
+if __name__ == "__main__":
+    import time
+
+    # Iterar una ventana al final de una serie larga cuesta lo mismo que al principio (O(ventana))
+    num_candles = 500000
+    all_candles = [Candlestick("BTCUSDT", [i * 60000, 1, 1, 1, 1, 1, i * 60000 + 59999, 1, 1, 1, 1])
+                   for i in range(num_candles)]
+    all_series = CandleSeries.from_candles("BTCUSDT", all_candles)
+
+    for window_start in [0, num_candles - 30]:
+        window = CandleWindow(all_candles, all_series, window_start, window_start + 30)
+        assert list(window) == all_candles[window_start:window_start + 30]
+        start = time.time()
+        for _ in range(1000):
+            for candle in window[1:]:
+                pass
+        print("Ventana desde", window_start, ":", (time.time() - start) / 1000 * 1e6, "us por iteracion")
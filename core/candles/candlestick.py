@@ -12,6 +12,9 @@
 
 from datetime import datetime
 from enum import Enum
+from typing import Dict, List
+
+import numpy as np
 
 from core.utils.utils import round_seconds, unix_time_to_datetime_utc
 
@@ -22,26 +25,117 @@ class PriceZone(str, Enum):
     SUPPORT = "SUPPORT"
 
 
-class TAData:
-    """Struct with many types of technical indicators"""
-    def __init__(self):
+class IndicatorFrame:
+    """Indicadores tecnicos de una lista de velas en columnas: una columna float64 por indicador y una int8 por zona
+    de precio. Cada vela referencia el frame y su posicion en el (ver TAData)"""
+
+    zone_codes: List[PriceZone] = [PriceZone.UNKNOWN, PriceZone.RESISTANCE, PriceZone.SUPPORT]
+
+    def __init__(self, size: int):
         """Default constructor"""
-        self.atr: float = None
-        self.sma: float = None
-        self.adx: float = None
+        self.size: int = size
+        self.columns: Dict[str, np.ndarray] = dict()
+        self.is_set: Dict[str, np.ndarray] = dict()  # Como None en TAData: posiciones sin valor
+
+    @staticmethod
+    def attach(periods: list) -> 'IndicatorFrame':
+        """Frame de la lista de velas: el que ya tienen si se creo para esta misma lista, o uno nuevo al que se copian
+        los indicadores que ya tuvieran las velas (ej: calculados sobre una lista mas larga)"""
+
+        if not periods:
+            return IndicatorFrame(0)
+
+        first, last = periods[0], periods[-1]
+        frame = first.indicator_frame
+        if frame is not None and frame.size == len(periods) and first.indicator_index == 0 \
+                and last.indicator_frame is frame and last.indicator_index == len(periods) - 1:
+            return frame
+
+        frame = IndicatorFrame(len(periods))
+        previous_frames = dict()
+        for position, period in enumerate(periods):
+            if period.indicator_frame is not None:
+                positions, indexes = previous_frames.setdefault(period.indicator_frame, (list(), list()))
+                positions.append(position)
+                indexes.append(period.indicator_index)
+            period.indicator_frame = frame
+            period.indicator_index = position
+
+        for previous_frame, (positions, indexes) in previous_frames.items():
+            for name, column in previous_frame.columns.items():
+                frame.column(name)[positions] = column[indexes]
+                frame.is_set[name][positions] = previous_frame.is_set[name][indexes]
+        return frame
+
+    def column(self, name: str) -> np.ndarray:
+        """Columna del indicador, creandola vacia si no existe"""
+
+        column = self.columns.get(name)
+        if column is None:
+            if name.endswith("_price_zone"):
+                column = np.zeros(self.size, dtype=np.int8)
+            else:
+                column = np.full(self.size, np.nan)
+            self.columns[name] = column
+            self.is_set[name] = np.zeros(self.size, dtype=bool)
+        return column
+
+    def set(self, name: str, values: np.ndarray):
+        """Valores del indicador para todas las velas (codigos de zone_codes en las zonas de precio)"""
+
+        self.column(name)[:] = values
+        self.is_set[name][:] = True
+
+    def get_value(self, name: str, index: int):
+        if name not in self.columns or not self.is_set[name][index]:
+            return None
+        if name.endswith("_price_zone"):
+            return self.zone_codes[self.columns[name][index]]
+        return self.columns[name][index]
+
+    def set_value(self, name: str, index: int, value):
+        if value is None:
+            self.column(name)
+            self.is_set[name][index] = False
+            return
+        if name.endswith("_price_zone"):
+            value = self.zone_codes.index(PriceZone(value))
+        self.column(name)[index] = value
+        self.is_set[name][index] = True
+
+    def __deepcopy__(self, memo):
+        # Las copias de una vela (ej: para acumular velas) comparten los indicadores, no copian todo el frame
+        return self
+
 
-        self.bollinger_high_band: float = None
-        self.bollinger_middle_band: float = None
-        self.bollinger_low_band: float = None
-        self.bollinger_price_zone: PriceZone = None
+class TAData:
+    """Struct with many types of technical indicators. Vista sobre la posicion de una vela en su IndicatorFrame"""
 
-        self.donchian_high_band: float = None
-        self.donchian_low_band: float = None
-        self.donchian_price_zone: PriceZone = None
+    fields = ["atr", "sma", "adx",
+              "bollinger_high_band", "bollinger_middle_band", "bollinger_low_band", "bollinger_price_zone",
+              "donchian_high_band", "donchian_low_band", "donchian_price_zone",
+              "keltner_high_band", "keltner_low_band", "keltner_price_zone"]
+
+    __slots__ = ["frame", "index"]
+
+    def __init__(self, frame: IndicatorFrame = None, index: int = 0):
+        """Default constructor. Sin frame, los indicadores se guardan en un frame propio de una posicion"""
+        self.frame: IndicatorFrame = frame if frame is not None else IndicatorFrame(1)
+        self.index: int = index
+
+    def __getattr__(self, name):
+        if name in TAData.fields:
+            return self.frame.get_value(name, self.index)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in TAData.fields:
+            self.frame.set_value(name, self.index, value)
+        else:
+            object.__setattr__(self, name, value)
 
-        self.keltner_high_band: float = None
-        self.keltner_low_band: float = None
-        self.keltner_price_zone: PriceZone = None
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in TAData.fields}
 
 
 class Candlestick:
@@ -64,8 +158,21 @@ class Candlestick:
 
         self.__init_metrics()
 
-        # Can be filled ad-hoc for each analyzer
-        self.technical_indicators: TAData = None
+    # Can be filled ad-hoc for each analyzer (TechnicalIndicators.generate_*). Por defecto a nivel de clase, para
+    # las velas guardadas en disco (pickle) antes de existir estos atributos
+    indicator_frame: IndicatorFrame = None
+    indicator_index: int = None
+
+    @property
+    def technical_indicators(self) -> TAData:
+        if self.indicator_frame is None:
+            return None
+        return TAData(self.indicator_frame, self.indicator_index)
+
+    @technical_indicators.setter
+    def technical_indicators(self, technical_indicators: TAData):
+        self.indicator_frame = technical_indicators.frame if technical_indicators is not None else None
+        self.indicator_index = technical_indicators.index if technical_indicators is not None else None
 
     def __init_metrics(self):
         """Inicializa las metricas sinteticas"""
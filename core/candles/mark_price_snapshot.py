@@ -0,0 +1,118 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Mark Price Snapshot - Snapshot of the mark price of all symbols shared by every refresh]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import logging
+import threading
+import time
+
+from os import environ
+from typing import Dict
+
+from core.candles.binance_client import BinanceClient
+
+
+class MarkPriceSnapshot:
+    """Clase singleton que descarga en una sola llamada los mark prices de todos los symbols y los comparte con un TTL corto"""
+
+    __instance = None
+    __init_called = False
+
+    def __new__(cls):
+
+        """ Generate singleton """
+
+        if MarkPriceSnapshot.__instance is None:
+            MarkPriceSnapshot.__instance = object.__new__(cls)
+        return MarkPriceSnapshot.__instance
+
+    def __init__(self):
+
+        """ Initialize variables """
+
+        if not self.__init_called:
+            self.__init_called = True
+
+            self.__ttl_milliseconds = int(environ.get("MARK_PRICE_SNAPSHOT_TTL_MILLISECONDS", 800))
+            self.__use_redis = environ.get("MARK_PRICE_SNAPSHOT_REDIS", "True") == "True"
+            self.__redis_key = "MARK_PRICE_SNAPSHOT"
+
+            self.__binance_client = BinanceClient()
+            self.__lock = threading.Lock()
+            self.__prices: Dict[str, float] = dict()
+            self.__taken_at: float = 0
+
+    def get_snapshot(self) -> Dict[str, float]:
+        """Mark price of all symbols, no older than the TTL"""
+
+        if not self.__is_expired():
+            return self.__prices
+
+        with self.__lock:
+            # Otro hilo puede haberlo refrescado mientras esperabamos el lock
+            if not self.__is_expired():
+                return self.__prices
+
+            # El snapshot de Redis guarda cuando se tomo, para no alargar su vida al copiarlo en memoria
+            snapshot = self.__load_from_redis()
+            if not snapshot:
+                snapshot = {"taken_at": time.time(), "prices": self.__binance_client.get_all_mark_prices()}
+                self.__save_in_redis(snapshot)
+
+            self.__prices = snapshot["prices"]
+            self.__taken_at = snapshot["taken_at"]
+
+        return self.__prices
+
+    def get_mark_price(self, ticker: str) -> float:
+        """Mark price of a ticker served from the snapshot, asking Binance only if the ticker is missing"""
+
+        mark_price = self.get_snapshot().get(ticker)
+        if mark_price is None:
+            logging.warning("Mark price no encontrado en el snapshot, consultando a Binance: " + ticker)
+            mark_price = self.__binance_client.get_current_mark_price(ticker)
+
+        return mark_price
+
+    def __is_expired(self) -> bool:
+        return (time.time() - self.__taken_at) * 1000 > self.__ttl_milliseconds
+
+    def __load_from_redis(self) -> dict:
+        if not self.__use_redis:
+            return None
+        try:
+            return self.__redis_client().get_dict(self.__redis_key, serialization="json")
+        except Exception as e:
+            logging.warning("No se pudo leer el snapshot de mark prices de Redis: " + repr(e))
+            return None
+
+    def __save_in_redis(self, snapshot: dict):
+        if not self.__use_redis:
+            return
+        try:
+            self.__redis_client().save_dict(self.__redis_key, snapshot, serialization="json",
+                                            expiration_milliseconds=self.__ttl_milliseconds)
+        except Exception as e:
+            logging.warning("No se pudo guardar el snapshot de mark prices en Redis: " + repr(e))
+
+    @staticmethod
+    def __redis_client():
+        # Import diferido: en backtesting local no siempre hay Redis
+        from core.utils.redisclient import RedisClient
+        return RedisClient()
+
+
+# Local Testing
+if __name__ == "__main__":
+    mark_price_snapshot = MarkPriceSnapshot()
+    start = time.time()
+    print(len(mark_price_snapshot.get_snapshot()), "mark prices in", time.time() - start, "seconds")
+    start = time.time()
+    print(mark_price_snapshot.get_mark_price("BTCUSDT"), "in", time.time() - start, "seconds")
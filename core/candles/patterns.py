@@ -0,0 +1,158 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Patterns - Candlestick patterns as boolean masks over a whole CandleSeries]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+from typing import Tuple
+
+import numpy as np
+
+from core.candles.candle_series import CandleSeries
+
+
+def green_mask(series: CandleSeries) -> np.ndarray:
+    """Velas verdes, como Candlestick.color (una vela sin cambio de precio es verde)"""
+    return ~(series.open_price > series.close_price)
+
+
+def red_mask(series: CandleSeries) -> np.ndarray:
+    return series.open_price > series.close_price
+
+
+def hammer_masks(series: CandleSeries) -> Tuple[np.ndarray, np.ndarray]:
+    """Martillos (is_low_hammer, is_high_hammer), con las mismas reglas que Candlestick"""
+
+    real_body = np.abs(series.close_price - series.open_price)
+    lower_shadow = np.minimum(series.open_price, series.close_price) - series.low_price
+    upper_shadow = series.high_price - np.maximum(series.open_price, series.close_price)
+
+    low_hammer = (lower_shadow > 2 * real_body) & (lower_shadow > real_body + upper_shadow)
+    high_hammer = (upper_shadow > 2 * real_body) & (upper_shadow > real_body + lower_shadow)
+    return low_hammer, high_hammer
+
+
+def engulfing_masks(series: CandleSeries) -> Tuple[np.ndarray, np.ndarray]:
+    """Velas envolventes (alcista, bajista): el cuerpo de la vela cubre el de la anterior, de color contrario"""
+
+    green = green_mask(series)
+    red = ~green
+    bullish = np.zeros(len(series), dtype=bool)
+    bearish = np.zeros(len(series), dtype=bool)
+
+    bullish[1:] = green[1:] & red[:-1] & (series.open_price[1:] <= series.close_price[:-1]) \
+        & (series.close_price[1:] >= series.open_price[:-1])
+    bearish[1:] = red[1:] & green[:-1] & (series.open_price[1:] >= series.close_price[:-1]) \
+        & (series.close_price[1:] <= series.open_price[:-1])
+    return bullish, bearish
+
+
+def color_runs(series: CandleSeries) -> np.ndarray:
+    """Numero de velas seguidas del mismo color que terminan en cada vela (1 si la anterior es de otro color)"""
+
+    if len(series) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    green = green_mask(series)
+    positions = np.arange(len(series))
+    changes = np.ones(len(series), dtype=bool)
+    changes[1:] = green[1:] != green[:-1]
+    run_starts = np.maximum.accumulate(np.where(changes, positions, 0))
+    return positions - run_starts + 1
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Media de las window ultimas posiciones (incluida la actual). NaN hasta tener window valores"""
+
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        result[window - 1:] = (cumulative[window:] - cumulative[:-window]) / window
+    return result
+
+
+def rolling_max(values: np.ndarray, window: int) -> np.ndarray:
+    """Maximo de las window ultimas posiciones (incluida la actual), para ventanas cortas"""
+
+    result = np.array(values, dtype=np.float64)
+    for shift in range(1, window):
+        result[shift:] = np.maximum(result[shift:], values[:-shift])
+    result[:window - 1] = np.nan
+    return result
+
+
+def rolling_argmax(values: np.ndarray, window: int) -> np.ndarray:
+    """Posicion del maximo de las window ultimas posiciones (a igualdad, la mas reciente). -1 hasta tener window
+    valores"""
+
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    result = np.full(len(values), -1, dtype=np.int64)
+    num_windows = len(values) - window + 1
+    if num_windows <= 0:
+        return result
+
+    windows = np.lib.stride_tricks.as_strided(values, shape=(num_windows, window),
+                                              strides=(values.strides[0], values.strides[0]), writeable=False)
+    positions = np.arange(window - 1, len(values))
+    result[window - 1:] = positions - windows[:, ::-1].argmax(axis=1)
+    return result
+
+
+def rolling_percentile(values: np.ndarray, window: int, percentile: float, chunk_size: int = 4096) -> np.ndarray:
+    """Percentil (como np.percentile) de las window ultimas posiciones (incluida la actual). NaN hasta tener window
+    valores. Se calcula por bloques de ventanas para acotar la memoria"""
+
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    num_windows = len(values) - window + 1
+    if num_windows <= 0:
+        return result
+
+    windows = np.lib.stride_tricks.as_strided(values, shape=(num_windows, window),
+                                              strides=(values.strides[0], values.strides[0]), writeable=False)
+    for start in range(0, num_windows, chunk_size):
+        result[window - 1 + start:window - 1 + start + chunk_size] = np.percentile(windows[start:start + chunk_size],
+                                                                                   percentile, axis=1)
+    return result
+
+
+def red_volume_outliers(series: CandleSeries, percentile_window: int, pre_volume_candles: int,
+                        max_pre_volume_inc_percent: float, look_back: int = 19, percentile: float = 91) -> np.ndarray:
+    """Condicion necesaria de las entradas por volumen rojo (AnalyzerJ2, AnalyzerJ3_1m) con cada vela como la actual:
+    la vela de mayor quote volume de las look_back ultimas supera el percentil de las percentile_window ultimas, es
+    roja, el acumulado desde ella hasta la actual es rojo, y las pre_volume_candles anteriores a ella no suben mas de
+    max_pre_volume_inc_percent. True tambien donde no hay historia suficiente para decidir"""
+
+    if len(series) <= pre_volume_candles:
+        return np.ones(len(series), dtype=bool)
+
+    volume = series.quote_asset_volume
+    volume_positions = rolling_argmax(volume, look_back)
+    decidable = volume_positions >= pre_volume_candles
+    positions = np.where(decidable, volume_positions, pre_volume_candles)
+
+    # Margen para redondeos, y NaN (sin historia para el percentil) cuenta como candidata
+    threshold = rolling_percentile(volume, percentile_window, percentile)
+    outlier = ~(volume[positions] <= threshold * (1 - 1e-9))
+
+    red = series.open_price[positions] > series.close_price[positions]
+    red_accumulated = series.open_price[positions] > series.close_price
+
+    pre_volume_open = series.open_price[positions - pre_volume_candles]
+    pre_volume_inc_percent = (series.close_price[positions - 1] - pre_volume_open) / pre_volume_open * 100
+    falling = ~(pre_volume_inc_percent > max_pre_volume_inc_percent + 1e-9)
+
+    return (outlier & red & red_accumulated & falling) | ~decidable
+
+
+def volume_spikes(series: CandleSeries, window: int = 300, percentile: float = 97, factor: float = 2) -> np.ndarray:
+    """Picos de volumen: por encima del percentil de las window ultimas velas y factor veces el de la anterior"""
+
+    spikes = np.zeros(len(series), dtype=bool)
+    spikes[1:] = series.volume[1:] > series.volume[:-1] * factor
+    return spikes & (series.volume > rolling_percentile(series.volume, window, percentile))
@@ -0,0 +1,233 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Resampler - Higher timeframe candles derived from a single series of 1m candles]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import threading
+import time
+
+from typing import Dict, List
+
+import numpy as np
+
+from core.candles.binance_client import BinanceClient
+from core.candles.candle_series import CandleSeries
+from core.candles.candlestick import Candlestick
+from core.utils.utils import unix_time_to_datetime_utc
+
+INTERVAL_MINUTES = {"1m": 1, "3m": 3, "5m": 5, "15m": 15, "30m": 30, "1h": 60, "2h": 120, "4h": 240, "6h": 360,
+                    "8h": 480, "12h": 720, "1d": 1440}
+
+MINUTE_MILLISECONDS = 60 * 1000
+
+
+def resample(series_1m: CandleSeries, interval: str, drop_partial_first: bool = True) -> CandleSeries:
+    """Velas de interval a partir de velas de 1m, alineadas como en Binance (UTC). La primera vela se descarta si
+    la serie empieza a mitad de ella (drop_partial_first); la ultima puede estar a medio formar, igual que la vela
+    en curso de Binance"""
+
+    minutes = INTERVAL_MINUTES[interval]
+    if minutes == 1 or len(series_1m) == 0:
+        return series_1m
+
+    interval_milliseconds = minutes * MINUTE_MILLISECONDS
+    buckets = series_1m.open_time // interval_milliseconds
+
+    # Vela inicial incompleta: la historia descargada empieza despues de su apertura
+    first = 0
+    if drop_partial_first and series_1m.open_time[0] % interval_milliseconds:
+        first = int(np.searchsorted(buckets, buckets[0], side="right"))
+    if first == len(series_1m):
+        return series_1m.slice(0, 0)
+    if first > 0:
+        series_1m = series_1m.slice(first, None)
+        buckets = buckets[first:]
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.concatenate((starts[1:], [len(buckets)])) - 1
+    open_time = buckets[starts] * interval_milliseconds
+
+    return CandleSeries(series_1m.ticker,
+                        open_time,
+                        series_1m.open_price[starts],
+                        np.maximum.reduceat(series_1m.high_price, starts),
+                        np.minimum.reduceat(series_1m.low_price, starts),
+                        series_1m.close_price[ends],
+                        np.add.reduceat(series_1m.volume, starts),
+                        open_time + interval_milliseconds - 1,
+                        np.add.reduceat(series_1m.quote_asset_volume, starts),
+                        np.add.reduceat(series_1m.number_of_trades, starts),
+                        np.add.reduceat(series_1m.taker_buy_base_asset_volume, starts),
+                        np.add.reduceat(series_1m.taker_buy_quote_asset_volume, starts))
+
+
+class Resampler:
+    """Mantiene una serie de 1m y sus velas de mayor intervalo. Al añadir velas de 1m solo se recalculan las velas
+    de mayor intervalo a partir de la ultima (la que estaba a medio formar)"""
+
+    def __init__(self, series_1m: CandleSeries, max_minutes: int = None):
+        """Default constructor
+        Args:
+            series_1m: Serie inicial de velas de 1m
+            max_minutes: Minutos de historia que se conservan (None: todos)
+        """
+        self.__max_minutes = max_minutes
+        self.series_1m: CandleSeries = self.__trim(series_1m)
+        self.__bars: Dict[str, CandleSeries] = dict()
+
+    def update(self, new_1m: CandleSeries):
+        """Añade (o sustituye desde su open_time) velas de 1m y actualiza de forma incremental las ya calculadas"""
+
+        if len(new_1m) == 0:
+            return
+
+        self.series_1m = self.__trim(self.series_1m.append(new_1m))
+
+        for interval, bars in list(self.__bars.items()):
+            interval_milliseconds = INTERVAL_MINUTES[interval] * MINUTE_MILLISECONDS
+
+            # Solo se recalcula desde la vela que contiene la primera vela de 1m nueva
+            recompute_from = (int(new_1m.open_time[0]) // interval_milliseconds) * interval_milliseconds
+            keep = int(np.searchsorted(bars.open_time, recompute_from, side="left"))
+            first_1m = int(np.searchsorted(self.series_1m.open_time, recompute_from, side="left"))
+            if keep == 0 or first_1m == 0:
+                # La vela a recalcular no esta entera en la historia: se recalcula todo
+                del self.__bars[interval]
+                continue
+
+            bars = bars.slice(0, keep).append(resample(self.series_1m.slice(first_1m, None), interval,
+                                                       drop_partial_first=False))
+            if self.__max_minutes is not None:
+                bars = bars.tail(self.__max_minutes // INTERVAL_MINUTES[interval] + 1)
+            self.__bars[interval] = bars
+
+    def get_series(self, interval: str) -> CandleSeries:
+        """Serie de velas del intervalo, incluida la ultima a medio formar"""
+
+        if INTERVAL_MINUTES[interval] == 1:
+            return self.series_1m
+
+        bars = self.__bars.get(interval)
+        if bars is None:
+            bars = resample(self.series_1m, interval)
+            self.__bars[interval] = bars
+        return bars
+
+    def get_candles(self, interval: str, num_candles: int) -> List[Candlestick]:
+        return self.get_series(interval).to_candles(num_candles)
+
+    def __trim(self, series_1m: CandleSeries) -> CandleSeries:
+        if self.__max_minutes is None:
+            return series_1m
+        return series_1m.tail(self.__max_minutes)
+
+
+class MultiTimeframeLoader:
+    """Sirve velas de cualquier intervalo de una moneda a partir de una unica serie de 1m por moneda, cacheada en el
+    proceso: tras la primera carga, cada escaneo solo descarga las velas de 1m nuevas (una llamada por moneda)"""
+
+    def __init__(self, binance_client: BinanceClient = None, futures_info: bool = False, max_page_candles: int = 1000,
+                 max_age_seconds: float = 10):
+        """Default constructor
+        Args:
+            binance_client: Cliente de Binance (por defecto, solo consulta)
+            futures_info: True para velas de futuros, False para spot
+            max_page_candles: Velas por peticion a /klines (1000 en spot, 1500 en futuros)
+            max_age_seconds: Durante estos segundos desde la ultima descarga de una moneda, se sirve sin descargar
+        """
+
+        self.__binance_client = binance_client if binance_client is not None else BinanceClient()
+        self.__futures_info = futures_info
+        self.__max_page_candles = max_page_candles
+        self.__lock = threading.Lock()
+        self.__resamplers: Dict[str, Resampler] = dict()
+        self.__closed_bars: Dict[tuple, tuple] = dict()
+        self.__max_age_seconds = max_age_seconds
+        self.__refreshed_at: Dict[str, float] = dict()
+
+    def refresh(self, coin: str, minutes: int) -> Resampler:
+        """Asegura al menos minutes velas de 1m de la moneda, descargando solo las que falten"""
+
+        resampler = self.__resamplers.get(coin)
+        if resampler is not None and len(resampler.series_1m) >= minutes:
+            if time.time() - self.__refreshed_at.get(coin, 0) <= self.__max_age_seconds:
+                return resampler
+
+            last_open_time = int(resampler.series_1m.open_time[-1])
+            missing_minutes = int(time.time() * 1000 - last_open_time) // MINUTE_MILLISECONDS + 1
+            if missing_minutes < self.__max_page_candles:
+                # Desde la ultima vela (que estaba abierta) hasta ahora: una sola peticion
+                resampler.update(self.__download(coin, start_time=last_open_time, num_candles=missing_minutes + 1))
+                self.__refreshed_at[coin] = time.time()
+                return resampler
+
+        resampler = Resampler(self.__download_last(coin, minutes), max_minutes=minutes)
+        with self.__lock:
+            self.__resamplers[coin] = resampler
+            self.__refreshed_at[coin] = time.time()
+        return resampler
+
+    def get_resampler(self, coin: str) -> Resampler:
+        """Serie cacheada de la moneda tal y como quedo en el ultimo refresh, sin descargar (None si no se ha cargado)"""
+        return self.__resamplers.get(coin)
+
+    def get_candles(self, coin: str, interval: str, num_candles: int) -> List[Candlestick]:
+        """Ultimas num_candles velas del intervalo (la ultima, en curso), descargando solo las de 1m que falten"""
+
+        resampler = self.refresh(coin, num_candles * INTERVAL_MINUTES[interval] + INTERVAL_MINUTES[interval])
+        return resampler.get_candles(interval, num_candles)
+
+    def get_closed_candles(self, coin: str, interval: str, num_candles: int) -> List[Candlestick]:
+        """Ultimas num_candles velas cerradas de un intervalo largo (ej: 1d), descargadas una vez por vela nueva:
+        no cambian hasta que cierra la siguiente"""
+
+        key = (coin, interval, num_candles)
+        interval_milliseconds = INTERVAL_MINUTES[interval] * MINUTE_MILLISECONDS
+        current_bar = int(time.time() * 1000) // interval_milliseconds
+
+        cached = self.__closed_bars.get(key)
+        if cached is None or cached[0] != current_bar:
+            candles = self.__binance_client.get_last_candlesticks(coin=coin, num_candlesticks=num_candles + 1,
+                                                                  interval=interval, futures_info=self.__futures_info)
+            cached = (current_bar, candles[:-1])
+            self.__closed_bars[key] = cached
+        return cached[1]
+
+    def __download_last(self, coin: str, minutes: int) -> CandleSeries:
+        """Ultimas minutes velas de 1m, en paginas de max_page_candles"""
+
+        now = int(time.time() * 1000)
+        start_time = (now // MINUTE_MILLISECONDS - minutes + 1) * MINUTE_MILLISECONDS
+        series = None
+        while start_time <= now:
+            page = self.__download(coin, start_time=start_time, num_candles=self.__max_page_candles)
+            if len(page) == 0:
+                break
+            series = page if series is None else series.append(page)
+            start_time = int(page.open_time[-1]) + MINUTE_MILLISECONDS
+        return series if series is not None else CandleSeries.from_raw(coin, [])
+
+    def __download(self, coin: str, start_time: int, num_candles: int) -> CandleSeries:
+        candles = self.__binance_client.get_last_candlesticks(coin=coin, num_candlesticks=min(num_candles, self.__max_page_candles),
+                                                              interval="1m", futures_info=self.__futures_info,
+                                                              start_time_utc=unix_time_to_datetime_utc(start_time))
+        return CandleSeries.from_candles(coin, candles)
+
+
+# Local Testing
+if __name__ == "__main__":
+    loader = MultiTimeframeLoader()
+    for interval_to_check in ["5m", "30m", "1h"]:
+        resampled = loader.get_candles("BTCUSDT", interval_to_check, 3)
+        downloaded = BinanceClient().get_last_candlesticks("BTCUSDT", 3, interval_to_check)
+        for resampled_candle, downloaded_candle in zip(resampled, downloaded):
+            print(interval_to_check, resampled_candle.open_time == downloaded_candle.open_time,
+                  resampled_candle.high_price == downloaded_candle.high_price,
+                  resampled_candle.low_price == downloaded_candle.low_price,
+                  abs(resampled_candle.volume - downloaded_candle.volume) < 1e-6)
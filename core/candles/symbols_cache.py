@@ -0,0 +1,176 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Symbols Cache - Process-wide cache of the exchangeInfo symbol metadata]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import logging
+import os
+import threading
+import time
+
+from os import environ
+from typing import Dict, List
+
+from core.candles.binance_client import BinanceClient
+
+
+class SymbolInfo:
+    """Struct with the precomputed metadata of a symbol needed to build orders"""
+    def __init__(self, symbol_data: dict):
+        """Default constructor"""
+        self.symbol: str = symbol_data["symbol"]
+        self.quantity_precision: int = symbol_data["quantityPrecision"]
+        self.price_precision: int = symbol_data["pricePrecision"]
+        self.order_types: frozenset = frozenset(symbol_data["orderTypes"])
+        self.filters: Dict[str, dict] = {symbol_filter["filterType"]: symbol_filter
+                                         for symbol_filter in symbol_data.get("filters", [])}
+
+        price_filter = self.filters.get("PRICE_FILTER", {})
+        lot_size_filter = self.filters.get("LOT_SIZE", {})
+        min_notional_filter = self.filters.get("MIN_NOTIONAL", {})
+
+        self.tick_size: float = float(price_filter.get("tickSize", 0))
+        self.step_size: float = float(lot_size_filter.get("stepSize", 0))
+        self.min_quantity: float = float(lot_size_filter.get("minQty", 0))
+        self.max_quantity: float = float(lot_size_filter.get("maxQty", 0))
+        self.min_notional: float = float(min_notional_filter.get("notional", 0))
+
+    def round_quantity(self, quantity: float) -> float:
+        return round(quantity, self.quantity_precision)
+
+    def round_price(self, price: float) -> float:
+        return round(price, self.price_precision)
+
+
+class SymbolsCache:
+    """Clase singleton que cachea en memoria (y opcionalmente en Redis) el exchangeInfo de Binance Futures"""
+
+    __instance = None
+    __init_called = False
+
+    def __new__(cls):
+
+        """ Generate singleton """
+
+        if SymbolsCache.__instance is None:
+            SymbolsCache.__instance = object.__new__(cls)
+        return SymbolsCache.__instance
+
+    def __init__(self):
+
+        """ Initialize variables """
+
+        if not self.__init_called:
+            self.__init_called = True
+
+            self.__ttl_seconds = int(environ.get("SYMBOLS_CACHE_TTL_SECONDS", 6 * 60 * 60))
+            self.__use_redis = environ.get("SYMBOLS_CACHE_REDIS", "True") == "True"
+            self.__background_refresh = environ.get("SYMBOLS_CACHE_BACKGROUND_REFRESH", "True") == "True"
+            self.__redis_key = "EXCHANGE_INFO_SYMBOLS"
+
+            self.__lock = threading.Lock()
+            self.__symbols: Dict[str, dict] = None
+            self.__symbols_info: Dict[str, SymbolInfo] = None
+            self.__loaded_at: float = 0
+            self.__refresh_thread: threading.Thread = None
+            self.__refresh_thread_pid: int = None
+
+    def get_all_available_symbols(self) -> Dict[str, dict]:
+        """Same output as BinanceClient.get_all_available_symbols(), served from cache"""
+        self.__ensure_loaded()
+        return self.__symbols
+
+    def get_symbols_list(self) -> List[str]:
+        """Available symbols, in exchangeInfo order"""
+        return [key for key in self.get_all_available_symbols()]
+
+    def get_symbol_info(self, symbol: str) -> SymbolInfo:
+        """Precomputed precision, filters and order types of a symbol"""
+        self.__ensure_loaded()
+        symbol_info = self.__symbols_info.get(symbol)
+        if symbol_info is None:
+            raise Exception("Symbol no disponible en exchangeInfo: " + symbol)
+        return symbol_info
+
+    def refresh(self):
+        """Force a download of exchangeInfo, updating memory and Redis"""
+        symbols = BinanceClient().get_all_available_symbols()
+        self.__set_symbols(symbols)
+
+        if self.__use_redis:
+            try:
+                self.__redis_client().save_dict(self.__redis_key, symbols, self.__ttl_seconds, serialization="json")
+            except Exception as e:
+                logging.warning("No se pudo guardar exchangeInfo en Redis: " + repr(e))
+
+    def __ensure_loaded(self):
+        """Load symbols on first use, or when TTL has expired and there is no background refresh. The refresh thread
+        is started once per process (gunicorn workers fork after the first use)"""
+
+        if self.__symbols is not None and (self.__has_refresh_thread() or
+                                           (not self.__background_refresh and not self.__is_expired())):
+            return
+
+        with self.__lock:
+            if self.__symbols is None or self.__is_expired():
+                symbols = self.__load_from_redis()
+                if symbols:
+                    self.__set_symbols(symbols)
+                else:
+                    self.refresh()
+
+            if self.__background_refresh and not self.__has_refresh_thread():
+                self.__refresh_thread = threading.Thread(target=self.__refresh_loop, daemon=True)
+                self.__refresh_thread_pid = os.getpid()
+                self.__refresh_thread.start()
+
+    def __has_refresh_thread(self) -> bool:
+        # Tras un fork el hilo del padre no existe en el hijo
+        return self.__refresh_thread is not None and self.__refresh_thread_pid == os.getpid()
+
+    def __refresh_loop(self):
+        """Background refresh before the TTL expires, keeping stale data if Binance fails"""
+        while True:
+            time.sleep(self.__ttl_seconds * 0.9)
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.exception("Error refrescando exchangeInfo: " + repr(e))
+
+    def __load_from_redis(self) -> Dict[str, dict]:
+        if not self.__use_redis:
+            return None
+        try:
+            return self.__redis_client().get_dict(self.__redis_key, serialization="json")
+        except Exception as e:
+            logging.warning("No se pudo leer exchangeInfo de Redis: " + repr(e))
+            return None
+
+    def __set_symbols(self, symbols: Dict[str, dict]):
+        self.__symbols_info = {symbol: SymbolInfo(symbol_data) for symbol, symbol_data in symbols.items()}
+        self.__symbols = symbols
+        self.__loaded_at = time.time()
+
+    def __is_expired(self) -> bool:
+        return time.time() - self.__loaded_at > self.__ttl_seconds
+
+    @staticmethod
+    def __redis_client():
+        # Import diferido: en backtesting local no siempre hay Redis
+        from core.utils.redisclient import RedisClient
+        return RedisClient()
+
+
+# Local Testing
+if __name__ == "__main__":
+    symbols_cache = SymbolsCache()
+    start = time.time()
+    print(len(symbols_cache.get_all_available_symbols()), "symbols in", time.time() - start, "seconds")
+    start = time.time()
+    print(symbols_cache.get_symbol_info("BTCUSDT").__dict__, "in", time.time() - start, "seconds")
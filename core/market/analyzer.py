@@ -21,6 +21,7 @@ from core.market.technical_indicators import TechnicalIndicators, Trend
 from core.candles.binance_client import BinanceClient
 from core.candles.candlestick import Candlestick
 from core.candles.candles_period import CandlesPeriod
+from core.candles.resampler import INTERVAL_MINUTES, MultiTimeframeLoader
 from core.alerts.telegram import Telegram
 from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
@@ -38,6 +39,7 @@ class Analyzer:
         self.__order_simulator = OrderSimulator()
         self.__binance_order = BinanceOrder()
         self.__technical_indicators = TechnicalIndicators()
+        self.__candles_loader = MultiTimeframeLoader(self.__binance_client)
         self.__binance_spot_chart_url = "https://www.binance.com/es/trade/{0}"
         self.__binance_futures_chart_url = "https://www.binance.com/es/futures/{0}"
         self.__trading_view_url = "https://es.tradingview.com/chart/?symbol=BINANCE:{0}&interval=1"
@@ -208,19 +210,41 @@ class Analyzer:
         """Analyze market for signals"""
         minutes = [2, 4, 8, 16]
 
+        # Todos los intervalos salen de una unica serie de 1m por moneda: se actualiza una vez por moneda y escaneo
+        # (una descarga incremental), con la historia que necesitan las 200 velas de 30m
+        for coin in self.coins_to_analyze:
+            try:
+                self.__candles_loader.refresh(coin, 200 * INTERVAL_MINUTES["30m"] + INTERVAL_MINUTES["30m"])
+            except Exception as e:
+                logging.exception("Error obteniendo velas de " + coin + ". " + repr(e))
+
+        # Tendencias de todas las monedas de una vez, de las series ya cargadas
+        global_trends = self.__technical_indicators.get_trends(self.coins_to_analyze, num_periods_sma=50,
+                                                               interval="30m", candles_loader=self.__candles_loader,
+                                                               refresh=False)
+        high_trends = self.__technical_indicators.get_trends(self.coins_to_analyze, num_periods_sma=30,
+                                                             interval="5m", candles_loader=self.__candles_loader,
+                                                             refresh=False)
+        high_trends_small_adx = self.__technical_indicators.get_trends(self.coins_to_analyze, num_periods_sma=150,
+                                                                       interval="1m", candles_loader=self.__candles_loader,
+                                                                       refresh=False)
+        small_trends = self.__technical_indicators.get_trends(self.coins_to_analyze, num_periods_sma=15,
+                                                              interval="1m", candles_loader=self.__candles_loader,
+                                                              refresh=False)
+
         # Hypothesis
         for coin in self.coins_to_analyze:
             print("Processing " + coin)
             try:
-                global_trend = self.__technical_indicators.get_trend(coin, num_periods_sma=50, interval="30m")
-                high_trend = self.__technical_indicators.get_trend(coin, num_periods_sma=30, interval="5m")
-                high_trend_small_adx = self.__technical_indicators.get_trend(coin, num_periods_sma=150, interval="1m")
-                small_trend = self.__technical_indicators.get_trend(coin, num_periods_sma=15, interval="1m")
+                global_trend = global_trends[coin]
+                high_trend = high_trends[coin]
+                high_trend_small_adx = high_trends_small_adx[coin]
+                small_trend = small_trends[coin]
 
                 mixed_trend = Trend.UNKNOWN if global_trend != high_trend else global_trend
                 mixed_trend_2 = Trend.UNKNOWN if global_trend != small_trend else global_trend
 
-                candles_array = self.__binance_client.get_last_candlesticks(coin, 17)
+                candles_array = self.__candles_loader.get_resampler(coin).get_candles("1m", 17)
 
                 global_analysis: CandlesPeriod = CandlesPeriod(candles_array[:-1])
 
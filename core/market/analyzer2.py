@@ -24,7 +24,7 @@ from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
 from core.order.order_simulator import OrderSimulator
 
-from core.utils.utils import unix_time_to_datetime_utc, datetime_utc_to_madrid, datetime_utc_to_unix_time
+from core.utils.utils import unix_time_to_datetime_utc, datetime_utc_to_madrid
 
 
 class Analyzer2:
@@ -329,15 +329,14 @@ class Analyzer2:
 
     def go_for_real(self, moby_order: MobyOrder):
         try:
-            current_datetime = datetime.utcnow()
-            profits = self.__order_simulator.get_profits_from_redis(moby_order.order_label,
-                                                         int(datetime_utc_to_unix_time(current_datetime - timedelta(hours=1))),
-                                                         int(datetime_utc_to_unix_time(current_datetime)))
-            if profits is None or len(profits) < 2:
+            # Las dos ultimas simulaciones de la ultima hora han de ser positivas
+            stats = self.__order_simulator.get_profit_stats(moby_order.order_label)
+            profits = stats.last_profits_since(datetime.utcnow() - timedelta(hours=1))
+            if len(profits) < 2:
                 return False
 
-            for profit in profits[-2:]:
-                if float(profit) <= 0:
+            for profit in profits[:2]:
+                if profit <= 0:
                     return False
             return True
 
@@ -96,13 +96,14 @@ class Analyzer3:
         self.__init_config()
 
     def __init_config(self):
-        config = self.__redis_client.get_dict("ANALYZER3_CONFIG")
+        # Hash nativo de Redis (si aun esta en bson, se migra), cacheado en local
+        config = self.__redis_client.get_hash_dict("ANALYZER3_CONFIG", local_cache_seconds=60, legacy_serialization="bson")
         if config is not None and len(config) > 0:
             self.__config = config
 
     def set_config(self, config):
-        self.__redis_client.save_dict("ANALYZER3_CONFIG", config)
-        return self.__redis_client.get_dict("ANALYZER3_CONFIG")
+        self.__redis_client.save_hash_dict("ANALYZER3_CONFIG", config)
+        return self.__redis_client.get_hash_dict("ANALYZER3_CONFIG")
 
     def analyze_all(self):
         """Analiza todas las monedas para buscar entradas"""
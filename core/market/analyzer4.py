@@ -50,17 +50,22 @@ class Analyzer4:
     def analyze_all(self):
         """Analiza todas las monedas para buscar entradas"""
 
+        # Tendencias de todas las monedas en una sola evaluacion (matriz monedas x velas)
+        trends = self.__technical_indicators.get_trends(self.coins_to_analyze, num_periods_sma=150, interval="1m",
+                                                        adx_min=25)
+
         for coin in self.coins_to_analyze:
             print("Processing " + coin)
             try:
-                self.analyze(coin)
+                self.analyze(coin, trends.get(coin))
             except Exception as e:
                 logging.exception("Error procesando " + coin + ". " + repr(e))
 
-    def analyze(self, coin):
-        """Analiza una moneda para buscar entradas"""
+    def analyze(self, coin, trend: Trend = None):
+        """Analiza una moneda para buscar entradas. trend: tendencia ya calculada (si no, se calcula)"""
         candles = self.__binance_client.get_last_candlesticks(coin=coin, num_candlesticks=99, interval="1m")
-        trend = self.__technical_indicators.get_trend(coin, num_periods_sma=150, interval="1m", adx_min=25)
+        if trend is None:
+            trend = self.__technical_indicators.get_trend(coin, num_periods_sma=150, interval="1m", adx_min=25)
         # TODO: Probar con num_periods=30, interval="5m", por eso del ADX a 5m
         # TODO: Probar con num_periods=150, interval="1m", por eso del ADX a 1m
         # TODO: Probar con ADX min [20,30] (mejor 30 si 1m, y mejor 20 si 5m)
@@ -14,12 +14,23 @@ import logging
 from datetime import datetime
 from typing import List
 
+import numpy as np
+import pandas as pd
+
+from core.alerts.telegram import Telegram
 from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
+from core.candles.resampler import MultiTimeframeLoader
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
 from core.candles.candlestick import Candlestick
+from core.market.symbol_ranking import SymbolRanking
+from core.market.symbol_sharding import SymbolSharding
 from core.market.technical_indicators import TechnicalIndicators
 from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
 from core.order.order_simulator import OrderSimulator
+from core.utils.scan_lease import ScanLease
 
 
 class Analyzer5:
@@ -36,6 +47,9 @@ class Analyzer5:
 
         self.__order_simulator = None  # Init if needed
 
+        # Velas de futuros por moneda cacheadas en el proceso: cada escaneo solo descarga las velas de 1m nuevas
+        self.__candles_loader = MultiTimeframeLoader(self.__binance_client, futures_info=True, max_page_candles=1500)
+
         self.__technical_indicators = TechnicalIndicators()
 
         self.__simulator_entries = False
@@ -44,7 +58,9 @@ class Analyzer5:
         self.__donchian_days = 20
         self.__1m_candles_in_a_day = 1440
 
-        self.coins_to_analyze = [key for key in self.__binance_client.get_all_available_symbols()]
+        self.coins_to_analyze = SymbolsCache().get_symbols_list()
+        self.__symbol_sharding = SymbolSharding("Analyzer5")
+        self.__symbol_ranking = SymbolRanking()
         self.interval = "1m"
         self.num_candles_to_iterate = 31
         self.candle_index_to_start_backtest = self.__donchian_days * self.__1m_candles_in_a_day + 20
@@ -54,41 +70,98 @@ class Analyzer5:
         self.trailing_stop_percentage = 0.2  # 0.2%
         self.trailing_stop_activation_percentage = 0.5  # 0.5%
 
-    def analyze_all(self):
-        """Analiza todas las monedas para buscar entradas, basándonos en ruptura de maximos"""
-
-        for coin in self.coins_to_analyze.copy():
-            print("Processing " + coin)
-            try:
-                candles = self.__binance_client.get_last_candlesticks(
-                    coin=coin,
-                    num_candlesticks=self.__1m_candles_in_a_day,
-                    interval=self.interval,
-                    futures_info=True
-                )
-                # Aqui no aplica pues en real calculamos maximos y minimos con velas diarias, no con donchian
-                # self.prepare_candles(candles)
-
-                moby_order = self.analyze(candles)
-
-                if moby_order is not None:
-                    logging.warning("Entrada " + moby_order.order_label + ": " + coin)
-                    if self.__real_entries:
-                        self.__binance_order.open_position(moby_order)
-                    if self.__simulator_entries:
-                        self.__order_simulator.open_position_simulation(moby_order)
-
-            except Exception as e:
-                msg = "Error procesando " + coin + ". " + repr(e)
-                if "Invalid symbol" in msg:
-                    msg += ". Quitamos esta moneda del listado"
-                    self.coins_to_analyze.remove(coin)
-                logging.exception(msg)
+    def analyze_all(self, shard: int = None, shards: int = None):
+        """Analiza todas las monedas para buscar entradas, basándonos en ruptura de maximos.
+        Con shards, solo las monedas del shard (el resto lo escanean otras peticiones en paralelo).
+        Las notificaciones de Telegram del escaneo se envían en un único mensaje al final"""
+        with Telegram().summary("Escaneo Analyzer5" + ("" if shards is None else " " + str(shard) + "/" + str(shards))):
+            self.__analyze_all(shard, shards)
+
+    def __analyze_all(self, shard: int, shards: int):
+
+        start_time = datetime.utcnow()
+        signals = 0
+
+        # Si la pasada anterior sigue en curso no se solapa otra; si se quedo a medias, se continua
+        scan_pass = ScanLease("Analyzer5", shard).acquire()
+        if scan_pass is None:
+            return
+
+        try:
+            if self.__real_entries and self.__binance_order is not None:
+                # Un unico snapshot de posiciones/ordenes por escaneo
+                self.__binance_order.refresh_account_state()
+
+            if shards is None:
+                coins = self.coins_to_analyze.copy()
+            else:
+                coins = self.__symbol_sharding.get_shard_symbols(self.coins_to_analyze, shard, shards)
+
+            # Primero los symbols mas liquidos y volatiles; con el presupuesto de tiempo agotado se saltan los
+            # frios
+            coins = self.__symbol_ranking.order(coins)
+            skipped = 0
+
+            for coin in scan_pass.pending(coins):
+                if self.__symbol_ranking.should_skip(coin, start_time):
+                    skipped += 1
+                    scan_pass.mark_done(coin)
+                    continue
+
+                print("Processing " + coin)
+                try:
+                    candles = self.__candles_loader.get_candles(coin, self.interval, self.__1m_candles_in_a_day)
+                    self.__symbol_ranking.update(coin, candles)
+                    # Aqui no aplica pues en real calculamos maximos y minimos con velas diarias, no con donchian
+                    # self.prepare_candles(candles)
+
+                    moby_order = self.analyze(candles)
+
+                    if moby_order is not None:
+                        logging.warning("Entrada " + moby_order.order_label + ": " + coin)
+                        signals += 1
+                        if shards is not None:
+                            self.__symbol_sharding.publish_signal(shard, moby_order)
+                        if self.__real_entries and scan_pass.is_valid():
+                            self.__binance_order.open_position(moby_order)
+                        if self.__simulator_entries:
+                            self.__order_simulator.open_position_simulation(moby_order)
+
+                except Exception as e:
+                    msg = "Error procesando " + coin + ". " + repr(e)
+                    if "Invalid symbol" in msg:
+                        msg += ". Quitamos esta moneda del listado"
+                        self.coins_to_analyze.remove(coin)
+                    logging.exception(msg)
+
+                if not scan_pass.mark_done(coin):
+                    break
+        finally:
+            scan_pass.finish()
+
+        self.__symbol_ranking.flush()
+        if skipped > 0:
+            logging.warning("Presupuesto de tiempo agotado: " + str(skipped) + " symbols frios sin escanear")
+
+        if shards is not None:
+            self.__symbol_sharding.publish_scan(shard, shards, len(coins), signals, start_time)
 
     def prepare_candles(self, candles: List[Candlestick]):
         """Añade los indicadores tecnicos necesarios a cada vela"""
         self.__technical_indicators.generate_donchian_channel(candles, self.__1m_candles_in_a_day * self.__donchian_days)
 
+    def precondition_mask(self, series: CandleSeries) -> np.ndarray:
+        """Velas en las que analyze() puede abrir orden siendo la vela actual (backtest): la anterior rompe el canal
+        de Donchian de la previa (mismas bandas que generate_donchian_channel)"""
+
+        window = self.__1m_candles_in_a_day * self.__donchian_days
+        high_band = pd.Series(series.high_price).rolling(window, min_periods=window).max().values
+        low_band = pd.Series(series.low_price).rolling(window, min_periods=window).min().values
+
+        breakout = np.zeros(len(series), dtype=bool)
+        breakout[2:] = (series.high_price[1:-1] > high_band[:-2]) | (series.low_price[1:-1] < low_band[:-2])
+        return breakout
+
     def analyze(self, candles: List[Candlestick]) -> MobyOrder:
         """Analiza una moneda para buscar entradas, basandonos en ruptura de maximos"""
 
@@ -98,24 +171,22 @@ class Analyzer5:
         current_candle = candles[-1]
         previous_candle = candles[-2]
 
-        # Backtesting: many candles of 5m, with donchian channel
+        # Backtesting: many candles of 5m, with donchian channel. Backtesting solo llama con las velas de
+        # precondition_mask (la anterior rompe el canal)
         if current_candle.technical_indicators is not None \
                 and current_candle.technical_indicators.donchian_high_band is not None:
             maximum_price = candles[-3].technical_indicators.donchian_high_band
             minimum_price = candles[-3].technical_indicators.donchian_low_band
 
-            # Salimos antes de seguir haciendo cosas, para eficientar el backtesting
-            if not (previous_candle.high_price > maximum_price or previous_candle.low_price < minimum_price):
-                return moby_order
-
-        # 5 minutes volumes
-        current_volume = sum(candle.volume for candle in candles[-6:-1])
+        # 5 minutes volumes (en backtesting, sobre la columna de volumen de la ventana)
+        volumes = candles.volume if isinstance(candles, CandleWindow) else [candle.volume for candle in candles]
+        current_volume = sum(volumes[-6:-1])
         previous_volumes = [
-            sum(candle.volume for candle in candles[-11:-6]),
-            sum(candle.volume for candle in candles[-16:-11]),
-            sum(candle.volume for candle in candles[-21:-16]),
-            sum(candle.volume for candle in candles[-26:-21]),
-            sum(candle.volume for candle in candles[-31:-26])
+            sum(volumes[-11:-6]),
+            sum(volumes[-16:-11]),
+            sum(volumes[-21:-16]),
+            sum(volumes[-26:-21]),
+            sum(volumes[-31:-26])
         ]
 
         if current_volume > max(previous_volumes):
@@ -124,12 +195,11 @@ class Analyzer5:
 
             # Real time: some candles of 1d and some of 1m
             if maximum_price is None:
-                day_candles = self.__binance_client.get_last_candlesticks(coin=candles[0].ticker,
-                                                                          num_candlesticks=self.__donchian_days,
-                                                                          interval="1d", futures_info=True)
-                maximum_price = max([candle.high_price for candle in day_candles[:-1] + candles[:-2]])
-                minimum_price = min([candle.low_price for candle in day_candles[:-1] + candles[:-2]])
-                current_price = day_candles[-1].close_price
+                # Las velas diarias cerradas no cambian en todo el dia: una descarga por moneda y dia
+                day_candles = self.__candles_loader.get_closed_candles(coin=candles[0].ticker, interval="1d",
+                                                                       num_candles=self.__donchian_days - 1)
+                maximum_price = max([candle.high_price for candle in day_candles + candles[:-2]])
+                minimum_price = min([candle.low_price for candle in day_candles + candles[:-2]])
 
             if previous_candle.high_price > maximum_price:
                 moby_order = MobyOrder(
@@ -14,11 +14,14 @@ import logging
 from datetime import datetime
 from typing import List
 
-from core.backtesting.backtesting import Backtesting
+from core.candles import patterns
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
 from core.candles.candles_period import CandlesPeriod
 from core.candles.candlestick import Candlestick
 from core.market.technical_indicators import TechnicalIndicators
 from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
 from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
 from core.order.order_simulator import OrderSimulator
@@ -39,7 +42,7 @@ class AnalyzerJ1:
         self.__real_entries = False
 
         # All available coins: [key for key in self.__binance_client.get_all_available_symbols()]
-        self.coins_to_analyze = [key for key in self.__binance_client.get_all_available_symbols()] #["IOTAUSDT", "XRPUSDT", "ETHUSDT", "ADAUSDT", "LUNAUSDT"]
+        self.coins_to_analyze = SymbolsCache().get_symbols_list() #["IOTAUSDT", "XRPUSDT", "ETHUSDT", "ADAUSDT", "LUNAUSDT"]
         self.interval = "1m"
         self.num_candles_to_iterate = 301
         self.candle_index_to_start_backtest = self.num_candles_to_iterate
@@ -57,6 +60,31 @@ class AnalyzerJ1:
         """Añade los indicadores tecnicos necesarios a cada vela"""
         self.__technical_indicators.generate_average_true_range(candles, 40)
 
+    def precondition_mask(self, series: CandleSeries) -> np.ndarray:
+        """Velas en las que analyze() puede abrir orden siendo la vela actual (para backtest, con ventanas de
+        num_candles_to_iterate velas). Condicion necesaria, no suficiente: pico de volumen verde en las 4 ultimas
+        velas completas por encima del percentil 97 y del doble de la media, y vela actual o anterior roja"""
+
+        window = self.num_candles_to_iterate - 1  # Velas completas
+        green = patterns.green_mask(series)
+        red = ~green
+
+        # Candidatas de search_high_volume: verdes y con el doble de volumen que la anterior
+        candidates = np.zeros(len(series), dtype=bool)
+        candidates[1:] = green[1:] & (series.volume[1:] > series.volume[:-1] * 2)
+        candidate_volume = np.where(candidates, series.volume, -np.inf)
+        max_candidate_volume = patterns.rolling_max(candidate_volume, 4)
+        threshold = np.maximum(patterns.rolling_percentile(series.volume, window, 97),
+                               2 * patterns.rolling_mean(series.volume, window))
+
+        # Margen para redondeos (la media y el percentil de analyze se calculan de otra forma)
+        spike = np.ones(len(series), dtype=bool)
+        spike[1:] = ~(max_candidate_volume[:-1] <= threshold[:-1] * (1 - 1e-9))
+
+        reversal = red.copy()
+        reversal[1:] |= red[:-1]
+        return spike & reversal
+
     def analyze(self, candles: List[Candlestick]) -> MobyOrder:
         if len(candles) % 2 != 0:
             return self.backtrack_coin(candles[0].ticker, candles)
@@ -64,6 +92,9 @@ class AnalyzerJ1:
             return self.backtrack_coin(candles[0].ticker, candles[0:len(candles)-2])
 
     def get_real_shadow_percentile(self, candles: List[Candlestick], percentile):
+        if isinstance(candles, CandleWindow):
+            return np.percentile(candles.values("shadow"), percentile)
+
         arr = []
         for candle in candles:
             arr.append(candle.shadow)
@@ -72,6 +103,9 @@ class AnalyzerJ1:
         return np.percentile(np_arr, percentile)
 
     def get_volume_percentile(self, candles: List[Candlestick], percentile):
+        if isinstance(candles, CandleWindow):
+            return np.percentile(candles.volume, percentile)
+
         arr = []
         for candle in candles:
             arr.append(candle.volume)
@@ -238,6 +272,8 @@ class AnalyzerJ1:
 
 # Local Testing
 if __name__ == "__main__":
+    from core.backtesting.backtesting import Backtesting
+
     backtest_analyzer = AnalyzerJ1()
     backtest_start_time = datetime(2021, 1, 1)
 
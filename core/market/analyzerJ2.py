@@ -15,10 +15,13 @@ from copy import deepcopy
 from datetime import datetime
 from typing import List
 
-from core.backtesting.backtesting import Backtesting
+from core.candles import patterns
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
 from core.candles.candlestick import Candlestick
 from core.market.technical_indicators import TechnicalIndicators
 from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
 from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
 import numpy as np
@@ -40,7 +43,7 @@ class AnalyzerJ2:
 
         self.__technical_indicators = TechnicalIndicators()
         # All available coins: [key for key in self.__binance_client.get_all_available_symbols()]
-        self.coins_to_analyze = [key for key in self.__binance_client.get_all_available_symbols()]
+        self.coins_to_analyze = SymbolsCache().get_symbols_list()
         self.interval = "5m"
         self.num_candles_to_iterate = 501
         self.candle_index_to_start_backtest = self.num_candles_to_iterate
@@ -51,10 +54,19 @@ class AnalyzerJ2:
         self.__technical_indicators.generate_average_true_range(candles, 25)
         #self.__technical_indicators.generate_donchian_channel(candles, 25)
 
+    def precondition_mask(self, series: CandleSeries) -> np.ndarray:
+        """Velas en las que red_volume_order() puede abrir orden siendo la vela actual: pico de quote volume rojo por
+        encima del P91 de las 500 ultimas velas en las 20 ultimas, sin subida previa de mas del 1%"""
+        return patterns.red_volume_outliers(series, percentile_window=500, pre_volume_candles=100,
+                                            max_pre_volume_inc_percent=1)
+
     def analyze(self, candles: List[Candlestick], previous_moby_order: MobyOrder, external_index_candles: List[Candlestick]) -> MobyOrder:
         return self.red_volume_order(candles, previous_moby_order, external_index_candles)
 
     def get_percentile(self, percentile: float, metric: str, candles: List[Candlestick]):
+        if isinstance(candles, CandleWindow) and candles.values(metric) is not None:
+            # Backtesting: columna de la ventana sin recorrer las velas
+            return np.percentile(candles.values(metric), percentile)
         np_arr = np.array([candle.__getattribute__(metric) for candle in candles])
         return np.percentile(np_arr, percentile)
 
@@ -167,11 +179,12 @@ class AnalyzerJ2:
 # Local Testing
 if __name__ == "__main__":
     import os
+    from core.backtesting.backtesting import Backtesting
     backtest_analyzer = AnalyzerJ2()
     backtest_start_time = datetime(2020, 12, 31)
 
     start = datetime.utcnow()
-    Backtesting().backtest(backtest_analyzer, backtest_start_time, processes=12)
+    Backtesting(intrabar_interval="1m").backtest(backtest_analyzer, backtest_start_time, processes=12)
     end = datetime.utcnow()
 
     time_elapsed = (end - start).total_seconds()
@@ -12,20 +12,27 @@
 import logging
 from copy import deepcopy
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 
 from core.account.account_manager import AccountManager, Account
 from core.alerts.telegram import Telegram
-from core.backtesting.backtesting import Backtesting
+from core.backtesting.portfolio_state import PortfolioState
+from core.candles import patterns
+from core.candles.candle_series import CandleSeries
+from core.candles.candle_window import CandleWindow
 from core.candles.candlestick import Candlestick
+from core.market.symbol_ranking import SymbolRanking
+from core.market.symbol_sharding import SymbolSharding
 from core.market.technical_indicators import TechnicalIndicators
 from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
 from core.order.binance_order import BinanceOrder
 from core.order.moby_order import MobyOrder, OrderPosition
 import numpy as np
 
 from core.utils.datastoreclient import DataStoreClient
+from core.utils.scan_lease import ScanLease
 
 
 class AnalyzerJ3_1m:
@@ -33,7 +40,7 @@ class AnalyzerJ3_1m:
 
     def __init__(self, real_orders=False):
         """Default constructor"""
-        self.coins_volume_rank = dict()
+        self.__symbol_ranking = SymbolRanking()
         if real_orders:
             self.__binance_client: BinanceClient = BinanceClient(account="binance2")
             self.__binance_order: BinanceOrder = BinanceOrder(account="binance2")
@@ -50,12 +57,16 @@ class AnalyzerJ3_1m:
         self.__technical_indicators = TechnicalIndicators()
 
         # All available coins: [key for key in self.__binance_client.get_all_available_symbols()]
-        self.coins_to_analyze = [key for key in self.__binance_client.get_all_available_symbols()]#["ETHUSDT", "IOTAUSDT", "BTCUSDT", "LUNAUSDT", "XRPUSDT", "EOSUSDT", "DOTUSDT", "SOLUSDT", "MATICUSDT", "TRXUSDT"]
+        self.__symbol_sharding = SymbolSharding("AnalyzerJ3_1m")
+        self.coins_to_analyze = SymbolsCache().get_symbols_list()#["ETHUSDT", "IOTAUSDT", "BTCUSDT", "LUNAUSDT", "XRPUSDT", "EOSUSDT", "DOTUSDT", "SOLUSDT", "MATICUSDT", "TRXUSDT"]
         self.interval = "1m"
         self.num_candles_to_iterate = 1441
         self.candle_index_to_start_backtest = self.num_candles_to_iterate
         self.order_label = "[J3-1m-v0.2.00]"
 
+        # Modo de las ordenes en el backtest de cartera (en real esta en AnalyzerJ3Config)
+        self.__backtest_position_mode = "LONG"
+
         # Variables
         self.var1 = 99
         self.var2 = 1
@@ -64,10 +75,29 @@ class AnalyzerJ3_1m:
         """Añade los indicadores tecnicos necesarios a cada vela"""
         self.__technical_indicators.generate_average_true_range(candles, 25)
 
-    def analyze(self, candles: List[Candlestick], previous_moby_order: MobyOrder = None, external_index_candles: List[Candlestick] = None) -> MobyOrder:
-        return self.red_volume_order(candles, previous_moby_order, external_index_candles)
+    def precondition_mask(self, series: CandleSeries) -> np.ndarray:
+        """Velas en las que red_volume_order() puede abrir orden siendo la vela actual: pico de quote volume rojo por
+        encima del P91 de las 1440 ultimas velas en las 20 ultimas, tras una caida de al menos el 5%"""
+        return patterns.red_volume_outliers(series, percentile_window=1440, pre_volume_candles=200,
+                                            max_pre_volume_inc_percent=-5)
+
+    def analyze(self, candles: List[Candlestick], previous_moby_order: MobyOrder = None, external_index_candles: List[Candlestick] = None,
+                portfolio_state: PortfolioState = None) -> MobyOrder:
+        moby_order = self.red_volume_order(candles, previous_moby_order, external_index_candles)
+
+        # Backtest de cartera: el modo sale de la racha de las ordenes cerradas de la cuenta simulada, como en real
+        if moby_order is not None and portfolio_state is not None:
+            new_mode = self.get_streak_mode(portfolio_state.closed_positions)
+            if new_mode is not None:
+                self.__backtest_position_mode = new_mode
+            self.configure_order(moby_order, self.__backtest_position_mode)
+
+        return moby_order
 
     def get_percentile(self, percentile: float, metric: str, candles: List[Candlestick]):
+        if isinstance(candles, CandleWindow) and candles.values(metric) is not None:
+            # Backtesting: columna de la ventana sin recorrer las velas
+            return np.percentile(candles.values(metric), percentile)
         np_arr = np.array([candle.__getattribute__(metric) for candle in candles])
         return np.percentile(np_arr, percentile)
 
@@ -188,11 +218,24 @@ class AnalyzerJ3_1m:
         if account_info is None:
             raise Exception("Información de cuenta necesaria... se para la ejecución")
 
+        new_mode = self.get_streak_mode(account_info.closed_positions)
+
+        if new_mode is not None and new_mode != moby_config["PositionMode"]:
+            moby_config["PositionMode"] = new_mode
+            moby_config["Updated"] = datetime.utcnow()
+            self.__ds_cli.update_entity(moby_config)
+            self.__telegram.send_message_to_group_2("Position Mode Updated: " + new_mode)
+
+        return moby_config["PositionMode"]
+
+    @staticmethod
+    def get_streak_mode(closed_positions: List[MobyOrder]) -> str:
+        """Modo que marca la racha de las ultimas ordenes cerradas: 'LONG', 'SHORT', o None si no hay racha"""
+
         down_price_streak_count = 0
         up_price_streak_count = 0
-        new_mode = None
 
-        closed_positions = sorted(account_info.closed_positions, key=lambda order: order.close_time, reverse=True)
+        closed_positions = sorted(closed_positions, key=lambda order: order.close_time, reverse=True)
 
         # Orders Streak
         if len(closed_positions) >= 3:
@@ -201,80 +244,132 @@ class AnalyzerJ3_1m:
                     up_price_streak_count += 1
                     down_price_streak_count = 0
                     if up_price_streak_count == 3:
-                        new_mode = "LONG"
-                        break
+                        return "LONG"
                 else:
                     down_price_streak_count += 1
                     up_price_streak_count = 0
                     if down_price_streak_count == 5:
-                        new_mode = "SHORT"
-                        break
-
-        if new_mode is not None and new_mode != moby_config["PositionMode"]:
-            moby_config["PositionMode"] = new_mode
-            moby_config["Updated"] = datetime.utcnow()
-            self.__ds_cli.update_entity(moby_config)
-            self.__telegram.send_message_to_group_2("Position Mode Updated: " + new_mode)
-
-        return moby_config["PositionMode"]
-
-    def real_orders(self):
-
-        account_info: Account = self.__account_manager.get_account_info(with_opened_positions_prices=False)
-        moby_config = self.__ds_cli.get_entity("AnalyzerJ3Config", "1m_config")
-        coin_count = 0
+                        return "SHORT"
 
-        # 1. Determinar Modo
-        moby_mode = self.get_position_mode(account_info, moby_config)
-
-        for coin in self.coins_to_analyze.copy():
-            print("Processing " + coin)
-            try:
-                candles = self.__binance_client.get_last_candlesticks(
-                    coin=coin,
-                    num_candlesticks=self.num_candles_to_iterate,
-                    interval=self.interval,
-                    futures_info=True
-                )
-                self.prepare_candles(candles)
-                moby_order = self.analyze(candles)
-
-                # Configuración Orden
-                if moby_order is not None:
-                    moby_order.quantity = 3
-                    moby_order.leverage = 5
-
-                    if moby_mode == "LONG":
-                        moby_order.position = OrderPosition.Long
-
-                    else:
-                        moby_order.position = OrderPosition.Short
-                        sl = moby_order.take_profit_price
-                        tp = moby_order.stop_loss
-                        moby_order.take_profit_price = tp
-                        moby_order.stop_loss = sl
+        return None
 
-                    logging.warning("ENTRADA REAL" + moby_order.order_label + ": " + coin + " MODE: " + moby_mode)
-                    self.__binance_order.open_position(moby_order)
+    @staticmethod
+    def configure_order(moby_order: MobyOrder, moby_mode: str):
+        """¡¡¡WARNING!!! Modifica la moby_order por referencia: tamaño de la orden real y posicion segun el modo"""
 
-                coin_count += 1
+        moby_order.quantity = 3
+        moby_order.leverage = 5
 
-                if coin_count % 50 == 0:
-                    account_info: Account = self.__account_manager.get_account_info(with_opened_positions_prices=False)
-                    moby_config = self.__ds_cli.get_entity("AnalyzerJ3Config", "1m_config")
-                    moby_mode = self.get_position_mode(account_info, moby_config)
+        if moby_mode == "LONG":
+            moby_order.position = OrderPosition.Long
 
-            except Exception as e:
-                msg = "Error procesando " + coin + ". " + repr(e)
-                if "Invalid symbol" in msg:
-                    msg += ". Quitamos esta moneda del listado"
-                    self.coins_to_analyze.remove(coin)
-                logging.exception(msg)
+        else:
+            moby_order.position = OrderPosition.Short
+            sl = moby_order.take_profit_price
+            tp = moby_order.stop_loss
+            moby_order.take_profit_price = tp
+            moby_order.stop_loss = sl
+
+    def real_orders(self, shard: int = None, shards: int = None):
+        """Escaneo real. Con shards, solo las monedas del shard (el resto lo escanean otras peticiones en paralelo).
+        Las notificaciones de Telegram del escaneo se envían en un único mensaje al final"""
+        with self.__telegram.summary("Escaneo AnalyzerJ3_1m" + ("" if shards is None else " " + str(shard) + "/" + str(shards))):
+            self.__real_orders(shard, shards)
+
+    def __real_orders(self, shard: int, shards: int):
+
+        start_time = datetime.utcnow()
+        signals = 0
+
+        # Si la pasada anterior sigue en curso no se solapa otra; si se quedo a medias, se continua
+        scan_pass = ScanLease("AnalyzerJ3_1m", shard).acquire()
+        if scan_pass is None:
+            return
+
+        try:
+            # Para el modo solo hacen falta las ultimas ordenes cerradas: una unica ventana de 7 dias de trades
+            account_info: Account = self.__account_manager.get_account_info(start_time=datetime.utcnow() - timedelta(days=7),
+                                                                            with_opened_positions_prices=False)
+            moby_config = self.__ds_cli.get_entity("AnalyzerJ3Config", "1m_config")
+            coin_count = 0
+
+            # Un unico snapshot de posiciones/ordenes por escaneo
+            self.__binance_order.refresh_account_state()
+
+            # 1. Determinar Modo
+            moby_mode = self.get_position_mode(account_info, moby_config)
+
+            if shards is None:
+                coins = self.coins_to_analyze.copy()
+            else:
+                coins = self.__symbol_sharding.get_shard_symbols(self.coins_to_analyze, shard, shards)
+
+            # Primero los symbols mas liquidos y volatiles; con el presupuesto de tiempo agotado se saltan los
+            # frios
+            coins = self.__symbol_ranking.order(coins)
+            skipped = 0
+
+            for coin in scan_pass.pending(coins):
+                if self.__symbol_ranking.should_skip(coin, start_time):
+                    skipped += 1
+                    scan_pass.mark_done(coin)
+                    continue
+
+                print("Processing " + coin)
+                try:
+                    candles = self.__binance_client.get_last_candlesticks(
+                        coin=coin,
+                        num_candlesticks=self.num_candles_to_iterate,
+                        interval=self.interval,
+                        futures_info=True
+                    )
+                    self.__symbol_ranking.update(coin, candles)
+                    self.prepare_candles(candles)
+                    moby_order = self.analyze(candles)
+
+                    # Configuración Orden
+                    if moby_order is not None:
+                        self.configure_order(moby_order, moby_mode)
+
+                        logging.warning("ENTRADA REAL" + moby_order.order_label + ": " + coin + " MODE: " + moby_mode)
+                        signals += 1
+                        if shards is not None:
+                            self.__symbol_sharding.publish_signal(shard, moby_order)
+                        if scan_pass.is_valid():
+                            self.__binance_order.open_position(moby_order)
+
+                    coin_count += 1
+
+                    if coin_count % 50 == 0:
+                        account_info: Account = self.__account_manager.get_account_info(start_time=datetime.utcnow() - timedelta(days=7),
+                                                                                        with_opened_positions_prices=False)
+                        moby_config = self.__ds_cli.get_entity("AnalyzerJ3Config", "1m_config")
+                        moby_mode = self.get_position_mode(account_info, moby_config)
+
+                except Exception as e:
+                    msg = "Error procesando " + coin + ". " + repr(e)
+                    if "Invalid symbol" in msg:
+                        msg += ". Quitamos esta moneda del listado"
+                        self.coins_to_analyze.remove(coin)
+                    logging.exception(msg)
+
+                if not scan_pass.mark_done(coin):
+                    break
+        finally:
+            scan_pass.finish()
+
+        self.__symbol_ranking.flush()
+        if skipped > 0:
+            logging.warning("Presupuesto de tiempo agotado: " + str(skipped) + " symbols frios sin escanear")
+
+        if shards is not None:
+            self.__symbol_sharding.publish_scan(shard, shards, len(coins), signals, start_time)
 
 
 # Local Testing
 if __name__ == "__main__":
     import os
+    from core.backtesting.backtesting import Backtesting
 
     backtesting = Backtesting()
     backtest_analyzers = list()
@@ -2,14 +2,13 @@
 from datetime import datetime
 
 from core.backtesting.backtesting import Backtesting
-from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
 
 if __name__ == "__main__":
     backtesting = Backtesting()
     backtest_analyzers = list()
     backtest_start_time = datetime(2020, 12, 31)
-    binance_client = BinanceClient()
-    coins = [key for key in binance_client.get_all_available_symbols()]
+    coins = SymbolsCache().get_symbols_list()
     count = 0
     for coin in coins:
         count = count + 1
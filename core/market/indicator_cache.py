@@ -0,0 +1,106 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Indicator Cache - Process-wide LRU cache of technical indicator results]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import hashlib
+import threading
+
+from collections import OrderedDict
+from os import environ
+from typing import Callable, Dict
+
+import numpy as np
+
+
+class IndicatorCache:
+    """Clase singleton: resultados de indicadores tecnicos por (symbol, indicador, parametros, huella de las velas),
+    compartidos por todos los TechnicalIndicators del proceso. Si varios analyzers calculan el mismo indicador sobre
+    las mismas velas (en el mismo tick o en el mismo backtest), se calcula una sola vez. LRU limitada en memoria"""
+
+    __instance = None
+    __init_called = False
+
+    def __new__(cls):
+
+        """ Generate singleton """
+
+        if IndicatorCache.__instance is None:
+            IndicatorCache.__instance = object.__new__(cls)
+        return IndicatorCache.__instance
+
+    def __init__(self):
+
+        """ Initialize variables """
+
+        if not self.__init_called:
+            self.__init_called = True
+
+            self.__lock = threading.Lock()
+            self.__entries: OrderedDict = OrderedDict()
+            self.__max_bytes = int(float(environ.get('INDICATOR_CACHE_MAX_MB', 256)) * 1024 * 1024)
+            self.__bytes = 0
+            self.__hits = 0
+            self.__misses = 0
+            self.__evictions = 0
+
+    @staticmethod
+    def fingerprint(ticker: str, first_open_time, last_open_time, inputs: Dict[str, np.ndarray]) -> tuple:
+        """Huella de una serie de velas: symbol, primera y ultima vela (que fijan tambien el intervalo), numero de
+        velas y hash de los precios de entrada, para invalidar en cuanto cambie cualquier vela (ej: la ultima, abierta)"""
+
+        digest = hashlib.md5()
+        for name in sorted(inputs):
+            digest.update(np.ascontiguousarray(inputs[name]).tobytes())
+        size = len(next(iter(inputs.values()))) if inputs else 0
+        return ticker, first_open_time, last_open_time, size, digest.hexdigest()
+
+    def get_or_compute(self, fingerprint: tuple, indicator: str, params: tuple,
+                       compute: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Columnas del indicador: de la cache o calculadas con compute() (y guardadas). No modificar las devueltas"""
+
+        key = (fingerprint, indicator, params)
+        with self.__lock:
+            columns = self.__entries.get(key)
+            if columns is not None:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return columns
+            self.__misses += 1
+
+        columns = compute()
+        size = sum(column.nbytes for column in columns.values())
+        if size > self.__max_bytes:
+            return columns
+
+        with self.__lock:
+            if key not in self.__entries:
+                self.__entries[key] = columns
+                self.__bytes += size
+            while self.__bytes > self.__max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__bytes -= sum(column.nbytes for column in evicted.values())
+                self.__evictions += 1
+        return columns
+
+    def __reduce__(self):
+        # Al pasar un analyzer a otro proceso (backtests con Pool) se usa la cache de ese proceso
+        return IndicatorCache, ()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def get_stats(self) -> dict:
+        """Entradas, memoria usada, aciertos, fallos y expulsiones"""
+
+        with self.__lock:
+            return {"entries": len(self.__entries), "bytes": self.__bytes, "max_bytes": self.__max_bytes,
+                    "hits": self.__hits, "misses": self.__misses, "evictions": self.__evictions}
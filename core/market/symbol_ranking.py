@@ -0,0 +1,165 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Symbol Ranking - Scan priority of symbols by liquidity and recent volatility]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import json
+import math
+import threading
+
+from datetime import datetime
+from dateutil import parser
+from os import environ
+from typing import Dict, List
+
+from core.candles.candlestick import Candlestick
+from core.utils.redisclient import RedisClient
+
+
+class SymbolScore:
+    """Volumen en USDT estimado a 24h y volatilidad realizada (desviacion de los retornos por minuto) de un symbol"""
+    def __init__(self, quote_volume_24h: float = None, volatility: float = None, updated: datetime = None):
+        """Default constructor"""
+        self.quote_volume_24h: float = quote_volume_24h
+        self.volatility: float = volatility
+        self.updated: datetime = updated
+
+    def to_json(self) -> str:
+        return json.dumps({"quote_volume_24h": self.quote_volume_24h, "volatility": self.volatility,
+                           "updated": self.updated.isoformat() if self.updated is not None else None})
+
+    @staticmethod
+    def from_json(value) -> 'SymbolScore':
+        score_dict = json.loads(value)
+        return SymbolScore(score_dict.get("quote_volume_24h"), score_dict.get("volatility"),
+                           parser.parse(score_dict["updated"]) if score_dict.get("updated") else None)
+
+
+class SymbolRanking:
+    """Prioridad de escaneo de los symbols: primero los mas liquidos y volatiles, que son los que dan la mayoria de
+    señales. Las puntuaciones se actualizan de forma incremental (media exponencial) con las velas que ya se
+    descargan en cada escaneo, y se comparten en Redis entre workers y analyzers"""
+
+    def __init__(self, alpha: float = 0.2, volatility_weight: float = 0.5, cold_fraction: float = 0.3,
+                 time_budget_seconds: float = None):
+        """Default constructor
+        Args:
+            alpha: Peso de cada nueva observacion en la media exponencial
+            volatility_weight: Peso de la volatilidad frente al volumen en la prioridad (0..1)
+            cold_fraction: Fraccion de symbols de menor prioridad que se saltan al agotar el presupuesto de tiempo
+            time_budget_seconds: Segundos de escaneo a partir de los cuales se saltan los symbols frios.
+                Por defecto, variable de entorno SCAN_TIME_BUDGET_SECONDS (sin presupuesto si no existe)
+        """
+
+        self.__redis_client = RedisClient()
+        self.__redis_key = "SYMBOL_RANKING"
+        self.__alpha = alpha
+        self.__volatility_weight = volatility_weight
+        self.__cold_fraction = cold_fraction
+        if time_budget_seconds is None and environ.get("SCAN_TIME_BUDGET_SECONDS"):
+            time_budget_seconds = float(environ.get("SCAN_TIME_BUDGET_SECONDS"))
+        self.__time_budget_seconds = time_budget_seconds
+
+        self.__lock = threading.Lock()
+        self.__scores: Dict[str, SymbolScore] = dict()
+        self.__priorities: Dict[str, float] = dict()
+        self.__pending_updates: Dict[str, SymbolScore] = dict()
+
+    def order(self, symbols: List[str]) -> List[str]:
+        """Symbols ordenados por prioridad. Los que aun no tienen puntuacion van primero, para puntuarlos cuanto
+        antes; a igual prioridad se mantiene el orden original"""
+
+        scores = {field.decode(): SymbolScore.from_json(value)
+                  for field, value in self.__redis_client.get_hash_values(self.__redis_key).items()}
+        priorities = self.__compute_priorities(scores)
+
+        with self.__lock:
+            self.__scores = scores
+            self.__priorities = priorities
+
+        return sorted(symbols, key=lambda symbol: -priorities.get(symbol, 2))
+
+    def is_cold(self, symbol: str) -> bool:
+        """True si el symbol esta en la fraccion de menor prioridad"""
+
+        priority = self.__priorities.get(symbol)
+        return priority is not None and priority < self.__cold_fraction
+
+    def should_skip(self, symbol: str, scan_start_time: datetime) -> bool:
+        """True si se ha agotado el presupuesto de tiempo del escaneo y el symbol es frio"""
+
+        if self.__time_budget_seconds is None:
+            return False
+        elapsed = (datetime.utcnow() - scan_start_time).total_seconds()
+        return elapsed > self.__time_budget_seconds and self.is_cold(symbol)
+
+    def update(self, symbol: str, candles: List[Candlestick]):
+        """Actualiza la puntuacion del symbol con las velas escaneadas. Se guarda en Redis con flush()"""
+
+        closed_candles = candles[:-1]  # La ultima vela aun no ha cerrado
+        if len(closed_candles) < 2:
+            return
+
+        minutes = (closed_candles[-1].close_time - closed_candles[0].open_time).total_seconds() / 60
+        if minutes <= 0:
+            return
+        quote_volume_24h = sum(candle.quote_asset_volume for candle in closed_candles) * 1440 / minutes
+
+        returns = [math.log(current.close_price / previous.close_price)
+                   for previous, current in zip(closed_candles[:-1], closed_candles[1:])
+                   if previous.close_price > 0 and current.close_price > 0]
+        if len(returns) < 2:
+            return
+        mean_return = sum(returns) / len(returns)
+        interval_minutes = minutes / len(closed_candles)
+        volatility = math.sqrt(sum((value - mean_return) ** 2 for value in returns) / (len(returns) - 1)
+                               / interval_minutes)
+
+        with self.__lock:
+            previous_score = self.__pending_updates.get(symbol) or self.__scores.get(symbol)
+            if previous_score is not None and previous_score.quote_volume_24h is not None:
+                quote_volume_24h = self.__alpha * quote_volume_24h + (1 - self.__alpha) * previous_score.quote_volume_24h
+                volatility = self.__alpha * volatility + (1 - self.__alpha) * previous_score.volatility
+            self.__pending_updates[symbol] = SymbolScore(quote_volume_24h, volatility, datetime.utcnow())
+
+    def flush(self):
+        """Guarda en Redis, en una unica escritura, las puntuaciones actualizadas en el escaneo"""
+
+        with self.__lock:
+            pending_updates = self.__pending_updates
+            self.__pending_updates = dict()
+            self.__scores.update(pending_updates)
+
+        self.__redis_client.save_hash_values(self.__redis_key, {symbol: score.to_json()
+                                                                for symbol, score in pending_updates.items()})
+
+    def get_priorities(self) -> Dict[str, float]:
+        """Prioridad (0..1) de cada symbol puntuado en el ultimo order()"""
+        return dict(self.__priorities)
+
+    def __compute_priorities(self, scores: Dict[str, SymbolScore]) -> Dict[str, float]:
+        """Media ponderada de los percentiles de volumen y de volatilidad de cada symbol"""
+
+        scored = [symbol for symbol, score in scores.items()
+                  if score.quote_volume_24h is not None and score.volatility is not None]
+        if not scored:
+            return dict()
+
+        volume_ranks = self.__percentile_ranks(scored, lambda symbol: scores[symbol].quote_volume_24h)
+        volatility_ranks = self.__percentile_ranks(scored, lambda symbol: scores[symbol].volatility)
+        return {symbol: (1 - self.__volatility_weight) * volume_ranks[symbol] +
+                        self.__volatility_weight * volatility_ranks[symbol]
+                for symbol in scored}
+
+    @staticmethod
+    def __percentile_ranks(symbols: List[str], value) -> Dict[str, float]:
+        ordered = sorted(symbols, key=value)
+        if len(ordered) == 1:
+            return {ordered[0]: 1.0}
+        return {symbol: index / (len(ordered) - 1) for index, symbol in enumerate(ordered)}
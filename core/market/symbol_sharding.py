@@ -0,0 +1,169 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Symbol Sharding - Partition of the symbol universe between scan requests by consistent hashing]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import bisect
+import hashlib
+import logging
+import threading
+
+from datetime import datetime
+from typing import Dict, List
+
+from core.order.moby_order import MobyOrder
+from core.utils.redisclient import RedisClient
+from core.utils.utils import datetime_utc_to_unix_time
+
+
+class ConsistentHashRing:
+    """Anillo de hash consistente: al cambiar el numero de nodos solo se mueven ~1/N de las claves"""
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = 100):
+        """Default constructor
+        Args:
+            nodes: Nombres de los nodos
+            virtual_nodes: Replicas de cada nodo en el anillo, para repartir de forma uniforme
+        """
+
+        if not nodes:
+            raise Exception("El anillo necesita al menos un nodo")
+
+        ring = sorted((self.__hash(node + "#" + str(replica)), node)
+                      for node in nodes for replica in range(virtual_nodes))
+        self.__hashes = [ring_hash for ring_hash, node in ring]
+        self.__nodes = [node for ring_hash, node in ring]
+
+    def get_node(self, key: str) -> str:
+        """Nodo al que pertenece la clave: el primero del anillo a partir de su hash"""
+
+        index = bisect.bisect(self.__hashes, self.__hash(key)) % len(self.__hashes)
+        return self.__nodes[index]
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class SymbolSharding:
+    """Reparte los symbols de un escaneo entre shards (peticiones de cron independientes, servidas por distintos
+    workers o instancias). El mapa de particion se guarda en Redis y se recalcula al cambiar el listado de symbols,
+    y los resultados de todos los shards se publican en un stream comun de Redis"""
+
+    def __init__(self, scan_name: str, virtual_nodes: int = 100, stream_max_length: int = 10000):
+        """Default constructor
+        Args:
+            scan_name: Nombre del escaneo (ej: "Analyzer5"), para las claves de Redis
+            virtual_nodes: Replicas de cada shard en el anillo
+            stream_max_length: Entradas aproximadas que se conservan en el stream de resultados
+        """
+
+        self.__redis_client = RedisClient()
+        self.__scan_name = scan_name
+        self.__partition_map_key = "SHARD_MAP_" + scan_name
+        self.__results_stream_key = "SCAN_RESULTS_" + scan_name
+        self.__virtual_nodes = virtual_nodes
+        self.__stream_max_length = stream_max_length
+
+        self.__lock = threading.Lock()
+        self.__signature: str = None
+        self.__assignment: Dict[str, int] = dict()
+
+    def get_shard_symbols(self, symbols: List[str], shard: int, shards: int) -> List[str]:
+        """Symbols del listado que corresponden al shard, en el mismo orden del listado"""
+
+        if shard is None or shards < 1 or not 0 <= shard < shards:
+            raise Exception("Shard invalido: " + str(shard) + " de " + str(shards))
+
+        assignment = self.get_partition_map(symbols, shards)
+        return [symbol for symbol in symbols if assignment[symbol] == shard]
+
+    def get_partition_map(self, symbols: List[str], shards: int) -> Dict[str, int]:
+        """Shard de cada symbol. Se reutiliza mientras no cambien los symbols ni el numero de shards"""
+
+        signature = hashlib.md5((",".join(sorted(symbols)) + "|" + str(shards)).encode()).hexdigest()
+
+        with self.__lock:
+            if signature == self.__signature:
+                return self.__assignment
+
+            stored = self.__redis_client.get_dict(self.__partition_map_key, serialization="json")
+            if stored.get("signature") == signature:
+                assignment = stored["assignment"]
+            else:
+                assignment = self.__rebalance(symbols, shards, stored.get("assignment", dict()), signature)
+
+            self.__signature = signature
+            self.__assignment = assignment
+            return assignment
+
+    def publish_signal(self, shard: int, moby_order: MobyOrder):
+        """Publica una entrada encontrada en el stream de resultados"""
+
+        self.__redis_client.add_to_stream(self.__results_stream_key, {
+            "type": "signal",
+            "shard": shard,
+            "ticker": moby_order.ticker,
+            "order_label": moby_order.order_label,
+            "position": moby_order.position.value if moby_order.position is not None else "",
+            "order_price": moby_order.order_price if moby_order.order_price is not None else ""
+        }, max_length=self.__stream_max_length)
+
+    def publish_scan(self, shard: int, shards: int, symbols: int, signals: int, start_time: datetime):
+        """Publica el resumen del escaneo de un shard en el stream de resultados"""
+
+        self.__redis_client.add_to_stream(self.__results_stream_key, {
+            "type": "scan",
+            "shard": shard,
+            "shards": shards,
+            "symbols": symbols,
+            "signals": signals,
+            "seconds": round((datetime.utcnow() - start_time).total_seconds(), 3)
+        }, max_length=self.__stream_max_length)
+
+    def get_results(self, since: datetime, count: int = None) -> List[dict]:
+        """Resultados de todos los shards publicados desde since"""
+
+        min_id = str(int(datetime_utc_to_unix_time(since) * 1000))
+        return [{key.decode(): value.decode() for key, value in fields.items()}
+                for entry_id, fields in self.__redis_client.get_stream_entries(self.__results_stream_key, min_id=min_id,
+                                                                               count=count)]
+
+    def __rebalance(self, symbols: List[str], shards: int, previous_assignment: Dict[str, int],
+                    signature: str) -> Dict[str, int]:
+        """Recalcula y guarda el mapa de particion. Con hash consistente solo cambian de shard los symbols
+        necesarios"""
+
+        ring = ConsistentHashRing([str(shard) for shard in range(shards)], self.__virtual_nodes)
+        assignment = {symbol: int(ring.get_node(symbol)) for symbol in symbols}
+
+        moved = sum(1 for symbol, shard in assignment.items()
+                    if symbol in previous_assignment and previous_assignment[symbol] != shard)
+        logging.warning("Reparto de {0}: {1} symbols en {2} shards, {3} cambian de shard".format(
+            self.__scan_name, len(symbols), shards, moved))
+
+        self.__redis_client.save_dict(self.__partition_map_key, {"signature": signature,
+                                                                 "shards": shards,
+                                                                 "assignment": assignment},
+                                      serialization="json")
+        return assignment
+
+
+# Local Testing
+if __name__ == "__main__":
+    symbols_to_split = ["SYMBOL" + str(i) + "USDT" for i in range(200)]
+
+    ring_3 = ConsistentHashRing(["0", "1", "2"])
+    ring_4 = ConsistentHashRing(["0", "1", "2", "3"])
+    shard_sizes = dict()
+    for symbol_to_split in symbols_to_split:
+        shard_sizes[ring_4.get_node(symbol_to_split)] = shard_sizes.get(ring_4.get_node(symbol_to_split), 0) + 1
+    print("Reparto en 4 shards:", shard_sizes)
+    print("Movidos de 3 a 4 shards:", sum(1 for symbol_to_split in symbols_to_split
+                                          if ring_3.get_node(symbol_to_split) != ring_4.get_node(symbol_to_split)))
@@ -10,8 +10,9 @@
 # Version: 0.1
 #
 import json
+import logging
 from enum import Enum
-from typing import List
+from typing import Dict, List
 
 import pandas as pd
 import numpy as np
@@ -22,7 +23,11 @@ from ta.trend import ADXIndicator, SMAIndicator
 from ta.volatility import DonchianChannel, BollingerBands, KeltnerChannel, AverageTrueRange
 
 from core.candles.binance_client import BinanceClient
-from core.candles.candlestick import Candlestick, TAData, PriceZone
+from core.candles.candle_series import CandleSeries
+from core.candles.candlestick import Candlestick, IndicatorFrame, PriceZone
+from core.candles.resampler import INTERVAL_MINUTES, MultiTimeframeLoader
+from core.market import trend_matrix
+from core.market.indicator_cache import IndicatorCache
 
 np.seterr(invalid='ignore')
 
@@ -40,6 +45,7 @@ class TechnicalIndicators:
         """Default constructor"""
 
         self.__binance_client = BinanceClient()
+        self.__indicator_cache = IndicatorCache()
 
     def get_trend(self, coin: str, num_periods_sma=30, interval="5m", adx_min=25) -> Trend:
         """Obtiene tendencia (bajista, alcista, o lateral), descargando velas de Binance API"""
@@ -47,6 +53,48 @@ class TechnicalIndicators:
         periods = self.__binance_client.get_last_candlesticks(coin, 200, interval)  # 200 for ADX
         return self.get_trend_from_periods(periods, num_periods_sma, adx_min)
 
+    def get_trends(self, coins: List[str], num_periods_sma=30, interval="5m", adx_min=25,
+                   candles_loader: MultiTimeframeLoader = None, refresh: bool = True) -> Dict[str, Trend]:
+        """Tendencia de muchas monedas a la vez: una matriz (monedas x 200 velas) y SMA, ADX y clasificacion en
+        operaciones 2D de numpy. Mismo resultado que get_trend moneda a moneda; cacheado por ultima vela, asi que
+        los analyzers que lo piden en el mismo tick lo comparten. Las monedas sin velas suficientes no se incluyen.
+        Con refresh=False se usan las series ya cargadas en candles_loader, sin descargar nada"""
+
+        symbols = list()
+        series_list = list()
+        for coin in coins:
+            try:
+                if candles_loader is not None and not refresh:
+                    resampler = candles_loader.get_resampler(coin)
+                    if resampler is None:
+                        continue
+                    series = resampler.get_series(interval).tail(200)
+                elif candles_loader is not None:
+                    series = candles_loader.refresh(coin, 200 * INTERVAL_MINUTES[interval] + INTERVAL_MINUTES[interval])\
+                        .get_series(interval).tail(200)
+                else:
+                    series = CandleSeries.from_candles(coin, self.__binance_client.get_last_candlesticks(coin, 200, interval))
+            except Exception as e:
+                logging.exception("Error obteniendo velas de " + coin + ". " + repr(e))
+                continue
+            if len(series) == 200:
+                symbols.append(coin)
+                series_list.append(series)
+
+        if not symbols:
+            return dict()
+
+        trends = trend_matrix.get_trends(symbols,
+                                         np.stack([series.open_time for series in series_list]),
+                                         np.stack([series.high_price for series in series_list]),
+                                         np.stack([series.low_price for series in series_list]),
+                                         np.stack([series.close_price for series in series_list]),
+                                         interval, num_periods_sma, adx_min)
+
+        trend_names = {trend_matrix.TREND_UNKNOWN: Trend.UNKNOWN, trend_matrix.TREND_UPTREND: Trend.UPTREND,
+                       trend_matrix.TREND_DOWNTREND: Trend.DOWNTREND}
+        return {coin: trend_names[trend] for coin, trend in trends.items()}
+
     def get_trend_from_periods(self, periods: List[Candlestick], num_periods_sma=30, adx_min=25) -> Trend:
         """Obtiene tendencia (bajista, alcista, o lateral)"""
 
@@ -74,25 +122,20 @@ class TechnicalIndicators:
 
     def generate_all_technical_indicators(self, periods: List[Candlestick], num_periods_sma: int = 30):
         """Llama a todos los generate() de esta clase para enriquecer las velas"""
-        technical_indicators.generate_simple_moving_average(periods, num_periods_sma)
-        technical_indicators.generate_average_true_range(periods)
-        technical_indicators.generate_average_directional_index(periods)
-        technical_indicators.generate_donchian_channel(periods)
-        technical_indicators.generate_bollinger_bands(periods)
-        technical_indicators.generate_keltner_channel(periods)
+        self.generate_simple_moving_average(periods, num_periods_sma)
+        self.generate_average_true_range(periods)
+        self.generate_average_directional_index(periods)
+        self.generate_donchian_channel(periods)
+        self.generate_bollinger_bands(periods)
+        self.generate_keltner_channel(periods)
 
     def generate_simple_moving_average(self, periods: List[Candlestick], num_periods: int):
         """SMA: Media Simple Móvil"""
 
-        close = pd.Series([p.close_price for p in periods])
+        def compute(close):
+            return {"sma": SMAIndicator(pd.Series(close), num_periods).sma_indicator().values}
 
-        sma_series = SMAIndicator(close, num_periods).sma_indicator()
-
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.sma = sma_series[i]
+        self.__generate(periods, "sma", (num_periods,), ["close_price"], compute)
 
     def generate_average_directional_index(self, periods: List[Candlestick]):
         """ADX: Indice medio de movimiento direccional"""
@@ -100,16 +143,10 @@ class TechnicalIndicators:
         if len(periods) < 200:
             raise Exception("Hacen falta al menos 200 velas para calcular el ADX")
 
-        high = pd.Series([p.high_price for p in periods])
-        low = pd.Series([p.low_price for p in periods])
-        close = pd.Series([p.close_price for p in periods])
+        def compute(high, low, close):
+            return {"adx": ADXIndicator(pd.Series(high), pd.Series(low), pd.Series(close)).adx().values}
 
-        adx_series = ADXIndicator(high, low, close).adx()
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.adx = adx_series[i]
+        self.__generate(periods, "adx", (), ["high_price", "low_price", "close_price"], compute)
 
     def generate_average_true_range(self, periods: List[Candlestick], window: int = 14):
         """ATR: Rango Verdadero Medio"""
@@ -117,16 +154,11 @@ class TechnicalIndicators:
         if len(periods) < 20:
             raise Exception("Hacen falta al menos 20 velas para calcular el ATR")
 
-        high = pd.Series([p.high_price for p in periods])
-        low = pd.Series([p.low_price for p in periods])
-        close = pd.Series([p.close_price for p in periods])
+        def compute(high, low, close):
+            return {"atr": AverageTrueRange(pd.Series(high), pd.Series(low), pd.Series(close),
+                                            window).average_true_range().values}
 
-        atr_series = AverageTrueRange(high, low, close, window).average_true_range()
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.atr = atr_series[i]
+        self.__generate(periods, "atr", (window,), ["high_price", "low_price", "close_price"], compute)
 
     def generate_donchian_channel(self, periods: List[Candlestick], num_periods=20):
         """Generate bands and infers if price is in resistance or support zone by using Donchian Channel"""
@@ -137,29 +169,14 @@ class TechnicalIndicators:
         # TODO afinar este porcentaje
         zone_width = 0.05  # 5% close to the limit to be considered support or resistance
 
-        high = pd.Series([p.high_price for p in periods])
-        low = pd.Series([p.low_price for p in periods])
-        close = pd.Series([p.close_price for p in periods])
-
-        channel = DonchianChannel(high, low, close, window=num_periods)
-        high_band = channel.donchian_channel_hband()
-        low_band = channel.donchian_channel_lband()
-        percentage_band = channel.donchian_channel_pband()
-
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.donchian_high_band = high_band[i]
-            period.technical_indicators.donchian_low_band = low_band[i]
-
-            price_percentage = percentage_band[i]
-            if price_percentage < zone_width:
-                period.technical_indicators.donchian_price_zone = PriceZone.SUPPORT
-            elif price_percentage > 1 - zone_width:
-                period.technical_indicators.donchian_price_zone = PriceZone.RESISTANCE
-            else:
-                period.technical_indicators.donchian_price_zone = PriceZone.UNKNOWN
+        def compute(high, low, close):
+            channel = DonchianChannel(pd.Series(high), pd.Series(low), pd.Series(close), window=num_periods)
+            return {"donchian_high_band": channel.donchian_channel_hband().values,
+                    "donchian_low_band": channel.donchian_channel_lband().values,
+                    "donchian_price_zone": self.__price_zones(channel.donchian_channel_pband().values, zone_width)}
+
+        self.__generate(periods, "donchian", (num_periods, zone_width), ["high_price", "low_price", "close_price"],
+                        compute)
 
     def generate_bollinger_bands(self, periods: List[Candlestick]):
         """Generate bands and infers if price is in resistance or support zone by using Bollinger Bands"""
@@ -170,29 +187,14 @@ class TechnicalIndicators:
         # TODO afinar este porcentaje
         zone_width = 0.05  # 5% close to the limit to be considered support or resistance
 
-        close = pd.Series([p.close_price for p in periods])
-
-        bands = BollingerBands(close)
-        high_band = bands.bollinger_hband()
-        middle_band = bands.bollinger_mavg()
-        low_band = bands.bollinger_lband()
-        percentage_band = bands.bollinger_pband()
-
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.bollinger_high_band = high_band[i]
-            period.technical_indicators.bollinger_middle_band = middle_band[i]
-            period.technical_indicators.bollinger_low_band = low_band[i]
-
-            price_percentage = percentage_band[i]
-            if price_percentage < zone_width:
-                period.technical_indicators.bollinger_price_zone = PriceZone.SUPPORT
-            elif price_percentage > 1 - zone_width:
-                period.technical_indicators.bollinger_price_zone = PriceZone.RESISTANCE
-            else:
-                period.technical_indicators.bollinger_price_zone = PriceZone.UNKNOWN
+        def compute(close):
+            bands = BollingerBands(pd.Series(close))
+            return {"bollinger_high_band": bands.bollinger_hband().values,
+                    "bollinger_middle_band": bands.bollinger_mavg().values,
+                    "bollinger_low_band": bands.bollinger_lband().values,
+                    "bollinger_price_zone": self.__price_zones(bands.bollinger_pband().values, zone_width)}
+
+        self.__generate(periods, "bollinger", (zone_width,), ["close_price"], compute)
 
     def generate_keltner_channel(self, periods: List[Candlestick]):
         """Generate bands and infers if price is in resistance or support zone by using Keltner Channel"""
@@ -202,29 +204,39 @@ class TechnicalIndicators:
 
         zone_width = 0.05  # 5% close to the limit to be considered support or resistance
 
-        high = pd.Series([p.high_price for p in periods])
-        low = pd.Series([p.low_price for p in periods])
-        close = pd.Series([p.close_price for p in periods])
+        def compute(high, low, close):
+            channel = KeltnerChannel(pd.Series(high), pd.Series(low), pd.Series(close))
+            return {"keltner_high_band": channel.keltner_channel_hband().values,
+                    "keltner_low_band": channel.keltner_channel_lband().values,
+                    "keltner_price_zone": self.__price_zones(channel.keltner_channel_pband().values, zone_width)}
+
+        self.__generate(periods, "keltner", (zone_width,), ["high_price", "low_price", "close_price"], compute)
+
+    def __generate(self, periods: List[Candlestick], indicator: str, params: tuple, input_names: List[str], compute):
+        """Columnas del indicador, de la IndicatorCache si ya se calcularon sobre las mismas velas (en otro analyzer
+        o en otra lista con las mismas velas), asignadas al IndicatorFrame de las velas"""
+
+        if not periods:
+            return
+
+        inputs = {name: np.array([getattr(p, name) for p in periods], dtype=np.float64) for name in input_names}
+        fingerprint = IndicatorCache.fingerprint(periods[0].ticker, periods[0].open_time, periods[-1].open_time,
+                                                 inputs)
+        columns = self.__indicator_cache.get_or_compute(fingerprint, indicator, params,
+                                                        lambda: compute(*[inputs[name] for name in input_names]))
 
-        channel = KeltnerChannel(high, low, close)
-        high_band = channel.keltner_channel_hband()
-        low_band = channel.keltner_channel_lband()
-        percentage_band = channel.keltner_channel_pband()
+        frame = IndicatorFrame.attach(periods)
+        for name, values in columns.items():
+            frame.set(name, values)
 
-        for i in range(len(periods)):
-            period = periods[i]
-            if not period.technical_indicators:
-                period.technical_indicators = TAData()
-            period.technical_indicators.keltner_high_band = high_band[i]
-            period.technical_indicators.keltner_low_band = low_band[i]
+    @staticmethod
+    def __price_zones(percentage_band: np.ndarray, zone_width: float) -> np.ndarray:
+        """Codigos (IndicatorFrame.zone_codes) de la zona de precio de cada vela segun su posicion en la banda"""
 
-            price_percentage = percentage_band[i]
-            if price_percentage < zone_width:
-                period.technical_indicators.keltner_price_zone = PriceZone.SUPPORT
-            elif price_percentage > 1 - zone_width:
-                period.technical_indicators.keltner_price_zone = PriceZone.RESISTANCE
-            else:
-                period.technical_indicators.keltner_price_zone = PriceZone.UNKNOWN
+        zones = np.full(len(percentage_band), IndicatorFrame.zone_codes.index(PriceZone.UNKNOWN), dtype=np.int8)
+        zones[percentage_band > 1 - zone_width] = IndicatorFrame.zone_codes.index(PriceZone.RESISTANCE)
+        zones[percentage_band < zone_width] = IndicatorFrame.zone_codes.index(PriceZone.SUPPORT)
+        return zones
 
 
 # Local Testing
@@ -235,6 +247,6 @@ if __name__ == "__main__":
 
     periods_test = BinanceClient().get_last_candlesticks("XRPUSDT", num_candlesticks=200, interval="1m")
     technical_indicators.generate_all_technical_indicators(periods_test)
-    print(json.dumps(periods_test[-1].technical_indicators.__dict__, indent=4))
+    print(json.dumps(periods_test[-1].technical_indicators.to_dict(), indent=4))
 
 
@@ -0,0 +1,128 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Trend Matrix - SMA, ADX and trend of many symbols at once over a (symbols x bars) matrix]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import threading
+
+from typing import Dict, List
+
+import numpy as np
+
+TREND_UNKNOWN = 0
+TREND_UPTREND = 1
+TREND_DOWNTREND = 2
+
+_cache: Dict[tuple, int] = dict()
+_cache_lock = threading.Lock()
+_cache_max_entries = 20000
+
+
+def sma_last(close: np.ndarray, window: int) -> np.ndarray:
+    """SMA de la ultima vela de cada fila"""
+    return close[:, -window:].mean(axis=1)
+
+
+def adx(high: np.ndarray, low: np.ndarray, close: np.ndarray, window: int = 14) -> np.ndarray:
+    """ADX de cada fila (symbol), igual que ADXIndicator(high, low, close, window).adx() de ta 0.8.0 (mismas
+    operaciones en el mismo orden, incluidas sus particularidades), vectorizado entre symbols"""
+
+    rows, bars = close.shape
+    length = bars - (window - 1)
+
+    # True range. La primera vela no tiene cierre anterior: ta la descarta (dropna)
+    close_shift = close[:, :-1]
+    diff_directional_movement = np.concatenate((np.full((rows, 1), np.nan),
+                                                np.maximum(high[:, 1:], close_shift) - np.minimum(low[:, 1:], close_shift)),
+                                               axis=1)
+
+    diff_up = high[:, 1:] - high[:, :-1]
+    diff_down = low[:, :-1] - low[:, 1:]
+    pos = np.abs(((diff_up > diff_down) & (diff_up > 0)) * diff_up)  # pos[:, i] es la vela i + 1
+    neg = np.abs(((diff_down > diff_up) & (diff_down > 0)) * diff_down)
+
+    trs = np.zeros((rows, length))
+    dip = np.zeros((rows, length))
+    din = np.zeros((rows, length))
+    trs[:, 0] = diff_directional_movement[:, 1:window + 1].sum(axis=1)
+    dip[:, 0] = pos[:, 0:window].sum(axis=1)
+    din[:, 0] = neg[:, 0:window].sum(axis=1)
+
+    # Suavizado de Wilder. Como en ta, la ultima posicion se queda a 0
+    for i in range(1, length - 1):
+        trs[:, i] = trs[:, i - 1] - (trs[:, i - 1] / float(window)) + diff_directional_movement[:, window + i]
+        dip[:, i] = dip[:, i - 1] - (dip[:, i - 1] / float(window)) + pos[:, window + i - 1]
+        din[:, i] = din[:, i - 1] - (din[:, i - 1] / float(window)) + neg[:, window + i - 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dip = 100 * (dip / trs)
+        din = 100 * (din / trs)
+        directional_index = 100 * np.abs((dip - din) / (dip + din))
+
+    adx_values = np.zeros((rows, length))
+    adx_values[:, window] = directional_index[:, 0:window].mean(axis=1)
+    for i in range(window + 1, length):
+        adx_values[:, i] = ((adx_values[:, i - 1] * (window - 1)) + directional_index[:, i - 1]) / float(window)
+
+    return np.concatenate((np.zeros((rows, window - 1)), adx_values), axis=1)
+
+
+def classify_trends(high: np.ndarray, low: np.ndarray, close: np.ndarray, num_periods_sma: int = 30,
+                    adx_min: float = 25) -> np.ndarray:
+    """Tendencia de cada fila (TREND_*), con las mismas reglas que TechnicalIndicators.get_trend_from_periods"""
+
+    if close.shape[1] < 200:
+        raise Exception("Hacen falta al menos 200 velas para calcular el ADX")
+
+    sma = sma_last(close, num_periods_sma)
+    adx_values = adx(high, low, close)
+    adx1 = adx_values[:, -1]
+    adx2 = adx_values[:, -2]
+    adx3 = adx_values[:, -3]
+
+    # Only strong Trend: [20,30] < ADX < 60, and increasing
+    strong = ~((adx1 < adx_min) | (adx1 > 60) | ((adx1 < adx2) & (adx2 < adx3)))
+
+    uptrend = (low[:, -1] > sma) & (low[:, -2] > sma)
+    downtrend = (high[:, -1] < sma) & (high[:, -2] < sma)
+
+    trends = np.full(close.shape[0], TREND_UNKNOWN, dtype=np.int8)
+    trends[strong & downtrend] = TREND_DOWNTREND
+    trends[strong & uptrend] = TREND_UPTREND
+    return trends
+
+
+def get_trends(symbols: List[str], open_time: np.ndarray, high: np.ndarray, low: np.ndarray, close: np.ndarray,
+               interval: str, num_periods_sma: int = 30, adx_min: float = 25) -> Dict[str, int]:
+    """Tendencia (TREND_*) de cada symbol. Cacheada en el proceso por (symbol, intervalo, parametros, ultima vela):
+    los analyzers que evaluan el mismo intervalo en el mismo tick solo la calculan una vez"""
+
+    keys = [(symbol, interval, num_periods_sma, adx_min, int(open_time[row, -1]), float(close[row, -1]),
+             float(high[row, -1]), float(low[row, -1]))
+            for row, symbol in enumerate(symbols)]
+
+    trends = dict()
+    missing_rows = list()
+    for row, key in enumerate(keys):
+        trend = _cache.get(key)
+        if trend is None:
+            missing_rows.append(row)
+        else:
+            trends[symbols[row]] = trend
+
+    if missing_rows:
+        computed = classify_trends(high[missing_rows], low[missing_rows], close[missing_rows], num_periods_sma, adx_min)
+        with _cache_lock:
+            if len(_cache) > _cache_max_entries:
+                _cache.clear()
+            for row, trend in zip(missing_rows, computed.tolist()):
+                _cache[keys[row]] = trend
+                trends[symbols[row]] = trend
+
+    return trends
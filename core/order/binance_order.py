@@ -11,14 +11,17 @@
 #
 
 import logging
-import time
 import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from google.cloud import bigquery
 
+from core.account.account_state import AccountState
 from core.alerts.telegram import Telegram
 from core.candles.binance_client import BinanceClient
+from core.candles.symbols_cache import SymbolsCache
 from core.order.moby_order import MobyOrder, OrderPosition, OrderMode, OrderStatus
 
 
@@ -34,7 +37,13 @@ class BinanceOrder:
         #self.__bq_client = bigquery.Client(project="fender-310315")
         #self.__bq_table_moby_order = self.__bq_client.get_table(self.__bq_client.dataset("MobyDick").table("MobyOrderReal"))
 
-        self.__all_symbols = self.__binance_client.get_all_available_symbols()
+        self.__symbols_cache = SymbolsCache()
+        self.__account_state = AccountState(self.__binance_client, account if account is not None else "testnet")
+        self.__close_orders_executor = ThreadPoolExecutor(max_workers=2)
+
+    def refresh_account_state(self):
+        """Refresca posiciones, ordenes abiertas y apalancamientos de la cuenta. Llamar al inicio de cada escaneo"""
+        self.__account_state.refresh()
 
     def open_position(self, moby_order: MobyOrder):
         """Open a position over Binance Futures and protect if with Stoploss and Trailing Stop"""
@@ -57,27 +66,36 @@ class BinanceOrder:
         if moby_order.take_profit_percent is not None and moby_order.take_profit_percent <= 0:
             raise Exception("Order Error: Take profit debe ser positivo")
 
-        # Esta comprobación mejor la última, pues conlleva una llamada al API
-        if self.__binance_client.is_position_open(moby_order.ticker):
+        # Comprobación contra el snapshot de la cuenta (se refresca solo si ha caducado)
+        if self.__account_state.is_position_open(moby_order.ticker):
             logging.warning("Ya hay una ordern abierta sobre " + moby_order.ticker)
             return
 
+        # Otro worker puede estar abriendo la misma posicion desde el ultimo refresco
+        if not self.__account_state.claim_symbol(moby_order.ticker):
+            logging.warning("Ya se está abriendo una orden sobre " + moby_order.ticker)
+            return
+
         # 1. Registro en BQ
         moby_order.status = OrderStatus.Created
         moby_order.order_mode = OrderMode.Real
         self.__send_order_to_bq(moby_order)
 
-        # 2. Borramos las anteriores ordenes de cierre residuales
-        self.__binance_client.delete_orders_of(moby_order.ticker)
+        # 2. Borramos las anteriores ordenes de cierre residuales, si las hay
+        if self.__account_state.has_open_orders(moby_order.ticker):
+            self.__binance_client.delete_orders_of(moby_order.ticker)
+            self.__account_state.mark_orders_deleted(moby_order.ticker)
 
-        quantity_precision = self.__all_symbols[moby_order.ticker]["quantityPrecision"]
-        price_precision = self.__all_symbols[moby_order.ticker]["pricePrecision"]
+        symbol_info = self.__symbols_cache.get_symbol_info(moby_order.ticker)
+        price_precision = symbol_info.price_precision
 
         quantity_to_buy = (moby_order.quantity / moby_order.order_price) * moby_order.leverage
-        quantity_to_buy = round(quantity_to_buy, quantity_precision)
+        quantity_to_buy = symbol_info.round_quantity(quantity_to_buy)
 
-        # 3. Establecemos el apalancamiento
-        self.__binance_client.set_leverage(moby_order.ticker, moby_order.leverage)
+        # 3. Establecemos el apalancamiento, si no es ya el configurado
+        if self.__account_state.get_leverage(moby_order.ticker) != moby_order.leverage:
+            self.__binance_client.set_leverage(moby_order.ticker, moby_order.leverage)
+            self.__account_state.mark_leverage(moby_order.ticker, moby_order.leverage)
 
         # 4. Abrimos posicion
         try:
@@ -86,9 +104,9 @@ class BinanceOrder:
             self.__telegram.send_message_to_group_1(moby_order.ticker + " Error abriendo posicion: " + repr(e))
             raise e
         real_entry_price = float(entry["avgPrice"])
+        self.__account_state.mark_position_opened(moby_order.ticker, quantity_to_buy)
 
-        # 5. Esperamos un poco antes de lanzar los stops
-        time.sleep(1)
+        # 5. Con newOrderRespType=RESULT la orden market ya está ejecutada, lanzamos los stops sin esperar
 
         # 6. Trailing Stop Price
         if moby_order.trailing_stop_activation_price is None and moby_order.trailing_stop_activation_percent is not None:
@@ -107,28 +125,33 @@ class BinanceOrder:
                                 "] Order Error: El precio de stoploss es inválido, saltaría de inmediado")
 
             # 9.1 Stoploss
-
-            self.__binance_client.make_stoploss_order(moby_order.ticker, stoploss_price, is_long)
+            close_orders = [(self.__binance_client.make_stoploss_order, (moby_order.ticker, stoploss_price, is_long))]
 
             # 9.2 Take Profit
             if moby_order.take_profit_percent is not None:
                 moby_order.take_profit_price = self.get_roe_take_profit_price(real_entry_price, moby_order, price_precision)
-                self.__binance_client.make_take_profit_order(moby_order.ticker, moby_order.take_profit_price, is_long)
+                close_orders.append((self.__binance_client.make_take_profit_order,
+                                     (moby_order.ticker, moby_order.take_profit_price, is_long)))
 
             elif moby_order.take_profit_price is not None:
                 moby_order.take_profit_price = round(moby_order.take_profit_price, price_precision)
-                self.__binance_client.make_take_profit_order(moby_order.ticker, moby_order.take_profit_price, is_long)
+                close_orders.append((self.__binance_client.make_take_profit_order,
+                                     (moby_order.ticker, moby_order.take_profit_price, is_long)))
 
             # 9.3 Trailing Stop
             elif moby_order.trailing_stop is not None and moby_order.trailing_stop_activation_price is not None:
-                self.__binance_client.make_trailing_stop_order(moby_order.ticker,
-                                                               moby_order.trailing_stop,
-                                                               moby_order.trailing_stop_activation_price,
-                                                               quantity_to_buy,
-                                                               is_long)
+                close_orders.append((self.__binance_client.make_trailing_stop_order,
+                                     (moby_order.ticker,
+                                      moby_order.trailing_stop,
+                                      moby_order.trailing_stop_activation_price,
+                                      quantity_to_buy,
+                                      is_long)))
             else:
                 raise Exception("Compra sin control, ni TP ni Trailing")
 
+            # 9.4 Lanzamos stoploss y TP/Trailing a la vez
+            self.__make_close_orders(close_orders)
+
         except Exception as e:
             # Podria darse si los valores stoploss_price o trailing_stop_activation_price no fueran validos
             msg = moby_order.ticker + " Error abriendo ordenes de cierre, ativamos trailling stop inmediato: " + repr(e)
@@ -136,6 +159,8 @@ class BinanceOrder:
             self.__binance_client.make_trailing_stop_order(moby_order.ticker, 0.2, None, quantity_to_buy, is_long)
             self.__telegram.send_message_to_group_1(msg)
 
+        self.__account_state.mark_order_opened(moby_order.ticker, {"symbol": moby_order.ticker})
+
         # Registro en BQ
         moby_order.stop_loss = stoploss_price
         moby_order.status = OrderStatus.Open
@@ -178,6 +203,15 @@ class BinanceOrder:
         """ Obtiene el balance restante para operar con la cuenta """
         return float(self.__binance_client.get_account_info()["availableBalance"])
 
+    def __make_close_orders(self, close_orders):
+        """Lanza en paralelo las ordenes de cierre (funcion, argumentos). Relanza la primera excepcion"""
+
+        futures = [self.__close_orders_executor.submit(make_order, *args) for make_order, args in close_orders]
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
     def __is_wrong_stoploss(self, entry_price, stoploss_price, is_long):
         """Return True if given stoploss is invalid"""
         if stoploss_price is None:
@@ -0,0 +1,184 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Exit Rules - Trailing stop, stoploss and take profit rules shared by simulator and backtesting]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import numpy as np
+
+from core.order.moby_order import MobyOrder, OrderPosition, PositionCloseReason
+
+# Codigos de salida de las versiones vectorizadas. Prioridad: trailing stop > stoploss > take profit
+EXIT_NONE = 0
+EXIT_TRAILING_STOP = 1
+EXIT_STOPLOSS = 2
+EXIT_TAKE_PROFIT = 3
+
+EXIT_CLOSE_REASONS = {
+    EXIT_TRAILING_STOP: PositionCloseReason.TrailingStop,
+    EXIT_STOPLOSS: PositionCloseReason.Stoploss,
+    EXIT_TAKE_PROFIT: PositionCloseReason.TakeProfit
+}
+
+
+def update_trailing_stop(is_long: bool, order_price: float, trailing_stop_percent: float,
+                         trailing_stop_activation_percent: float, trailing_stop_price: float,
+                         high_price: float, low_price: float) -> float:
+    """Nuevo trailing stop price tras ver un rango de precios (high/low de una vela, o el mark price en ambos)"""
+
+    trailling_stop_inc_price = order_price * trailing_stop_percent / 100
+    trailling_stop_activation_inc_price = order_price * trailing_stop_activation_percent / 100
+
+    if is_long:
+        if high_price >= order_price + trailling_stop_activation_inc_price:
+            new_trailling_stop_price = high_price - trailling_stop_inc_price
+            if new_trailling_stop_price > trailing_stop_price:
+                return new_trailling_stop_price
+    else:
+        if low_price <= order_price - trailling_stop_activation_inc_price:
+            new_trailling_stop_price = low_price + trailling_stop_inc_price
+            if new_trailling_stop_price < trailing_stop_price:
+                return new_trailling_stop_price
+
+    return trailing_stop_price
+
+
+def check_exit(is_long: bool, trailing_stop_price: float, stop_loss: float, take_profit_price: float,
+               high_price: float, low_price: float):
+    """Devuelve (PositionCloseReason, close_price) de la salida que salta, o (None, None)"""
+
+    if is_long:
+        if low_price <= trailing_stop_price:
+            return PositionCloseReason.TrailingStop, trailing_stop_price
+        if low_price <= stop_loss:
+            return PositionCloseReason.Stoploss, stop_loss
+        if high_price >= take_profit_price:
+            return PositionCloseReason.TakeProfit, take_profit_price
+    else:
+        if high_price >= trailing_stop_price:
+            return PositionCloseReason.TrailingStop, trailing_stop_price
+        if high_price >= stop_loss:
+            return PositionCloseReason.Stoploss, stop_loss
+        if low_price <= take_profit_price:
+            return PositionCloseReason.TakeProfit, take_profit_price
+
+    return None, None
+
+
+def update_trailing_stops(is_long: np.ndarray, order_price: np.ndarray, trailing_stop_percent: np.ndarray,
+                          trailing_stop_activation_percent: np.ndarray, trailing_stop_price: np.ndarray,
+                          high_price: np.ndarray, low_price: np.ndarray) -> np.ndarray:
+    """Version vectorizada de update_trailing_stop, una posicion por elemento"""
+
+    trailling_stop_inc_price = order_price * trailing_stop_percent / 100
+    trailling_stop_activation_inc_price = order_price * trailing_stop_activation_percent / 100
+
+    long_activated = high_price >= order_price + trailling_stop_activation_inc_price
+    short_activated = low_price <= order_price - trailling_stop_activation_inc_price
+
+    long_trailing_stop_price = np.where(long_activated,
+                                        np.maximum(trailing_stop_price, high_price - trailling_stop_inc_price),
+                                        trailing_stop_price)
+    short_trailing_stop_price = np.where(short_activated,
+                                         np.minimum(trailing_stop_price, low_price + trailling_stop_inc_price),
+                                         trailing_stop_price)
+
+    return np.where(is_long, long_trailing_stop_price, short_trailing_stop_price)
+
+
+def check_exits(is_long: np.ndarray, trailing_stop_price: np.ndarray, stop_loss: np.ndarray,
+                take_profit_price: np.ndarray, high_price: np.ndarray, low_price: np.ndarray):
+    """Version vectorizada de check_exit. Devuelve (codigos EXIT_*, close_prices), close_price es NaN sin salida"""
+
+    trailing_stop_executed = np.where(is_long, low_price <= trailing_stop_price, high_price >= trailing_stop_price)
+    stoploss_executed = np.where(is_long, low_price <= stop_loss, high_price >= stop_loss)
+    take_profit_executed = np.where(is_long, high_price >= take_profit_price, low_price <= take_profit_price)
+
+    exit_codes = np.select([trailing_stop_executed, stoploss_executed, take_profit_executed],
+                           [EXIT_TRAILING_STOP, EXIT_STOPLOSS, EXIT_TAKE_PROFIT], default=EXIT_NONE)
+    close_prices = np.select([trailing_stop_executed, stoploss_executed, take_profit_executed],
+                             [trailing_stop_price, stop_loss, take_profit_price], default=np.nan)
+
+    return exit_codes, close_prices
+
+
+def find_exit(is_long: bool, order_price: float, trailing_stop_percent: float, trailing_stop_activation_percent: float,
+              trailing_stop_price: float, stop_loss: float, take_profit_price: float,
+              high_price: np.ndarray, low_price: np.ndarray):
+    """Primera salida de una posicion sobre las velas siguientes a su apertura (high/low en orden), sin recorrerlas una
+    a una. Como en el Backtesting, cada vela se comprueba con el trailing stop de las velas anteriores.
+    Devuelve (posicion de la vela, codigo EXIT_*, close_price, trailing stop price con el que se comprueba la vela de
+    salida), o (-1, EXIT_NONE, None, trailing stop price tras todas las velas) si no hay salida"""
+
+    trailling_stop_inc_price = order_price * trailing_stop_percent / 100
+    trailling_stop_activation_inc_price = order_price * trailing_stop_activation_percent / 100
+
+    if is_long:
+        new_trailing_stop_prices = np.where(high_price >= order_price + trailling_stop_activation_inc_price,
+                                            high_price - trailling_stop_inc_price, -np.inf)
+        trailing_stop_prices = np.maximum.accumulate(np.maximum(new_trailing_stop_prices, trailing_stop_price))
+    else:
+        new_trailing_stop_prices = np.where(low_price <= order_price - trailling_stop_activation_inc_price,
+                                            low_price + trailling_stop_inc_price, np.inf)
+        trailing_stop_prices = np.minimum.accumulate(np.minimum(new_trailing_stop_prices, trailing_stop_price))
+
+    if len(trailing_stop_prices) == 0:
+        return -1, EXIT_NONE, None, trailing_stop_price
+
+    checked_trailing_stop_prices = np.concatenate(([trailing_stop_price], trailing_stop_prices[:-1]))
+    exit_codes, close_prices = check_exits(is_long, checked_trailing_stop_prices, stop_loss, take_profit_price,
+                                           high_price, low_price)
+
+    exits = np.flatnonzero(exit_codes)
+    if len(exits) == 0:
+        return -1, EXIT_NONE, None, float(trailing_stop_prices[-1])
+    position = int(exits[0])
+    return position, int(exit_codes[position]), float(close_prices[position]), \
+        float(checked_trailing_stop_prices[position])
+
+
+
+def find_order_exit(moby_order: MobyOrder, trailing_stop_price: float, candles, high_price: np.ndarray,
+                    low_price: np.ndarray, start: int, end: int, intrabar_resolver=None,
+                    min_scan_candles: int = 256, max_scan_candles: int = 65536) -> int:
+    """Busca la salida de una orden abierta en las velas [start, end) con find_exit, por bloques crecientes de velas
+    (las salidas cercanas no recorren toda la historia). Si sale, rellena close_price, close_reason y close_time de la
+    orden; con intrabar_resolver (IntrabarResolver), la vela de salida se resuelve con sus subvelas. Comun a los
+    backtests de cartera y walk forward
+    Args:
+        trailing_stop_price: Trailing stop inicial (Backtesting.prepare_order)
+        candles: Velas (secuencia de Candlestick, mismas posiciones que high_price/low_price)
+    Returns:
+        Posicion de la vela de salida, o None si no sale antes de end
+    """
+
+    is_long = moby_order.position == OrderPosition.Long
+    scan_candles = min_scan_candles
+
+    while start < end:
+        stop = min(start + scan_candles, end)
+        position, exit_code, close_price, trailing_stop_price = find_exit(
+            is_long, moby_order.order_price, moby_order.trailing_stop, moby_order.trailing_stop_activation_percent,
+            trailing_stop_price, moby_order.stop_loss, moby_order.take_profit_price, high_price[start:stop],
+            low_price[start:stop])
+
+        if position >= 0:
+            exit_candle_index = start + position
+            moby_order.close_price = close_price
+            moby_order.close_reason = EXIT_CLOSE_REASONS[exit_code]
+            if intrabar_resolver is not None:
+                moby_order.close_reason, moby_order.close_price = intrabar_resolver.resolve_exit(
+                    is_long, trailing_stop_price, moby_order.stop_loss, moby_order.take_profit_price,
+                    candles[exit_candle_index])
+            moby_order.close_time = candles[exit_candle_index].close_time
+            return exit_candle_index
+
+        start = stop
+        scan_candles = min(2 * scan_candles, max_scan_candles)
+
+    return None
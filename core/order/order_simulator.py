@@ -12,18 +12,22 @@
 import json
 import logging
 import random
-import pandas as pd
+
+from os import environ
 
 from copy import deepcopy
 from datetime import datetime, timedelta
 from enum import Enum
 
-from google.cloud import bigquery, tasks_v2
-from google.protobuf.timestamp_pb2 import Timestamp
-
 from core.candles.binance_client import BinanceClient
+from core.candles.mark_price_snapshot import MarkPriceSnapshot
 from core.alerts.telegram import Telegram
+from core.order.exit_rules import update_trailing_stop, check_exit
 from core.order.moby_order import MobyOrder, OrderPosition, OrderStatus, OrderMode, PositionCloseReason
+from core.order.profit_statistics import ProfitStatistics, ProfitStats
+from core.order.simulation_tracker import SimulationTracker
+from core.order.tick_scheduler import TickScheduler, CloudTasksScheduler
+from core.utils.bq_writer import BigQueryWriter
 from core.utils.redisclient import RedisClient
 from core.utils.utils import unix_time_to_datetime_utc, datetime_utc_to_madrid, datetime_utc_to_unix_time, percentage_to_str
 
@@ -42,8 +46,13 @@ class CloseOrder(str, Enum):
 class OrderSimulator:
     """Order Simulator - This class simulates the tracking of orders for BQ"""
 
-    def __init__(self):
-        """Default constructor"""
+    def __init__(self, tracker_mode: bool = None, scheduler: TickScheduler = None):
+        """Default constructor
+        Args:
+            tracker_mode: True para seguir todas las simulaciones en un unico tick (SimulationTracker) en lugar de
+                una Cloud Task por orden. Por defecto, variable de entorno SIMULATION_TRACKER_MODE
+            scheduler: Scheduler de ticks del tracker. Por defecto Cloud Tasks
+        """
 
         self.__default_trailing_stop_percentage = 0.4  # 0,4%
         self.__default_stoploss_percentage = 8  # 8%
@@ -53,36 +62,47 @@ class OrderSimulator:
 
         self.__chat = Telegram()
         self.__binance_client = BinanceClient()
+        self.__mark_price_snapshot = MarkPriceSnapshot()
         self.__redis_client = RedisClient()
         self.__redis_prefix_opened_order = "SIMULATION_"
-        self.__redis_prefix_profits = "PROFITS_"
-
-        # Big Query
-        self.__bq_client = bigquery.Client(project="fender-310315")
-        self.__bq_table_order_simulator = self.__bq_client.get_table(self.__bq_client.dataset("MobyDick").table("OrderSimulator"))
-        self.__bq_table_moby_order = self.__bq_client.get_table(self.__bq_client.dataset("MobyDick").table("MobyOrder"))
-
-        # Cloud Tasks
-        self.__cloud_tasks_client = tasks_v2.CloudTasksClient()
-        self.__cloud_tasks_parent = self.__cloud_tasks_client.queue_path("fender-310315", "europe-west1",
-                                                                         "order-simulator")
-        self.__task_schema = {
-            "app_engine_http_request": {
-                "http_method": tasks_v2.HttpMethod.POST,
-                "relative_uri": "/mobydick/signals/simulation/refresh",
-                "headers": {"Content-type": "application/json"},
-                "body": "".encode()  # Fill on build
-            },
-            "schedule_time": datetime.utcnow()  # Fill on build
-        }
+        self.__profit_statistics = ProfitStatistics()
+
+        # Big Query: filas encoladas, las inserta en lotes el BigQueryWriter en segundo plano
+        self.__bq_writer = BigQueryWriter()
+        self.__bq_table_order_simulator = "MobyDick.OrderSimulator"
+        self.__bq_table_moby_order = "MobyDick.MobyOrder"
+
+        # Cloud Tasks: el cliente se crea en la primera tarea (en modo tracker no se llega a crear)
+        self.__cloud_tasks_client = None
+        self.__cloud_tasks_parent = None
+        self.__task_schema = None
+
+        # Tracker de simulaciones
+        if tracker_mode is None:
+            tracker_mode = environ.get("SIMULATION_TRACKER_MODE", "False") == "True"
+        self.__tracker = None
+        if tracker_mode:
+            self.__tracker = SimulationTracker(scheduler=scheduler if scheduler is not None else CloudTasksScheduler(),
+                                               on_close=self.__close_tracked_simulation,
+                                               tick_seconds=self.__refresh_seconds)
 
     def open_position_simulation(self, moby_order: MobyOrder):
         """Simulate a buy order by scheduling refreshes of close possibilities"""
 
-        if self.__redis_client.get_value(self.__build_redis_key(moby_order)) is not None:
+        # Comprobar y marcar como abierta en un solo paso (SET NX)
+        if not self.__redis_client.save_value_if_not_exists(self.__build_redis_key(moby_order), "SIMULATION"):
             logging.warning("Simulación ya abierta para: " + moby_order.ticker)
             return
 
+        try:
+            self.__open_position_simulation(moby_order)
+        except Exception as e:
+            self.__redis_client.clear_key(self.__build_redis_key(moby_order))
+            raise e
+
+    def __open_position_simulation(self, moby_order: MobyOrder):
+        """Validate parameters and start tracking a simulation already marked as opened in redis"""
+
         ticker = moby_order.ticker
         order_price = moby_order.order_price
         position_type = PositionType(moby_order.position.value)
@@ -160,13 +180,61 @@ class OrderSimulator:
             "leverage": moby_order.leverage
         }
 
-        self.__schedule_next_refresh(body)
+        if self.__tracker is not None:
+            self.__tracker.add(body)
+        else:
+            self.__schedule_next_refresh(body)
         self.__send_order_to_bq(moby_order)
-        self.__redis_client.save_value(self.__build_redis_key(moby_order), "SIMULATION")
 
     def refresh_order(self, request_body):
         """Check stoploss and trailing stop of a opened simulated order"""
 
+        # Variables del request_body
+        ticker = request_body["ticker"]
+        position_type = PositionType(request_body["position_type"])
+        is_long = position_type == PositionType.Long
+
+        current_price = self.__mark_price_snapshot.get_mark_price(ticker)
+
+        # Actualizar trailing stop price
+        request_body["trailing_stop_price"] = update_trailing_stop(is_long,
+                                                                   request_body["start_price"],
+                                                                   request_body["trailing_stop_percentage"],
+                                                                   request_body["trailing_stop_activation_percentage"],
+                                                                   request_body["trailing_stop_price"],
+                                                                   current_price,
+                                                                   current_price)
+
+        # Comprobar si salta un cierre
+        close_reason, close_price = check_exit(is_long,
+                                               request_body["trailing_stop_price"],
+                                               request_body["stoploss_price"],
+                                               request_body["take_profit_price"],
+                                               current_price,
+                                               current_price)
+
+        if close_reason is not None:
+            self.__close_simulation(request_body, close_price, CloseOrder(close_reason.value))
+
+        # La orden sigue abierta. Programar siguiente refresco
+        else:
+            self.__schedule_next_refresh(request_body)
+
+    def tick_simulations(self, chain_token: str = None):
+        """Check stoploss and trailing stop of all opened simulated orders (tracker mode)"""
+
+        if self.__tracker is None:
+            raise Exception("OrderSimulator no está en modo tracker")
+
+        return self.__tracker.tick(chain_token)
+
+    def __close_tracked_simulation(self, request_body, close_reason: PositionCloseReason, close_price: float):
+        """Callback del tracker para cada simulación cerrada"""
+        self.__close_simulation(request_body, close_price, CloseOrder(close_reason.value))
+
+    def __close_simulation(self, request_body, close_price: float, close_order: CloseOrder):
+        """Close a simulated order: BQ, alert and profit in redis"""
+
         # Variables del request_body
         order_id = request_body["order_id"]
         ticker = request_body["ticker"]
@@ -175,7 +243,6 @@ class OrderSimulator:
         start_time = unix_time_to_datetime_utc(request_body["start_time"])
         stoploss_price = request_body["stoploss_price"]
         take_profit_price = request_body["take_profit_price"]
-        trailing_stop_price = request_body["trailing_stop_price"]
         trailing_stop_percentage = request_body["trailing_stop_percentage"]
         trailing_stop_activation_percentage = request_body["trailing_stop_activation_percentage"]
         entry_indicator = request_body["entry_indicator"]
@@ -183,39 +250,6 @@ class OrderSimulator:
         leverage = request_body["leverage"]
         current_time = datetime_utc_to_madrid(datetime.utcnow())
 
-        current_price = self.__binance_client.get_current_mark_price(ticker)
-
-        trailling_stop_inc_price = start_price * trailing_stop_percentage / 100
-        trailling_stop_activation_inc_price = start_price * trailing_stop_activation_percentage / 100
-
-        if position_type == PositionType.Long:
-            # Actualizar trailing stop price
-            trailing_stop_activation_price = start_price + trailling_stop_activation_inc_price
-            if current_price >= trailing_stop_activation_price:
-                new_trailling_stop_price = current_price - trailling_stop_inc_price
-                if new_trailling_stop_price > trailing_stop_price:
-                    trailing_stop_price = new_trailling_stop_price
-                    request_body["trailing_stop_price"] = new_trailling_stop_price
-
-            # Comprobar si salta un cierre
-            trailing_stop_executed = current_price <= trailing_stop_price
-            stoploss_executed = current_price <= stoploss_price
-            take_profit_executed = current_price >= take_profit_price
-
-        else:  # Short
-            # Actualizar trailing stop price
-            trailing_stop_activation_price = start_price - trailling_stop_activation_inc_price
-            if current_price <= trailing_stop_activation_price:
-                new_trailling_stop_price = current_price + trailling_stop_inc_price
-                if new_trailling_stop_price < trailing_stop_price:
-                    trailing_stop_price = new_trailling_stop_price
-                    request_body["trailing_stop_price"] = new_trailling_stop_price
-
-            # Comprobar si salta un cierre
-            trailing_stop_executed = current_price >= trailing_stop_price
-            stoploss_executed = current_price >= stoploss_price
-            take_profit_executed = current_price <= take_profit_price
-
         moby_order = MobyOrder(ticker=ticker,
                                order_price=start_price,
                                quantity=quantity,
@@ -232,60 +266,38 @@ class OrderSimulator:
         moby_order.status = OrderStatus.Close
         moby_order.order_mode = OrderMode.Simulated
         moby_order.id = order_id
+        moby_order.close_reason = PositionCloseReason(close_order.value)
+        moby_order.close_price = close_price
 
-        # Cerrar por trailling stop
-        if trailing_stop_executed:
-            self.__send_to_bq(request_body, trailing_stop_price, CloseOrder.TrailingStop, current_time)
-            moby_order.close_reason = PositionCloseReason.TrailingStop
-            moby_order.close_price = trailing_stop_price
-            self.__send_order_to_bq(moby_order)
-            self.__send_alert(request_body, trailing_stop_price, CloseOrder.TrailingStop, current_time)
-            self.__redis_client.clear_key(self.__build_redis_key(moby_order))
-            self.__save_profit_in_redis(moby_order)
-
-        # Cerrar por stoploss
-        elif stoploss_executed:
-            self.__send_to_bq(request_body, stoploss_price, CloseOrder.Stoploss, current_time)
-            moby_order.close_reason = PositionCloseReason.Stoploss
-            moby_order.close_price = stoploss_price
-            self.__send_order_to_bq(moby_order)
-            self.__send_alert(request_body, stoploss_price, CloseOrder.Stoploss, current_time)
-            self.__redis_client.clear_key(self.__build_redis_key(moby_order))
-            self.__save_profit_in_redis(moby_order)
+        self.__send_to_bq(request_body, close_price, close_order, current_time)
+        self.__send_order_to_bq(moby_order)
+        self.__send_alert(request_body, close_price, close_order, current_time)
 
-        # Cerrar por take profit
-        elif take_profit_executed:
-            self.__send_to_bq(request_body, take_profit_price, CloseOrder.TakeProfit, current_time)
-            moby_order.close_reason = PositionCloseReason.TakeProfit
-            moby_order.close_price = take_profit_price
-            self.__send_order_to_bq(moby_order)
-            self.__send_alert(request_body, take_profit_price, CloseOrder.TakeProfit, current_time)
+        # Un unico round-trip a Redis: borrar la simulacion y actualizar las estadisticas de profit
+        with self.__redis_client.batch():
             self.__redis_client.clear_key(self.__build_redis_key(moby_order))
             self.__save_profit_in_redis(moby_order)
 
-        # La orden sigue abierta. Programar siguiente refresco
-        else:
-            self.__schedule_next_refresh(request_body)
-
     def get_profits_from_redis(self, order_label:str, min: int, max: int):
-        """"""
-        return self.__redis_client.get_values_between_scores(self.__redis_prefix_profits + order_label, min, max)
-
-    def __save_profit_in_redis(self, moby_order: MobyOrder):
-        """Save profit in redis, deleting oldest profits"""
+        """Profits (float) del order label cerrados entre min y max (unix time), del mas antiguo al mas reciente"""
+        return self.__profit_statistics.get_profits_between(order_label, min, max)
 
-        redis_key = self.__redis_prefix_profits + moby_order.order_label
+    def get_profit_stats(self, order_label: str) -> ProfitStats:
+        """Contadores, racha y ultimos profits del order label en un unico round-trip"""
+        return self.__profit_statistics.get_stats(order_label)
 
-        one_day_seconds = 24 * 60 * 60
-        current_time = moby_order.close_time
-        self.__redis_client.save_scored_value(redis_key, moby_order.profit_percent, int(datetime_utc_to_unix_time(current_time)), one_day_seconds)
+    def __save_profit_in_redis(self, moby_order: MobyOrder):
+        """Save profit in redis. El script de Lua actualiza las estadisticas y barre los profits de mas de 24h"""
 
-        # Barremos las claves antiguas
-        self.__redis_client.clear_between_scores(redis_key, 0, int(datetime_utc_to_unix_time(current_time - timedelta(hours=24))))
+        self.__profit_statistics.add_profit(moby_order.order_label, moby_order.profit_percent, moby_order.close_time,
+                                            moby_order.id)
 
     def __schedule_next_refresh(self, request_body):
         """Schedule next refresh in Google Cloud Tasks"""
 
+        from google.protobuf.timestamp_pb2 import Timestamp
+
+        self.__init_cloud_tasks()
         task = deepcopy(self.__task_schema)
         task["app_engine_http_request"]["body"] = json.dumps(request_body).encode()
 
@@ -299,6 +311,27 @@ class OrderSimulator:
 
         logging.warning('Created task {}'.format(response.name))
 
+    def __init_cloud_tasks(self):
+        """Create the Cloud Tasks client on first use"""
+
+        if self.__cloud_tasks_client is not None:
+            return
+
+        from google.cloud import tasks_v2
+
+        self.__cloud_tasks_client = tasks_v2.CloudTasksClient()
+        self.__cloud_tasks_parent = self.__cloud_tasks_client.queue_path("fender-310315", "europe-west1",
+                                                                         "order-simulator")
+        self.__task_schema = {
+            "app_engine_http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "relative_uri": "/mobydick/signals/simulation/refresh",
+                "headers": {"Content-type": "application/json"},
+                "body": "".encode()  # Fill on build
+            },
+            "schedule_time": datetime.utcnow()  # Fill on build
+        }
+
     def __send_alert(self, request_body, end_price, close_reason: str, end_time: datetime):
         """Send alert to telegram"""
 
@@ -349,23 +382,14 @@ class OrderSimulator:
             "closeReason": close_reason
         }
 
-        rows_to_insert = [
-            msg
-        ]
-
-        errors = self.__bq_client.insert_rows(self.__bq_table_order_simulator, rows_to_insert)
-        if errors:
-            logging.error(errors)
+        self.__bq_writer.enqueue(self.__bq_table_order_simulator, msg)
 
     def __send_order_to_bq(self, moby_order: MobyOrder):
         """Almacena la orden en BQ"""
 
         moby_order.update_metrics()
-        bq_array = [moby_order.__dict__]
-        df = pd.DataFrame(bq_array)
-        errors = self.__bq_client.insert_rows_from_dataframe(self.__bq_table_moby_order, df)
-        if errors:
-            logging.error(errors)
+        # Copia superficial: la orden puede seguir modificandose antes del volcado
+        self.__bq_writer.enqueue(self.__bq_table_moby_order, dict(moby_order.__dict__))
 
     def __build_redis_key(self, moby_order: MobyOrder):
         return self.__redis_prefix_opened_order + moby_order.ticker + moby_order.order_label
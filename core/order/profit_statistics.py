@@ -0,0 +1,164 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Profit Statistics - Rolling profit statistics per order label, maintained in Redis by Lua scripts]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import uuid
+
+from datetime import datetime
+from typing import List, Tuple
+
+from core.utils.redisclient import RedisClient
+from core.utils.utils import datetime_utc_to_unix_time, unix_time_to_datetime_utc
+
+# Saca de la ventana los profits anteriores a ARGV[1] (unix time) descontandolos de los contadores de la ventana
+_LUA_TRIM_WINDOW = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', '(' .. ARGV[1])
+for _, member in ipairs(expired) do
+    local profit = tonumber(string.match(member, ':([^:]+)$'))
+    redis.call('HINCRBY', KEYS[1], 'window_count', -1)
+    redis.call('HINCRBYFLOAT', KEYS[1], 'window_sum', -profit)
+    if profit > 0 then
+        redis.call('HINCRBY', KEYS[1], 'window_wins', -1)
+    end
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', '(' .. ARGV[1])
+end
+"""
+
+# KEYS: hash de estadisticas, lista de ultimos profits, zset de la ventana
+# ARGV: inicio de la ventana, profit, unix time, id unico, k ultimos, segundos de expiracion
+_LUA_ADD_PROFIT = _LUA_TRIM_WINDOW + """
+local profit = tonumber(ARGV[2])
+local win = 0
+if profit > 0 then win = 1 end
+
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4] .. ':' .. ARGV[2])
+
+redis.call('HINCRBY', KEYS[1], 'count', 1)
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum', profit)
+redis.call('HINCRBY', KEYS[1], 'wins', win)
+redis.call('HINCRBY', KEYS[1], 'window_count', 1)
+redis.call('HINCRBYFLOAT', KEYS[1], 'window_sum', profit)
+redis.call('HINCRBY', KEYS[1], 'window_wins', win)
+
+-- Racha con signo: positiva ganando, negativa perdiendo
+local streak = tonumber(redis.call('HGET', KEYS[1], 'streak') or '0')
+if win == 1 then
+    if streak >= 0 then streak = streak + 1 else streak = 1 end
+else
+    if streak <= 0 then streak = streak - 1 else streak = -1 end
+end
+redis.call('HSET', KEYS[1], 'streak', streak)
+
+redis.call('LPUSH', KEYS[2], ARGV[3] .. ':' .. ARGV[2])
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[5]) - 1)
+
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[6])
+end
+return 1
+"""
+
+# KEYS: igual que _LUA_ADD_PROFIT. ARGV: inicio de la ventana
+_LUA_GET_STATS = _LUA_TRIM_WINDOW + """
+local stats = redis.call('HMGET', KEYS[1], 'count', 'sum', 'wins', 'streak', 'window_count', 'window_sum', 'window_wins')
+return {stats, redis.call('LRANGE', KEYS[2], 0, -1)}
+"""
+
+
+class ProfitStats:
+    """Struct con las estadisticas de profits de un order label"""
+    def __init__(self):
+        """Default constructor"""
+        self.count: int = 0
+        self.sum: float = 0
+        self.wins: int = 0
+        self.streak: int = 0  # >0 racha ganadora, <0 racha perdedora
+        self.window_count: int = 0
+        self.window_sum: float = 0
+        self.window_wins: int = 0
+        self.last_profits: List[Tuple[datetime, float]] = list()  # Mas reciente primero
+
+    @property
+    def window_win_rate(self) -> float:
+        return self.window_wins / self.window_count if self.window_count else 0
+
+    def last_profits_since(self, since: datetime) -> List[float]:
+        """Ultimos profits (mas reciente primero) cerrados a partir de since"""
+        return [profit for close_time, profit in self.last_profits if close_time >= since]
+
+
+class ProfitStatistics:
+    """Estadisticas rodantes de profits por order label, actualizadas de forma atomica en Redis al insertar,
+    para que cualquier decision de entrada cueste un solo round-trip"""
+
+    def __init__(self, window_seconds: int = 24 * 60 * 60, last_k: int = 10):
+        """Default constructor
+        Args:
+            window_seconds: Ventana de las estadisticas window_* (por defecto 24h)
+            last_k: Numero de ultimos profits guardados
+        """
+
+        self.__redis_client = RedisClient()
+        self.__redis_prefix = "PROFIT_STATS_"
+        self.__window_seconds = window_seconds
+        self.__last_k = last_k
+        self.__expiration_seconds = 7 * 24 * 60 * 60  # Labels sin actividad en una semana desaparecen
+
+        self.__add_profit_script = self.__redis_client.register_script(_LUA_ADD_PROFIT)
+        self.__get_stats_script = self.__redis_client.register_script(_LUA_GET_STATS)
+
+    def add_profit(self, order_label: str, profit_percent: float, close_time: datetime, order_id: str = None):
+        """Añade el profit de una orden cerrada. Dentro de un RedisClient.batch() va en el mismo pipeline"""
+
+        unix_time = int(datetime_utc_to_unix_time(close_time))
+        self.__redis_client.run_script(self.__add_profit_script,
+                                       keys=self.__build_keys(order_label),
+                                       args=[unix_time - self.__window_seconds,
+                                             repr(float(profit_percent)),
+                                             unix_time,
+                                             order_id if order_id is not None else str(uuid.uuid4()),
+                                             self.__last_k,
+                                             self.__expiration_seconds])
+
+    def get_stats(self, order_label: str) -> ProfitStats:
+        """Estadisticas del order label en un unico round-trip"""
+
+        unix_time = int(datetime_utc_to_unix_time(datetime.utcnow()))
+        stats_values, last_profits = self.__redis_client.run_script(self.__get_stats_script,
+                                                                    keys=self.__build_keys(order_label),
+                                                                    args=[unix_time - self.__window_seconds])
+
+        count, total, wins, streak, window_count, window_sum, window_wins = stats_values
+        stats = ProfitStats()
+        stats.count = int(count or 0)
+        stats.sum = float(total or 0)
+        stats.wins = int(wins or 0)
+        stats.streak = int(streak or 0)
+        stats.window_count = int(window_count or 0)
+        stats.window_sum = float(window_sum or 0)
+        stats.window_wins = int(window_wins or 0)
+        for last_profit in last_profits:
+            close_unix_time, profit = last_profit.decode().split(":", 1)
+            stats.last_profits.append((unix_time_to_datetime_utc(int(close_unix_time)), float(profit)))
+
+        return stats
+
+    def get_profits_between(self, order_label: str, min_unix_time: int, max_unix_time: int) -> List[float]:
+        """Profits de la ventana entre dos instantes, del mas antiguo al mas reciente"""
+
+        members = self.__redis_client.get_values_between_scores(self.__build_keys(order_label)[2], min_unix_time, max_unix_time)
+        return [float(member.decode().rsplit(":", 1)[1]) for member in members]
+
+    def __build_keys(self, order_label: str) -> List[str]:
+        return [self.__redis_prefix + order_label,
+                self.__redis_prefix + "LAST_" + order_label,
+                self.__redis_prefix + "WINDOW_" + order_label]
@@ -0,0 +1,182 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Simulation Tracker - Tracks all opened simulated orders in a single tick]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import json
+import logging
+import time
+import uuid
+import numpy as np
+
+from typing import Callable, Dict
+
+from core.candles.mark_price_snapshot import MarkPriceSnapshot
+from core.order.exit_rules import update_trailing_stops, check_exits, EXIT_NONE, EXIT_CLOSE_REASONS
+from core.order.tick_scheduler import TickScheduler
+from core.utils.redisclient import RedisClient
+
+# KEYS: alive. ARGV: token del tick actual, token del siguiente tick, segundos de vida (0: se borra la clave)
+_LUA_RENEW_CHAIN = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[3] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+
+class SimulationTracker:
+    """Mantiene las simulaciones abiertas en un hash de Redis y las evalua todas a la vez en cada tick,
+    contra un unico snapshot de mark prices"""
+
+    def __init__(self, scheduler: TickScheduler, on_close: Callable, tick_seconds: float = 3):
+        """Default constructor
+        Args:
+            scheduler: Programa el siguiente tick (Cloud Tasks en produccion, LocalScheduler en pruebas)
+            on_close: Funcion (request_body, close_reason: PositionCloseReason, close_price) llamada por cada cierre
+            tick_seconds: Segundos entre ticks
+        """
+
+        self.__scheduler = scheduler
+        self.__on_close = on_close
+        self.__tick_seconds = tick_seconds
+
+        self.__redis_client = RedisClient()
+        self.__mark_price_snapshot = MarkPriceSnapshot()
+
+        self.__redis_key_simulations = "SIMULATIONS_OPEN"
+        self.__redis_key_alive = "SIMULATION_TRACKER_ALIVE"  # Token del tick programado de la cadena, si la hay
+        self.__redis_key_tick_lock = "SIMULATION_TRACKER_TICK_LOCK"
+        self.__alive_seconds = int(tick_seconds * 10)
+        self.__tick_lock_seconds = int(tick_seconds * 20)
+
+        self.__renew_chain_script = self.__redis_client.register_script(_LUA_RENEW_CHAIN)
+
+    def add(self, request_body: dict):
+        """Añade una simulacion abierta y arranca la cadena de ticks si no esta corriendo"""
+
+        self.__redis_client.save_hash_values(self.__redis_key_simulations,
+                                             {request_body["order_id"]: json.dumps(request_body)})
+        self.ensure_running()
+
+    def ensure_running(self):
+        """Programa un tick si no hay ya una cadena de ticks viva. Cada tick lleva su token, el unico que se ejecuta"""
+
+        chain_token = uuid.uuid4().hex
+        if self.__redis_client.save_value_if_not_exists(self.__redis_key_alive, chain_token, self.__alive_seconds):
+            self.__scheduler.schedule_tick(self.__tick_seconds, chain_token)
+
+    def get_open_simulations(self) -> Dict[str, dict]:
+        """Simulaciones abiertas por order_id"""
+
+        return {order_id.decode(): json.loads(body)
+                for order_id, body in self.__redis_client.get_hash_values(self.__redis_key_simulations).items()}
+
+    def tick(self, chain_token: str = None) -> dict:
+        """Evalua todas las simulaciones abiertas, cierra las que han saltado y programa el siguiente tick, con un
+        token nuevo. Los ticks cuyo token no es el de la cadena (ej: reintentos de Cloud Tasks, ticks ya ejecutados o
+        de otra cadena) se descartan, asi que nunca corren dos cadenas a la vez"""
+
+        alive_token = self.__redis_client.get_value(self.__redis_key_alive)
+        if alive_token is None:
+            # La cadena se ha perdido (ej: el tick anterior fallo): se arranca otra
+            logging.warning("Cadena de ticks de simulaciones caducada, se rearranca")
+            self.ensure_running()
+            return {"open": None, "closed": 0, "updated": 0}
+        if alive_token.decode() != chain_token:
+            logging.warning("Tick de otra cadena de simulaciones, se descarta")
+            return {"open": None, "closed": 0, "updated": 0}
+
+        # Un solo tick a la vez: si otro esta en curso, ese ya programara el siguiente
+        if not self.__redis_client.save_value_if_not_exists(self.__redis_key_tick_lock, 1, self.__tick_lock_seconds):
+            logging.warning("Tick de simulaciones ya en curso, se descarta este")
+            return {"open": None, "closed": 0, "updated": 0}
+
+        try:
+            start = time.time()
+            stats = self.__evaluate(self.get_open_simulations())
+
+            if stats["open"] > stats["closed"]:
+                # Solo si la cadena sigue siendo esta
+                next_chain_token = uuid.uuid4().hex
+                if self.__renew_chain(chain_token, next_chain_token, self.__alive_seconds):
+                    self.__scheduler.schedule_tick(self.__tick_seconds, next_chain_token)
+            else:
+                # Paramos la cadena. Si se ha abierto una simulacion entretanto, la rearrancamos
+                self.__renew_chain(chain_token, "", 0)
+                if self.__redis_client.get_hash_length(self.__redis_key_simulations) > 0:
+                    self.ensure_running()
+
+            logging.info("Tick de simulaciones: " + str(stats) + " en " + str(round(time.time() - start, 3)) + "s")
+            return stats
+
+        finally:
+            self.__redis_client.clear_key(self.__redis_key_tick_lock)
+
+    def __renew_chain(self, chain_token: str, next_chain_token: str, alive_seconds: int) -> bool:
+        """Si la cadena sigue en el tick de chain_token, la pasa al de next_chain_token (o la para, con alive_seconds
+        0)"""
+
+        return self.__redis_client.run_script(self.__renew_chain_script, keys=[self.__redis_key_alive],
+                                              args=[chain_token, next_chain_token, alive_seconds]) == 1
+
+    def __evaluate(self, simulations: Dict[str, dict]) -> dict:
+        """Actualiza trailing stops y comprueba cierres de todas las simulaciones con una unica evaluacion vectorizada"""
+
+        if not simulations:
+            return {"open": 0, "closed": 0, "updated": 0}
+
+        order_ids = list(simulations.keys())
+        bodies = [simulations[order_id] for order_id in order_ids]
+
+        snapshot = self.__mark_price_snapshot.get_snapshot()
+        current_prices = np.array([snapshot[body["ticker"]] if body["ticker"] in snapshot
+                                   else self.__mark_price_snapshot.get_mark_price(body["ticker"])
+                                   for body in bodies], dtype=np.float64)
+
+        is_long = np.array([body["position_type"] == "Long" for body in bodies])
+        start_prices = np.array([body["start_price"] for body in bodies], dtype=np.float64)
+        trailing_stop_percentages = np.array([body["trailing_stop_percentage"] for body in bodies], dtype=np.float64)
+        trailing_stop_activation_percentages = np.array([body["trailing_stop_activation_percentage"] for body in bodies],
+                                                        dtype=np.float64)
+        trailing_stop_prices = np.array([body["trailing_stop_price"] for body in bodies], dtype=np.float64)
+        stoploss_prices = np.array([body["stoploss_price"] for body in bodies], dtype=np.float64)
+        take_profit_prices = np.array([body["take_profit_price"] for body in bodies], dtype=np.float64)
+
+        new_trailing_stop_prices = update_trailing_stops(is_long, start_prices, trailing_stop_percentages,
+                                                         trailing_stop_activation_percentages, trailing_stop_prices,
+                                                         current_prices, current_prices)
+        exit_codes, close_prices = check_exits(is_long, new_trailing_stop_prices, stoploss_prices, take_profit_prices,
+                                               current_prices, current_prices)
+
+        closed = np.flatnonzero(exit_codes != EXIT_NONE)
+        updated = np.flatnonzero((exit_codes == EXIT_NONE) & (new_trailing_stop_prices != trailing_stop_prices))
+
+        # Trailing stops actualizados, en una sola escritura
+        updated_bodies = dict()
+        for i in updated:
+            bodies[i]["trailing_stop_price"] = float(new_trailing_stop_prices[i])
+            updated_bodies[order_ids[i]] = json.dumps(bodies[i])
+        self.__redis_client.save_hash_values(self.__redis_key_simulations, updated_bodies)
+
+        # Cierres
+        self.__redis_client.delete_hash_values(self.__redis_key_simulations, [order_ids[i] for i in closed])
+        for i in closed:
+            bodies[i]["trailing_stop_price"] = float(new_trailing_stop_prices[i])
+            try:
+                self.__on_close(bodies[i], EXIT_CLOSE_REASONS[int(exit_codes[i])], float(close_prices[i]))
+            except Exception as e:
+                logging.exception("Error cerrando la simulacion " + order_ids[i] + ": " + repr(e))
+
+        return {"open": len(order_ids), "closed": len(closed), "updated": len(updated)}
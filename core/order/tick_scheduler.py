@@ -0,0 +1,103 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Tick Scheduler - Schedules the next tick of the simulated orders tracker]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import json
+import logging
+import time
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+
+class TickScheduler(ABC):
+    """Interfaz de los schedulers: programa una llamada al tick del tracker dentro de in_seconds, con su token de
+    cadena de ticks"""
+
+    @abstractmethod
+    def schedule_tick(self, in_seconds: float, chain_token: str):
+        raise NotImplementedError()
+
+
+class CloudTasksScheduler(TickScheduler):
+    """Programa el siguiente tick como una Cloud Task contra la ruta de tick del servicio signals"""
+
+    def __init__(self, relative_uri: str = "/mobydick/signals/simulation/tick", queue: str = "order-simulator"):
+        """Default constructor"""
+
+        from google.cloud import tasks_v2
+
+        self.__cloud_tasks_client = tasks_v2.CloudTasksClient()
+        self.__cloud_tasks_parent = self.__cloud_tasks_client.queue_path("fender-310315", "europe-west1", queue)
+        self.__http_method = tasks_v2.HttpMethod.POST
+        self.__relative_uri = relative_uri
+
+    def schedule_tick(self, in_seconds: float, chain_token: str):
+        """Schedule next tick in Google Cloud Tasks"""
+
+        from google.protobuf.timestamp_pb2 import Timestamp
+
+        timestamp = Timestamp()
+        timestamp.FromDatetime(datetime.utcnow() + timedelta(seconds=in_seconds))
+        task = {
+            "app_engine_http_request": {
+                "http_method": self.__http_method,
+                "relative_uri": self.__relative_uri,
+                "headers": {"Content-type": "application/json"},
+                "body": json.dumps({"chain_token": chain_token}).encode()
+            },
+            "schedule_time": timestamp
+        }
+
+        response = self.__cloud_tasks_client.create_task(parent=self.__cloud_tasks_parent, task=task)
+
+        logging.info('Created tick task {}'.format(response.name))
+
+
+class LocalScheduler(TickScheduler):
+    """Scheduler en memoria que sustituye a Cloud Tasks en pruebas y ejecuciones locales"""
+
+    def __init__(self, tick: Callable = None):
+        """Default constructor"""
+
+        self.tick = tick
+        self.scheduled_ticks: List[tuple] = list()  # Instantes (time.time()) y tokens de cadena de los ticks pendientes
+
+    def schedule_tick(self, in_seconds: float, chain_token: str):
+        self.scheduled_ticks.append((time.time() + in_seconds, chain_token))
+
+    def run_pending(self, ignore_schedule_time: bool = True) -> int:
+        """Ejecuta los ticks pendientes (por defecto sin esperar a su hora). Devuelve cuantos se han ejecutado"""
+
+        executed = 0
+        now = time.time()
+        pending = sorted(self.scheduled_ticks)
+        self.scheduled_ticks = list()
+
+        for tick_time, chain_token in pending:
+            if not ignore_schedule_time and tick_time > now:
+                self.scheduled_ticks.append((tick_time, chain_token))
+                continue
+            self.tick(chain_token)
+            executed += 1
+
+        return executed
+
+    def run_until_idle(self, max_ticks: int = 1000, sleep: bool = False) -> int:
+        """Ejecuta ticks mientras el tracker siga programando otros. Devuelve cuantos se han ejecutado"""
+
+        executed = 0
+        while self.scheduled_ticks and executed < max_ticks:
+            if sleep:
+                time.sleep(max(0.0, min(self.scheduled_ticks)[0] - time.time()))
+            executed += self.run_pending()
+
+        return executed
@@ -0,0 +1,183 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [BigQuery Writer - Buffered and batched streaming inserts to BQ in background]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from os import environ
+from typing import Dict, List
+
+
+class BigQueryWriter:
+    """Clase singleton que encola filas para BQ y las inserta en lotes por tabla desde un hilo en segundo plano,
+    para que ninguna decision de trading espere a BQ"""
+
+    __instance = None
+    __init_called = False
+
+    def __new__(cls):
+
+        """ Generate singleton """
+
+        if BigQueryWriter.__instance is None:
+            BigQueryWriter.__instance = object.__new__(cls)
+        return BigQueryWriter.__instance
+
+    def __init__(self):
+
+        """ Initialize variables """
+
+        if not self.__init_called:
+            self.__init_called = True
+
+            self.__max_queue_rows = int(environ.get("BQ_WRITER_MAX_QUEUE_ROWS", 10000))
+            self.__max_batch_rows = int(environ.get("BQ_WRITER_MAX_BATCH_ROWS", 500))
+            self.__flush_seconds = float(environ.get("BQ_WRITER_FLUSH_SECONDS", 5))
+            self.__max_retries = 4
+            self.__retry_base_seconds = 1
+
+            self.__queue = queue.Queue(maxsize=self.__max_queue_rows)
+            self.__lock = threading.Lock()
+            self.__thread: threading.Thread = None
+            self.__thread_pid: int = None
+            self.__bq_client = None
+            self.__tables = dict()
+
+            self.__metrics = {
+                "enqueued_rows": 0,
+                "dropped_rows": 0,
+                "flushed_rows": 0,
+                "failed_rows": 0,
+                "insert_calls": 0,
+                "last_flush_latency_seconds": None,
+                "max_flush_latency_seconds": 0
+            }
+
+            atexit.register(self.flush)
+
+    def enqueue(self, table_id: str, row: dict):
+        """Encola una fila para la tabla (ej: "MobyDick.MobyOrder"). Nunca bloquea: si la cola está llena, se descarta"""
+
+        self.__ensure_thread()
+        try:
+            self.__queue.put_nowait((table_id, row))
+            self.__metrics["enqueued_rows"] += 1
+        except queue.Full:
+            self.__metrics["dropped_rows"] += 1
+            logging.error("Cola de BQ llena, se descarta una fila de " + table_id)
+
+    def get_metrics(self) -> dict:
+        """Profundidad de la cola, filas volcadas/descartadas/fallidas y latencias de volcado"""
+
+        metrics = dict(self.__metrics)
+        metrics["queue_depth"] = self.__queue.qsize()
+        return metrics
+
+    def flush(self):
+        """Vuelca de forma sincrona todo lo encolado (al parar el proceso o en pruebas)"""
+
+        rows_by_table = self.__drain(block_seconds=0)
+        self.__insert_all(rows_by_table)
+
+    def __ensure_thread(self):
+        """Arranca el hilo en el primer uso de cada proceso (los workers de gunicorn hacen fork)"""
+
+        if self.__thread is not None and self.__thread_pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__thread is not None and self.__thread_pid == os.getpid():
+                return
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread_pid = os.getpid()
+            self.__thread.start()
+
+    def __run(self):
+        """Bucle del hilo: acumula hasta max_batch_rows filas o flush_seconds, y vuelca"""
+
+        while True:
+            try:
+                rows_by_table = self.__drain(block_seconds=self.__flush_seconds)
+                self.__insert_all(rows_by_table)
+            except Exception as e:
+                logging.exception("Error en el writer de BQ: " + repr(e))
+
+    def __drain(self, block_seconds: float) -> Dict[str, List[dict]]:
+        """Saca filas de la cola agrupadas por tabla, esperando como mucho block_seconds a completar el lote"""
+
+        rows_by_table = dict()
+        rows = 0
+        deadline = time.time() + block_seconds
+
+        while rows < self.__max_batch_rows:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    table_id, row = self.__queue.get(timeout=timeout)
+                else:
+                    table_id, row = self.__queue.get_nowait()
+            except queue.Empty:
+                break
+            rows_by_table.setdefault(table_id, []).append(row)
+            rows += 1
+
+        return rows_by_table
+
+    def __insert_all(self, rows_by_table: Dict[str, List[dict]]):
+        for table_id, rows in rows_by_table.items():
+            self.__insert_with_retries(table_id, rows)
+
+    def __insert_with_retries(self, table_id: str, rows: List[dict]):
+        """Un streaming insert por tabla y lote, con reintentos y backoff exponencial"""
+
+        start = time.time()
+        for attempt in range(self.__max_retries):
+            try:
+                errors = self.__get_bq_client().insert_rows(self.__get_table(table_id), rows)
+                self.__metrics["insert_calls"] += 1
+                if errors:
+                    # Errores por fila (esquema, etc.): reintentar no los arregla
+                    self.__metrics["failed_rows"] += len(errors)
+                    logging.error(errors)
+                self.__metrics["flushed_rows"] += len(rows) - len(errors)
+                break
+
+            except Exception as e:
+                if attempt == self.__max_retries - 1:
+                    self.__metrics["failed_rows"] += len(rows)
+                    logging.exception("Se descartan {0} filas de {1} tras {2} intentos: {3}".format(
+                        len(rows), table_id, self.__max_retries, repr(e)))
+                else:
+                    time.sleep(self.__retry_base_seconds * 2 ** attempt)
+
+        latency = time.time() - start
+        self.__metrics["last_flush_latency_seconds"] = latency
+        self.__metrics["max_flush_latency_seconds"] = max(self.__metrics["max_flush_latency_seconds"], latency)
+
+    def __get_bq_client(self):
+        if self.__bq_client is None:
+            from google.cloud import bigquery
+            self.__bq_client = bigquery.Client(project="fender-310315")
+        return self.__bq_client
+
+    def __get_table(self, table_id: str):
+        """Tablas cacheadas: el esquema solo se pide una vez por tabla"""
+
+        table = self.__tables.get(table_id)
+        if table is None:
+            dataset, table_name = table_id.split(".")
+            table = self.__get_bq_client().get_table(self.__get_bq_client().dataset(dataset).table(table_name))
+            self.__tables[table_id] = table
+        return table
@@ -12,10 +12,24 @@
 
 import bson
 import json
+import threading
+import time
 
-from redis import StrictRedis
+from contextlib import contextmanager
+from redis import StrictRedis, ConnectionPool
 from os import environ
 
+# Codecs opcionales, más rápidos que bson/json. Solo se usan si se piden y están instalados
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class RedisClient:
     """Clase singleton creada para gestionar la interaccion Redis"""
@@ -38,11 +52,45 @@ class RedisClient:
         if not self.__init_called:
             self.__init_called = True
 
-            self.__redis_client = StrictRedis(
+            self.__connection_pool = ConnectionPool(
                 host=environ.get('REDISHOST', 'localhost'),
                 port=int(environ.get('REDISPORT', 6379)),
+                max_connections=int(environ.get('REDIS_MAX_CONNECTIONS', 50)),
+                socket_keepalive=True,
                 decode_responses=False
             )
+            self.__redis_client = StrictRedis(connection_pool=self.__connection_pool)
+
+            # Pipeline del batch() en curso, por hilo
+            self.__batch = threading.local()
+
+            # Cache local (por proceso) de claves de configuración: key -> (expira_en, valor)
+            self.__local_cache = dict()
+
+    @contextmanager
+    def batch(self):
+
+        """ Pipelines every write command issued within the scope, sent in a single round-trip at the end.
+        Reads are not pipelined: they are executed immediately. Nested batches join the outer one
+        """
+
+        if getattr(self.__batch, "pipeline", None) is not None:
+            yield
+            return
+
+        self.__batch.pipeline = self.__redis_client.pipeline(transaction=False)
+        try:
+            yield
+            self.__batch.pipeline.execute()
+        finally:
+            self.__batch.pipeline = None
+
+    def __writer(self):
+
+        """ Pipeline of the current batch, or the client if there is no batch """
+
+        pipeline = getattr(self.__batch, "pipeline", None)
+        return pipeline if pipeline is not None else self.__redis_client
 
     def increase_count(self, key):
 
@@ -60,7 +108,7 @@ class RedisClient:
             key (string): Key from redis
         """
 
-        return self.__redis_client.set(key, 0)
+        return self.__writer().set(key, 0)
 
     def get_value(self, key):
 
@@ -84,19 +132,22 @@ class RedisClient:
 
         return self.__redis_client.mget(keys)
 
-    def save_value(self, key, value, expiration_seconds=None):
+    def save_value(self, key, value, expiration_seconds=None, expiration_milliseconds=None):
 
         """ Store a value in redis
         Args:
             key (string): Key to save value in redis
             value (any type): Value to be saved in redis
             expiration_seconds (int or None): After this number of seconds, this key-value will be erased from redis
+            expiration_milliseconds (int or None): Same as expiration_seconds, for sub-second expirations
         """
 
-        self.__redis_client.set(
+        self.__local_cache.pop(key, None)
+        self.__writer().set(
             name=key,
             value=value,
-            ex=expiration_seconds
+            ex=expiration_seconds,
+            px=expiration_milliseconds
         )
 
     def save_values(self, name_value_ex_records):
@@ -106,33 +157,33 @@ class RedisClient:
             name_value_ex_records (list): List of dicts with name, value and ex
         """
 
-        pipe = self.__redis_client.pipeline()
+        # Dentro de un batch() se añaden a su pipeline
+        pipe = self.__writer()
+        own_pipeline = pipe is self.__redis_client
+        if own_pipeline:
+            pipe = self.__redis_client.pipeline()
         for name_value_ex in name_value_ex_records:
+            self.__local_cache.pop(name_value_ex["name"], None)
             pipe.set(
                 name=name_value_ex["name"],
                 value=name_value_ex["value"],
                 ex=name_value_ex["ex"]
             )
-        pipe.execute()
+        if own_pipeline:
+            pipe.execute()
 
-    def get_dict(self, key, serialization="bson"):
+    def get_dict(self, key, serialization="bson", local_cache_seconds=None):
 
         """ Returns a dict stored in redis with a given key
         Args:
             key (string): Key to get value from redis
-            serialization (string): "bson" or "json", format to deserialize
+            serialization (string): "bson", "json", "msgpack" or "orjson", format to deserialize
+            local_cache_seconds (float or None): Keep the value in this process for these seconds (hot config keys)
         Returns:
             The value gotten from redis, a dict
         """
 
-        value = self.get_value(key)
-        if value:
-            if serialization == "bson":
-                return bson.loads(value)
-            elif serialization == "json":
-                return json.loads(value)
-
-        return dict()
+        return self.__read_through(key, local_cache_seconds, lambda: self.__loads(self.get_value(key), serialization))
 
     def get_dicts(self, keys, serialization="bson"):
 
@@ -144,47 +195,127 @@ class RedisClient:
             The values gotten from redis, a list of dicts
         """
 
-        values = self.get_values(keys)
-        if serialization == "bson":
-            values = [bson.loads(f) if f else dict() for f in values]
-        elif serialization == "json":
-            values = [json.loads(f) if f else dict() for f in values]
+        return [self.__loads(value, serialization) for value in self.get_values(keys)]
 
-        return values
-
-    def save_dict(self, key, value, expiration_seconds=None, serialization="bson"):
+    def save_dict(self, key, value, expiration_seconds=None, serialization="bson", expiration_milliseconds=None):
 
         """ Store a dict in redis
         Args:
             key (string): Key to save value in redis
             value (dict): Value to be saved in redis
             expiration_seconds (int or None): After this number of seconds, this key-value will be erased from redis
-            serialization (string): "bson" or "json", format to serialize
+            serialization (string): "bson", "json", "msgpack" or "orjson", format to serialize
+            expiration_milliseconds (int or None): Same as expiration_seconds, for sub-second expirations
         """
 
-        if serialization == "bson":
-            value = bson.dumps(value)
-        elif serialization == "json":
-            value = json.dumps(value)
-
-        self.save_value(key, value, expiration_seconds)
+        self.save_value(key, self.__dumps(value, serialization), expiration_seconds, expiration_milliseconds)
 
     def save_dicts(self, name_value_ex_records, serialization="bson"):
 
         """ Store a dict in redis
         Args:
             name_value_ex_records (list): List of dicts with name, value and ex
-            serialization (string): "bson" or "json", format to serialize
+            serialization (string): "bson", "json", "msgpack" or "orjson", format to serialize
         """
 
         for name_value_ex in name_value_ex_records:
-            if serialization == "bson":
-                name_value_ex["value"] = bson.dumps(name_value_ex["value"])
-            else:
-                name_value_ex["value"] = json.dumps(name_value_ex["value"])
+            name_value_ex["value"] = self.__dumps(name_value_ex["value"], serialization)
 
         self.save_values(name_value_ex_records)
 
+    def get_hash_dict(self, key, local_cache_seconds=None, legacy_serialization=None):
+
+        """ Returns a dict stored as a native redis hash (one field per key, values as json)
+        Args:
+            key (string): Key of the hash
+            local_cache_seconds (float or None): Keep the value in this process for these seconds (hot config keys)
+            legacy_serialization (string or None): If the key is still an old serialized dict ("bson", "json"...),
+                it is read with this format and migrated to a hash
+        Returns:
+            The dict, empty if the key does not exist
+        """
+
+        def load():
+            if legacy_serialization is not None and self.__redis_client.type(key) == b"string":
+                value = self.get_dict(key, legacy_serialization)
+                self.save_hash_dict(key, value)
+                return value
+            return {field.decode(): json.loads(value) for field, value in self.__redis_client.hgetall(key).items()}
+
+        return self.__read_through(key, local_cache_seconds, load)
+
+    def save_hash_dict(self, key, value, expiration_seconds=None):
+
+        """ Store a dict as a native redis hash, replacing the previous one
+        Args:
+            key (string): Key of the hash
+            value (dict): Dict to be saved, values must be json serializable
+            expiration_seconds (int or None): After this number of seconds, this key-value will be erased from redis
+        """
+
+        self.__local_cache.pop(key, None)
+        with self.batch():
+            self.__writer().delete(key)
+            if value:
+                self.__writer().hset(key, mapping={field: json.dumps(field_value) for field, field_value in value.items()})
+            if expiration_seconds:
+                self.__writer().expire(key, expiration_seconds)
+
+    def __read_through(self, key, local_cache_seconds, load):
+
+        """ Local read-through cache with TTL """
+
+        if not local_cache_seconds:
+            return load()
+
+        cached = self.__local_cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        value = load()
+        self.__local_cache[key] = (time.time() + local_cache_seconds, value)
+        return value
+
+    @staticmethod
+    def __dumps(value, serialization):
+
+        """ Serialize a dict with the given codec """
+
+        if serialization == "bson":
+            return bson.dumps(value)
+        elif serialization == "json":
+            return json.dumps(value)
+        elif serialization == "msgpack":
+            if msgpack is None:
+                raise Exception("msgpack no está instalado")
+            return msgpack.packb(value, use_bin_type=True)
+        elif serialization == "orjson":
+            if orjson is None:
+                raise Exception("orjson no está instalado")
+            return orjson.dumps(value)
+        raise Exception("Serialización desconocida: " + str(serialization))
+
+    @staticmethod
+    def __loads(value, serialization):
+
+        """ Deserialize a dict with the given codec, empty dict if there is no value """
+
+        if not value:
+            return dict()
+        if serialization == "bson":
+            return bson.loads(value)
+        elif serialization == "json":
+            return json.loads(value)
+        elif serialization == "msgpack":
+            if msgpack is None:
+                raise Exception("msgpack no está instalado")
+            return msgpack.unpackb(value, raw=False)
+        elif serialization == "orjson":
+            if orjson is None:
+                raise Exception("orjson no está instalado")
+            return orjson.loads(value)
+        raise Exception("Serialización desconocida: " + str(serialization))
+
     def get_file(self, key, path):
 
         """ Write in a given path the file stored in redis with a given key
@@ -220,7 +351,8 @@ class RedisClient:
             key (string): Key to be deleted
         """
 
-        self.__redis_client.delete(key)
+        self.__local_cache.pop(key, None)
+        self.__writer().delete(key)
 
     def save_scored_value(self, key, value, score, expiration_seconds=None):
 
@@ -237,9 +369,9 @@ class RedisClient:
         # Do stuff: zadd, expire...
         # self.__redis_client.zremrangebyrank(key, 0, -2) # Delete all the entries but the highest
 
-        self.__redis_client.zadd(key, {value: score})
+        self.__writer().zadd(key, {value: score})
         if expiration_seconds:
-            self.__redis_client.expire(key, expiration_seconds)
+            self.__writer().expire(key, expiration_seconds)
 
     def get_highest_scored_value(self, key, pop=False):
 
@@ -297,8 +429,13 @@ class RedisClient:
         return values
 
     def clear_between_scores(self, key, min_score, max_score):
-        """TODO doc"""
-        self.__redis_client.zremrangebyscore(key, min_score, max_score)
+        """ Delete all values between two scores
+        Args:
+            key (string): Key of the sorted set
+            min_score (int): Minimum score to delete
+            max_score (int): Maximum score to delete
+        """
+        self.__writer().zremrangebyscore(key, min_score, max_score)
 
     def is_first_time_this_key_is_checked(self, key, expiration_seconds=None):
         """ Returns True is this is the first time this function has been called for this key
@@ -314,6 +451,132 @@ class RedisClient:
 
         return previous_value is None
 
+    def save_value_if_not_exists(self, key, value, expiration_seconds=None):
+
+        """ Store a value in redis only if the key does not exist (SET NX)
+        Args:
+            key (string): Key to save value in redis
+            value (any type): Value to be saved in redis
+            expiration_seconds (int or None): After this number of seconds, this key-value will be erased from redis
+        Returns:
+            True if the value has been saved, False if the key already existed
+        """
+
+        return bool(self.__redis_client.set(name=key, value=value, ex=expiration_seconds, nx=True))
+
+    def save_hash_values(self, key, mapping):
+
+        """ Store several fields of a hash in redis
+        Args:
+            key (string): Key of the hash
+            mapping (dict): Fields and values to be saved
+        """
+
+        if mapping:
+            self.__local_cache.pop(key, None)
+            self.__writer().hset(key, mapping=mapping)
+
+    def get_hash_values(self, key):
+
+        """ Returns all fields of a hash stored in redis
+        Args:
+            key (string): Key of the hash
+        Returns:
+            Dict with fields and values (bytes)
+        """
+
+        return self.__redis_client.hgetall(key)
+
+    def delete_hash_values(self, key, fields):
+
+        """ Delete fields of a hash
+        Args:
+            key (string): Key of the hash
+            fields (list of string): Fields to be deleted
+        Returns:
+            Number of fields deleted
+        """
+
+        if not fields:
+            return 0
+        return self.__redis_client.hdel(key, *fields)
+
+    def increase_hash_value(self, key, field, amount=1):
+
+        """ Increases a number stored in a field of a hash (HINCRBY / HINCRBYFLOAT)
+        Args:
+            key (string): Key of the hash
+            field (string): Field to increase
+            amount (int or float): Increment
+        """
+
+        if isinstance(amount, float):
+            self.__writer().hincrbyfloat(key, field, amount)
+        else:
+            self.__writer().hincrby(key, field, amount)
+
+    def get_hash_length(self, key):
+
+        """ Returns the number of fields of a hash
+        Args:
+            key (string): Key of the hash
+        """
+
+        return self.__redis_client.hlen(key)
+
+    def add_to_stream(self, key, fields, max_length=None):
+
+        """ Append an entry to a redis stream (XADD)
+        Args:
+            key (string): Key of the stream
+            fields (dict): Fields and values of the entry
+            max_length (int): Approximate max number of entries kept in the stream
+        """
+
+        self.__writer().xadd(key, fields, maxlen=max_length, approximate=True)
+
+    def get_stream_entries(self, key, min_id="-", max_id="+", count=None):
+
+        """ Returns the entries of a redis stream between two ids (XRANGE)
+        Args:
+            key (string): Key of the stream
+            min_id (string): First id, "-" from the beginning. A unix time in milliseconds is also valid
+            max_id (string): Last id, "+" until the end
+            count (int): Max number of entries
+        Returns:
+            List of (id, dict of fields) with bytes
+        """
+
+        return self.__redis_client.xrange(key, min=min_id, max=max_id, count=count)
+
+    def register_script(self, script):
+
+        """ Register a Lua script, executed with EVALSHA (loaded on first use)
+        Args:
+            script (string): Lua source
+        Returns:
+            Script object to be run with run_script
+        """
+
+        return self.__redis_client.register_script(script)
+
+    def run_script(self, script, keys, args):
+
+        """ Run a registered Lua script. Within a batch() it is added to the pipeline and returns nothing
+        Args:
+            script: Script returned by register_script
+            keys (list of string): KEYS of the script
+            args (list): ARGV of the script
+        Returns:
+            The result of the script
+        """
+
+        pipeline = getattr(self.__batch, "pipeline", None)
+        if pipeline is not None:
+            script(keys=keys, args=args, client=pipeline)
+            return None
+        return script(keys=keys, args=args)
+
     def get_pubsub(self):
         """ Create a pubsub to subscribe to notifications
         Returns:
@@ -330,7 +593,7 @@ class RedisClient:
             expiration_milliseconds (int): New milliseconds time to expire
         """
 
-        self.__redis_client.pexpire(key, expiration_milliseconds)
+        self.__writer().pexpire(key, expiration_milliseconds)
 
     def flushall(self):
         """ Delete all keys in all databases on the current host"""
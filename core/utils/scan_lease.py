@@ -0,0 +1,174 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Scan Lease - Distributed lease with fencing tokens and progress cursor for cron-triggered scans]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+import logging
+
+from datetime import datetime
+from typing import List, Set
+
+from core.utils.redisclient import RedisClient
+
+# KEYS: lease, cursor. ARGV: token, symbol, milisegundos de lease, segundos de vida del cursor
+_LUA_MARK_DONE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# KEYS: lease, cursor. ARGV: token, 1 si la pasada se ha completado
+_LUA_RELEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '1' then
+    redis.call('DEL', KEYS[2])
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+class ScanPass:
+    """Pasada de un escaneo con el lease adquirido. Solo es valida mientras su token sea el del lease"""
+
+    def __init__(self, scan_lease: 'ScanLease', token: str, done_symbols: Set[str]):
+        """Default constructor"""
+        self.token: str = token
+        self.start_time: datetime = datetime.utcnow()
+        self.resumed: bool = len(done_symbols) > 0
+        self.__scan_lease = scan_lease
+        self.__done_symbols = done_symbols
+        self.__symbols: List[str] = list()
+        self.__lost = False
+
+    def pending(self, symbols: List[str]) -> List[str]:
+        """Symbols que faltan por escanear. Si la pasada anterior no termino, se continua donde se quedo"""
+
+        self.__symbols = symbols
+        return [symbol for symbol in symbols if symbol not in self.__done_symbols]
+
+    def mark_done(self, symbol: str) -> bool:
+        """Avanza el cursor y renueva el lease. False si el lease ya no es nuestro: hay que parar la pasada"""
+
+        if self.__lost:
+            return False
+        if not self.__scan_lease.mark_done(self.token, symbol):
+            self.__lost = True
+            logging.warning("Lease perdido en " + self.__scan_lease.name + ", se detiene la pasada")
+            return False
+        self.__done_symbols.add(symbol)
+        return True
+
+    def is_valid(self) -> bool:
+        """Comprobacion de fencing antes de efectos externos (ej: abrir una posicion real)"""
+
+        if not self.__lost and not self.__scan_lease.holds(self.token):
+            self.__lost = True
+        return not self.__lost
+
+    def finish(self):
+        """Libera el lease. Si se han escaneado todos los symbols, borra el cursor"""
+
+        completed = not self.__lost and all(symbol in self.__done_symbols for symbol in self.__symbols)
+        self.__scan_lease.release(self, completed)
+
+
+class ScanLease:
+    """Lease en Redis por escaneo (y shard), con tokens de fencing crecientes: si una pasada sigue en curso cuando
+    llega la siguiente peticion de cron, esta se salta; si la anterior murio o perdio el lease, se continua desde
+    su cursor de progreso. Registra duraciones y solapes de las pasadas"""
+
+    def __init__(self, scan_name: str, shard: int = None, lease_seconds: float = 180, interval_seconds: float = 120):
+        """Default constructor
+        Args:
+            scan_name: Nombre del escaneo (ej: "Analyzer5")
+            shard: Shard del escaneo, si esta repartido
+            lease_seconds: Vida del lease sin renovar. Se renueva con cada symbol escaneado
+            interval_seconds: Periodo del cron: una pasada mas larga cuenta como overrun
+        """
+
+        self.name = scan_name if shard is None else scan_name + "_" + str(shard)
+        self.__redis_client = RedisClient()
+        self.__lease_key = "SCAN_LEASE_" + self.name
+        self.__fencing_key = "SCAN_LEASE_TOKEN_" + self.name
+        self.__cursor_key = "SCAN_CURSOR_" + self.name
+        self.__metrics_key = "SCAN_METRICS_" + self.name
+        self.__lease_milliseconds = int(lease_seconds * 1000)
+        self.__cursor_seconds = int(lease_seconds * 3)  # Un cursor mas antiguo no se continua: pasada nueva
+        self.__interval_seconds = interval_seconds
+
+        self.__mark_done_script = self.__redis_client.register_script(_LUA_MARK_DONE)
+        self.__release_script = self.__redis_client.register_script(_LUA_RELEASE)
+
+    def acquire(self) -> ScanPass:
+        """Adquiere el lease para una pasada. None si hay otra pasada en curso"""
+
+        token = str(self.__redis_client.increase_count(self.__fencing_key))
+        if not self.__redis_client.save_value_if_not_exists(self.__lease_key, token,
+                                                            expiration_seconds=self.__lease_milliseconds // 1000):
+            self.__redis_client.increase_hash_value(self.__metrics_key, "skipped")
+            logging.warning("Pasada de " + self.name + " en curso, se salta esta ejecucion")
+            return None
+
+        done_symbols = {symbol.decode() for symbol in self.__redis_client.get_hash_values(self.__cursor_key)}
+        scan_pass = ScanPass(self, token, done_symbols)
+        if scan_pass.resumed:
+            self.__redis_client.increase_hash_value(self.__metrics_key, "resumed")
+            logging.warning("Se continua la pasada anterior de " + self.name + " (" + str(len(done_symbols)) +
+                            " symbols ya escaneados)")
+        return scan_pass
+
+    def holds(self, token: str) -> bool:
+        value = self.__redis_client.get_value(self.__lease_key)
+        return value is not None and value.decode() == token
+
+    def mark_done(self, token: str, symbol: str) -> bool:
+        return self.__redis_client.run_script(self.__mark_done_script,
+                                              keys=[self.__lease_key, self.__cursor_key],
+                                              args=[token, symbol, self.__lease_milliseconds,
+                                                    self.__cursor_seconds]) == 1
+
+    def release(self, scan_pass: ScanPass, completed: bool):
+        """Libera el lease (si sigue siendo nuestro) y registra las metricas de la pasada"""
+
+        released = self.__redis_client.run_script(self.__release_script,
+                                                  keys=[self.__lease_key, self.__cursor_key],
+                                                  args=[scan_pass.token, 1 if completed else 0]) == 1
+
+        duration = (datetime.utcnow() - scan_pass.start_time).total_seconds()
+        with self.__redis_client.batch():
+            self.__redis_client.increase_hash_value(self.__metrics_key, "passes")
+            self.__redis_client.increase_hash_value(self.__metrics_key, "total_seconds", float(duration))
+            if completed:
+                self.__redis_client.increase_hash_value(self.__metrics_key, "completed")
+            if duration > self.__interval_seconds:
+                self.__redis_client.increase_hash_value(self.__metrics_key, "overruns")
+            if released:
+                self.__redis_client.save_hash_values(self.__metrics_key, {"last_seconds": round(duration, 3),
+                                                                          "last_token": scan_pass.token})
+            else:
+                self.__redis_client.increase_hash_value(self.__metrics_key, "lost_leases")
+
+        if duration > self.__interval_seconds:
+            logging.warning("Pasada de {0} de {1:.1f}s, mas larga que el periodo de {2}s".format(
+                self.name, duration, self.__interval_seconds))
+
+    def get_metrics(self) -> dict:
+        """Pasadas, completadas, saltadas por solape, continuadas, overruns, leases perdidos y duraciones"""
+
+        metrics = {field.decode(): float(value) for field, value in self.__redis_client.get_hash_values(self.__metrics_key).items()}
+        if metrics.get("passes"):
+            metrics["mean_seconds"] = metrics.get("total_seconds", 0) / metrics["passes"]
+        return metrics
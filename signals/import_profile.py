@@ -0,0 +1,73 @@
+# Copyright 2021 TradersOfTheUniverse S.A. All Rights Reserved.
+#
+# [Import Profile - Import time and memory report of the signals service]
+#
+# Authors:
+#   antoniojose.luqueocana@telefonica.com
+#   joseluis.roblesurquiza@telefonica.com
+#   franciscojavier.gonzalezfernandez1@telefonica.com
+#
+# Version: 0.1
+#
+# Uso: python -m signals.import_profile [modulo] [top]
+#   Por defecto perfila signals.main (lo que carga cada worker de gunicorn al arrancar)
+#
+import re
+import subprocess
+import sys
+
+from typing import List, Tuple
+
+_import_time_line = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def profile_imports(module: str) -> Tuple[List[Tuple[str, int, int, int]], float, float]:
+    """Importa el modulo en un interprete limpio con -X importtime
+    Returns:
+        Lista de (modulo, microsegundos propios, microsegundos acumulados, nivel), segundos totales y RSS maximo en MB
+    """
+
+    code = "import resource, time\n" \
+           "start = time.time()\n" \
+           "import {0}\n" \
+           "print('TOTAL', time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)".format(module)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise Exception("Error importando " + module + ":\n" + process.stderr)
+
+    imports = list()
+    for line in process.stderr.splitlines():
+        match = _import_time_line.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+
+    total_seconds, max_rss_kb = process.stdout.split()[-2:]
+    return imports, float(total_seconds), int(max_rss_kb) / 1024
+
+
+def print_report(module: str, top: int = 25):
+    imports, total_seconds, max_rss_mb = profile_imports(module)
+
+    print("Import de {0}: {1:.3f}s, RSS max {2:.1f} MB, {3} modulos".format(module, total_seconds, max_rss_mb,
+                                                                            len(imports)))
+
+    print("\nPaquetes de primer nivel mas lentos (acumulado):")
+    top_level = dict()
+    for name, self_us, cumulative_us, level in imports:
+        if level == 0:
+            package = name.split(".")[0]
+            top_level[package] = top_level.get(package, 0) + cumulative_us
+    for package, cumulative_us in sorted(top_level.items(), key=lambda item: -item[1])[:top]:
+        print("  {0:>9.1f} ms  {1}".format(cumulative_us / 1000, package))
+
+    print("\nModulos mas lentos (propio):")
+    for name, self_us, cumulative_us, level in sorted(imports, key=lambda item: -item[1])[:top]:
+        print("  {0:>9.1f} ms  {1}".format(self_us / 1000, name))
+
+
+# Local Testing
+if __name__ == "__main__":
+    print_report(sys.argv[1] if len(sys.argv) > 1 else "signals.main",
+                 int(sys.argv[2]) if len(sys.argv) > 2 else 25)
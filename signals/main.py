@@ -11,18 +11,13 @@
 #
 
 import logging
+import threading
 from re import sub
 
 from flask import Flask, request
 
-from core.account.account_manager import AccountManager
-from core.market.analyzer5 import Analyzer5
-from core.market.analyzerJ2 import AnalyzerJ2
-from core.market.analyzerJ3_1m import AnalyzerJ3_1m
-from core.order.order_simulator import OrderSimulator
-
-
 # Loggin Config
+from core.utils.bq_writer import BigQueryWriter
 from core.utils.redisclient import RedisClient
 
 logging.basicConfig(
@@ -35,11 +30,49 @@ logging.basicConfig(
 logging.info("1.- Flask app config")
 app = Flask(__name__)
 
-# Initialize
-market_analyzer5 = Analyzer5(real_orders=True)
-market_analyzer3_1m = AnalyzerJ3_1m(real_orders=True)
-market_analyzer2_5m = AnalyzerJ2(real_orders=True)
-order_simulator = OrderSimulator()
+# Initialize: los analyzers y sus clientes (Secret Manager, exchangeInfo, Datastore, BQ, Cloud Tasks) se crean
+# en la primera peticion a su ruta, no al arrancar cada worker de gunicorn
+_instances = dict()
+_instances_lock = threading.Lock()
+
+
+def get_instance(name: str, factory):
+    """ Instancia unica por worker, construida en el primer uso """
+    instance = _instances.get(name)
+    if instance is None:
+        with _instances_lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+
+def get_market_analyzer5():
+    from core.market.analyzer5 import Analyzer5
+    return get_instance("analyzer5", lambda: Analyzer5(real_orders=True))
+
+
+def get_market_analyzer3_1m():
+    from core.market.analyzerJ3_1m import AnalyzerJ3_1m
+    return get_instance("analyzerJ3_1m", lambda: AnalyzerJ3_1m(real_orders=True))
+
+
+def get_market_analyzer2_5m():
+    from core.market.analyzerJ2 import AnalyzerJ2
+    return get_instance("analyzerJ2_5m", lambda: AnalyzerJ2(real_orders=True))
+
+
+def get_shard():
+    """ Shard del escaneo de la peticion (?shard=0&shards=4). (None, None): todos los symbols """
+    shards = request.args.get("shards", default=None, type=int)
+    shard = request.args.get("shard", default=None, type=int) if shards is not None else None
+    return shard, shards
+
+
+def get_order_simulator():
+    from core.order.order_simulator import OrderSimulator
+    return get_instance("order_simulator", OrderSimulator)
 
 
 @app.route('/')
@@ -54,7 +87,7 @@ def analyze_market():
     """ Analyze market and send alerts for signals """
     try:
         logging.info("Inicio Analizer5")
-        market_analyzer5.analyze_all()
+        get_market_analyzer5().analyze_all(*get_shard())
         logging.info("Fin Analizer5")
     except Exception as e:
         logging.exception(e)
@@ -66,7 +99,7 @@ def analyzer_j2_5m():
     """ Analyze market and send alerts for signals """
     try:
         logging.info("Inicio Analyzer2_5m")
-        market_analyzer2_5m.real_orders()
+        get_market_analyzer2_5m().real_orders()
         logging.info("Fin Analizer2_5m")
     except Exception as e:
         logging.exception(e)
@@ -78,7 +111,7 @@ def analyzer_j3_1m():
     """ Analyze market and send alerts for signals """
     try:
         logging.info("Inicio Analizer3_1m")
-        market_analyzer3_1m.real_orders()
+        get_market_analyzer3_1m().real_orders(*get_shard())
         logging.info("Fin Analizer3_1m")
     except Exception as e:
         logging.exception(e)
@@ -89,7 +122,7 @@ def analyzer_j3_1m():
 def check_profit():
     """ Check stoploss and trailing stop of a opened simulated order """
     try:
-        order_simulator.refresh_order(request.get_json())
+        get_order_simulator().refresh_order(request.get_json())
     except Exception as e:
         logging.exception(e)
         raise e
@@ -97,6 +130,45 @@ def check_profit():
     return "OK"
 
 
+@app.route('/mobydick/signals/simulation/tick', methods=['POST'])
+def tick_simulations():
+    """ Check stoploss and trailing stop of all opened simulated orders in a single tick """
+    try:
+        get_order_simulator().tick_simulations((request.get_json(silent=True) or {}).get("chain_token"))
+    except Exception as e:
+        logging.exception(e)
+        raise e
+
+    return "OK"
+
+
+@app.route('/mobydick/admin/bq_writer/metrics', methods=['GET'])
+def bq_writer_metrics():
+    """ Estado de la cola de escritura a BQ de este worker """
+    return BigQueryWriter().get_metrics()
+
+
+@app.route('/mobydick/admin/scan/results', methods=['GET'])
+def scan_results():
+    """ Resultados publicados por todos los shards de un escaneo en los ultimos minutos """
+    from datetime import datetime, timedelta
+    from core.market.symbol_sharding import SymbolSharding
+
+    scan = request.args.get("scan", default="Analyzer5", type=str)
+    minutes = request.args.get("minutes", default=10, type=int)
+    return {"results": SymbolSharding(scan).get_results(datetime.utcnow() - timedelta(minutes=minutes))}
+
+
+@app.route('/mobydick/admin/scan/metrics', methods=['GET'])
+def scan_metrics():
+    """ Duraciones, solapes y overruns de las pasadas de un escaneo (y shard) """
+    from core.utils.scan_lease import ScanLease
+
+    scan = request.args.get("scan", default="Analyzer5", type=str)
+    shard = request.args.get("shard", default=None, type=int)
+    return ScanLease(scan, shard).get_metrics()
+
+
 @app.route('/mobydick/admin/redis/flushall', methods=['GET'])
 def flushall():
     """ Carga en BQ de candle sticks """
@@ -108,6 +180,8 @@ def flushall():
 @app.route('/mobydick/admin/show/account', methods=['GET'])
 def show_account():
     """ Muestra la informacion de la cuenta """
+    from core.account.account_manager import AccountManager
+
     account = request.args.get("account", default=None, type=str)
     start = request.args.get("start", default=None, type=str)
     end = request.args.get("end", default=None, type=str)